@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+from django.conf import settings
+from anonymizer.datasource.managers.workers import start_pools
+
+__author__ = 'dipap'
+
+
+class AnonymizerConfig(AppConfig):
+    name = 'anonymizer'
+
+    def ready(self):
+        # fork the ANONYMIZER_WORKERS worker processes before requests open database connections or start threads
+        workers = getattr(settings, 'ANONYMIZER_WORKERS', 0)
+        if workers > 1:
+            start_pools(workers)
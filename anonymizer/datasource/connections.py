@@ -3,6 +3,20 @@ __author__ = 'dipap'
 import sqlite3
 from mysql.connector import connect as mysql_connect
 import psycopg2
+from functools import partial
+from itertools import count, islice
+from anonymizer.datasource.dialects import PARAMETER, SQLite3Dialect, MySQLDialect, PostgresDialect
+from anonymizer.datasource.pools import PooledConnection, connection_pools
+from anonymizer.datasource.schema import Schema
+
+# number of statements each connection keeps ready to run again
+STATEMENT_CACHE_SIZE = 256
+
+# number of rows a server-side cursor reads from the server at a time
+ITERSIZE = 2000
+
+# names of the Postgres server-side cursors
+_cursor_ids = count()
 
 
 class UnsupportedEngine(Exception):
@@ -16,15 +30,34 @@ class ConnectionNotFound(Exception):
 class Connection:
     """
     A single connection object to a database
+    Queries borrow a database connection of the pool, each thread uses its own
     """
 
-    def __init__(self, id, engine, conn=None):
+    def __init__(self, id, engine, conn=None, pool=None, itersize=ITERSIZE):
+        """
+        :param conn: A database connection shared by all threads, if there is no pool
+        :param pool: The pool of the database, see anonymizer.datasource.pools
+        :param itersize: Number of rows the server-side cursors of `fetch_chunks` read at a time
+        """
         self.id = id
         self.engine = engine
-        self.conn = conn
+        self.pool = pool
+        self.itersize = itersize
 
-        if self.is_sqlite3() or self.is_mysql() or self.is_postgres():
-            pass
+        # tables, columns & foreign keys, see `schema`
+        self._schema = None
+
+        self._connection = None
+        if conn is not None:
+            self._connection = PooledConnection(conn)
+
+        # SQL generation for this engine
+        if self.is_sqlite3():
+            self.dialect = SQLite3Dialect()
+        elif self.is_mysql():
+            self.dialect = MySQLDialect()
+        elif self.is_postgres():
+            self.dialect = PostgresDialect()
         else:
             raise UnsupportedEngine('Unsupported engine: ' + self.engine)
 
@@ -37,330 +70,384 @@ class Connection:
     def is_postgres(self):
         return self.engine == 'django.db.backends.psycopg2'
 
-    def execute(self, query):
+    def checkout(self):
+        """
+        :return: The PooledConnection of the current thread
+        """
+        if self.pool is not None:
+            return self.pool.acquire()
+
+        return self._connection
+
+    def release(self):
+        """
+        Gives the database connection of the current thread back to the pool
+        """
+        if self.pool is not None:
+            self.pool.release()
+
+    def cursor(self, connection):
+        if self.is_mysql():
+            # read the whole result, so other queries can run while it is being iterated
+            return connection.conn.cursor(buffered=True)
+
+        return connection.conn.cursor()
+
+    def execute(self, query, params=None):
         """
         Create new cursor & execute the given query
+        :param params: If set, `query` is a template with a `PARAMETER` in place of each of these values
         """
-        cursor = self.conn.cursor()
+        connection = self.checkout()
+
+        cursor = self.cursor(connection)
         try:
-            cursor.execute(query)
+            if params is None:
+                cursor.execute(query)
+            else:
+                cursor.execute(self.statement(connection, query), tuple(params))
         except Exception, e:
             print(e)
-            self.conn.rollback()
+            connection.conn.rollback()
 
         return cursor
 
-    def commit(self):
+    def statement(self, connection, template):
         """
-        Commits the cursor
+        :param connection: The PooledConnection the statement runs on
+        :return: The SQL that runs a parameterized template, created once per template & database connection
+                 Postgres prepares the template on the server, so it is parsed & planned only the first time
         """
-        self.conn.commit()
+        try:
+            return connection.statements[template]
+        except KeyError:
+            pass
 
-    def tables(self):
+        if len(connection.statements) >= STATEMENT_CACHE_SIZE:
+            if self.is_postgres():
+                connection.conn.cursor().execute('DEALLOCATE ALL')
+            connection.statements.clear()
+
+        if self.is_postgres():
+            name = 'anonymizer_%d' % connection.n_of_prepared
+            connection.n_of_prepared += 1
+
+            connection.conn.cursor().execute(self.dialect.prepare(name, template))
+            sql = self.dialect.execute_prepared(name, template.count(PARAMETER))
+        else:
+            sql = self.dialect.bind(template)
+
+        connection.statements[template] = sql
+        return sql
+
+    def fetch_chunks(self, query, chunk_size, params=None):
         """
-        :return: a list of all tables in this connection
+        Executes the query & yields its rows in lists of at most `chunk_size` rows
+        The rows are streamed from the server, so results of any size are read in bounded memory:
+        Postgres reads them through a named cursor, `itersize` rows at a time, MySQL through an unbuffered cursor
+        & sqlite steps through the result as it is iterated
+        Close the generator to stop early, that also frees the cursor on the server
+        Errors of the query are raised to the caller
         """
-        if self.is_sqlite3():
-            query = 'SELECT name FROM sqlite_master WHERE type=\'table\';'
-        elif self.is_mysql():
-            query = 'SHOW TABLES;'
-        elif self.is_postgres():
-            query = 'SELECT tablename FROM pg_catalog.pg_tables WHERE schemaname = \'public\';'
+        # other queries can't run on a MySQL connection until its unbuffered result is read,
+        # so the rows are read on a connection of their own
+        dedicated = self.is_mysql() and self.pool is not None
+        if dedicated:
+            connection = self.pool.borrow()
+        else:
+            connection = self.checkout()
 
-        return self.execute(query).fetchall()
+        if self.is_postgres():
+            cursor = connection.conn.cursor(name='anonymizer_stream_%d' % next(_cursor_ids))
+            cursor.itersize = self.itersize
+        elif dedicated:
+            cursor = connection.conn.cursor(buffered=False)
+        else:
+            cursor = self.cursor(connection)
 
-    def primary_key_of(self, table_name):
+        broken = False
+        try:
+            try:
+                if params is None:
+                    cursor.execute(query)
+                else:
+                    # a server-side cursor can't be declared for a prepared statement
+                    cursor.execute(self.dialect.bind(query), tuple(params))
+            except Exception:
+                # leave the connection usable for other queries (a failed Postgres transaction refuses them)
+                connection.conn.rollback()
+                raise
+
+            while True:
+                rows = list(islice(cursor, chunk_size))
+                if not rows:
+                    break
+
+                yield rows
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                # e.g rows of an unbuffered result were left unread
+                broken = True
+
+            if dedicated:
+                self.pool.give_back(connection, broken=broken)
+
+    def commit(self):
         """
-        :return: the primary key of this table
+        Commits the cursor
         """
-        if self.is_sqlite3():
-            query = "PRAGMA table_info('%s')" % table_name
-            for row in self.execute(query).fetchall():
-                if row[5]:  # 5th column is the `pk`
-                    return '%s.%s@%s' % (table_name, row[1], self.id)
+        self.checkout().conn.commit()
 
-            raise ValueError('Could not find primary key of table "%s"' % table_name)
-        elif self.is_mysql():
-            query = "SHOW INDEX FROM %s where Key_name='PRIMARY'" % table_name
-            row = self.execute(query).fetchone()
-            return '%s.%s@%s' % (table_name, row[4], self.id)
-        elif self.is_postgres():
-            query = """
-                SELECT
-                c.column_name
-                FROM
-                information_schema.table_constraints tc
-                JOIN information_schema.constraint_column_usage AS ccu USING (constraint_schema, constraint_name)
-                JOIN information_schema.columns AS c ON c.table_schema = tc.constraint_schema AND tc.table_name = c.table_name AND ccu.column_name = c.column_name
-                WHERE constraint_type = 'PRIMARY KEY' and tc.table_name = '%s';
-            """ % table_name
+    def schema(self):
+        """
+        :return: The Schema of the database, introspected on the first call & cached until `invalidate_schema`
+        """
+        if self._schema is None:
+            self._schema = Schema(self.introspect())
 
-            row = self.execute(query).fetchone()
-            return '%s.%s@%s' % (table_name, row[0], self.id)
+        return self._schema
 
-    def get_data_properties(self, table_name, from_related=False):
+    def set_schema(self, schema):
         """
-        If from_related is set to true, columns from other tables pointing to [table_name] will also be included
-        :return: (all non-auto increment columns of table, all foreign key pairs)
+        Uses a schema introspected earlier, e.g the snapshot stored on a configuration
         """
-        result = []
+        self._schema = schema
 
-        # check on which
-        tables = [table_name]
-        relationships = []
-        if from_related:
-            res = self.get_related_tables(table_name, already_accessed=[table_name])
-            tables += res[0]
-            relationships += res[1]
+    def invalidate_schema(self):
+        """
+        Drops the cached schema, the next call to `schema` introspects the database again
+        """
+        self._schema = None
 
-        tables = list(set(tables))
-        # look for columns in the table(s)
-        for table in tables:
-            if self.is_sqlite3():
-                query = "PRAGMA table_info('%s')" % table
-                for row in self.execute(query).fetchall():
-                    result.append((row[1], row[2], '%s.%s@%s' % (table, row[1], self.id)))
-
-            elif self.is_mysql():
-                query = "SHOW COLUMNS FROM %s;" % table
-                for row in self.execute(query).fetchall():
-                    if ('auto' not in row[5]) and ('MUL' not in row[3]):
-                        result.append((row[0], row[1], '%s.%s@%s' % (table, row[0], self.id)))
-
-            elif self.is_postgres():
-                query = """
-                    SELECT information_schema.columns.column_name, information_schema.columns.data_type
-                    FROM information_schema.columns
-                    WHERE information_schema.columns.table_name = '%s'
-                    EXCEPT
-                    SELECT information_schema.columns.column_name, information_schema.columns.data_type
-                    FROM information_schema.columns
-                    JOIN information_schema.table_constraints AS tc
-                        ON tc.table_name = information_schema.columns.table_name
-                    JOIN information_schema.key_column_usage AS kcu
-                        ON tc.constraint_name = kcu.constraint_name AND kcu.column_name = information_schema.columns.column_name
-                    JOIN information_schema.constraint_column_usage AS ccu
-                        ON ccu.constraint_name = tc.constraint_name
-                    WHERE information_schema.columns.table_name = '%s' AND (constraint_type = 'FOREIGN KEY' OR (COALESCE(information_schema.columns.column_default, '') LIKE 'nextval%%'));
-                """ % (table, table)
-                for row in self.execute(query).fetchall():
-                    result.append((row[0], row[1], '%s.%s@%s' % (table, row[0], self.id)))
+    def introspect(self):
+        """
+        Reads the tables, columns, primary keys & foreign keys of the database in a single pass
+        One catalog query on MySQL & Postgres, two PRAGMA statements per table on sqlite
+        :return: The tables, in the format of Schema
+        """
+        tables = []
+        by_name = {}
 
-        # save detected foreign keys
-        return result, relationships
+        def table_of(name):
+            if name not in by_name:
+                by_name[name] = {'name': name, 'columns': [], 'primary_key': None, 'foreign_keys': [],
+                                 'internal': []}
+                tables.append(by_name[name])
+
+            return by_name[name]
 
-    def get_foreign_key_between(self, from_table, to_table):
         if self.is_sqlite3():
-            query = "PRAGMA foreign_key_list('%s')" % from_table
+            query = 'SELECT name FROM sqlite_master WHERE type=\'table\';'
             for row in self.execute(query).fetchall():
-                if row[2].lower() == to_table.lower():
-                    return '%s.%s@%s' % (from_table, row[3], self.id)
+                table = table_of(row[0])
 
-            return None
+                for column in self.execute("PRAGMA table_info('%s')" % row[0]).fetchall():
+                    table['columns'].append([column[1], column[2]])
+                    if column[5] and table['primary_key'] is None:  # 5th column is the `pk`
+                        table['primary_key'] = column[1]
+
+                for key in self.execute("PRAGMA foreign_key_list('%s')" % row[0]).fetchall():
+                    table['foreign_keys'].append([key[3], key[2], key[4]])
 
         elif self.is_mysql():
             query = """
-                SELECT COLUMN_NAME
+                SELECT c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE, c.COLUMN_KEY, c.EXTRA,
+                       k.REFERENCED_TABLE_NAME, k.REFERENCED_COLUMN_NAME
                 FROM
-                    information_schema.KEY_COLUMN_USAGE
+                  information_schema.COLUMNS AS c
+                  LEFT OUTER JOIN information_schema.KEY_COLUMN_USAGE AS k
+                    ON k.TABLE_SCHEMA = c.TABLE_SCHEMA AND k.TABLE_NAME = c.TABLE_NAME AND
+                       k.COLUMN_NAME = c.COLUMN_NAME AND k.REFERENCED_TABLE_NAME IS NOT NULL
                 WHERE
-                    TABLE_NAME = '%s' AND
-                    REFERENCED_TABLE_NAME = '%s'
-            """ % (from_table, to_table)
+                  c.TABLE_SCHEMA = DATABASE()
+                ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION
+            """
+            for row in self.execute(query).fetchall():
+                table = table_of(row[0])
 
-            return '%s.%s@%s' % (from_table, self.execute(query).fetchone()[0], self.id)
+                if not table['columns'] or table['columns'][-1][0] != row[1]:
+                    table['columns'].append([row[1], row[2]])
+                    if row[3] == 'PRI' and table['primary_key'] is None:
+                        table['primary_key'] = row[1]
+                    if ('auto' in row[4]) or ('MUL' in row[3]):
+                        table['internal'].append(row[1])
+
+                if row[5]:
+                    table['foreign_keys'].append([row[1], row[5], row[6]])
 
         elif self.is_postgres():
             query = """
-                SELECT
-                    tc.constraint_name, tc.table_name, kcu.column_name,
-                    ccu.table_name AS foreign_table_name,
-                    ccu.column_name AS foreign_column_name
+                SELECT c.table_name, c.column_name, c.data_type, COALESCE(c.column_default, ''),
+                       tc.constraint_type, ccu.table_name, ccu.column_name
                 FROM
-                    information_schema.table_constraints AS tc
-                    JOIN information_schema.key_column_usage AS kcu
-                      ON tc.constraint_name = kcu.constraint_name
-                    JOIN information_schema.constraint_column_usage AS ccu
-                      ON ccu.constraint_name = tc.constraint_name
-                WHERE constraint_type = 'FOREIGN KEY' AND tc.table_name='%s' AND ccu.table_name='%s';
-            """ % (from_table, to_table)
+                  information_schema.tables AS t
+                  JOIN information_schema.columns AS c
+                    ON c.table_schema = t.table_schema AND c.table_name = t.table_name
+                  LEFT OUTER JOIN information_schema.key_column_usage AS kcu
+                    ON kcu.table_schema = c.table_schema AND kcu.table_name = c.table_name AND
+                       kcu.column_name = c.column_name
+                  LEFT OUTER JOIN information_schema.table_constraints AS tc
+                    ON tc.constraint_schema = kcu.constraint_schema AND tc.constraint_name = kcu.constraint_name AND
+                       tc.constraint_type IN ('PRIMARY KEY', 'FOREIGN KEY')
+                  LEFT OUTER JOIN information_schema.constraint_column_usage AS ccu
+                    ON tc.constraint_type = 'FOREIGN KEY' AND ccu.constraint_schema = tc.constraint_schema AND
+                       ccu.constraint_name = tc.constraint_name
+                WHERE
+                  t.table_schema = 'public' AND t.table_type = 'BASE TABLE'
+                ORDER BY c.table_name, c.ordinal_position
+            """
+            for row in self.execute(query).fetchall():
+                table = table_of(row[0])
 
-            row = self.execute(query).fetchone()
-            if not row:
-                return None
+                if not table['columns'] or table['columns'][-1][0] != row[1]:
+                    table['columns'].append([row[1], row[2]])
+                    if row[3].startswith('nextval'):
+                        table['internal'].append(row[1])
 
-            return '%s.%s@%s' % (from_table, row[2], self.id)
+                if row[4] == 'PRIMARY KEY' and table['primary_key'] is None:
+                    table['primary_key'] = row[1]
+                elif row[4] == 'FOREIGN KEY':
+                    table['foreign_keys'].append([row[1], row[5], row[6]])
+                    if row[1] not in table['internal']:
+                        table['internal'].append(row[1])
 
-    def get_related_tables(self, table_name, already_accessed=None):
+        return tables
+
+    def estimate_rows(self):
         """
-        :param table_name: The name of the table that is examined
-        :param already_accessed: The list of table names that have already been examined
-        :return: A list of tuples (table_name, through_property) that can reach/be reached on this table
+        :return: {table name: estimated number of rows}, from the statistics of MySQL & Postgres
+                 sqlite keeps no statistics, so its rows are counted
         """
-        if not already_accessed:
-            already_accessed = [table_name]
-
-        table_pk = self.primary_key_of(table_name).split('@')[0]
-        conn = self.primary_key_of(table_name).split('@')[1]
-        relationships = []
-        tables = []
+        result = {}
 
         if self.is_sqlite3():
-            # foreign keys FROM table_name
-            query = "PRAGMA foreign_key_list('%s')" % table_name
-            for row in self.execute(query).fetchall():
-                tables.append(row[2])
-                from_key = '%s.%s' % (table_name, row[3])
-                to_key = '%s.%s' % (row[2], row[4])
-
-                relationships.append((row[2], from_key, to_key))
-
-            # foreign keys TO table_name
-            # no automated way - we have to go through every table
-            result = []
-            for joined_table in self.tables():
-                if joined_table not in result:
-                    query = "PRAGMA foreign_key_list('%s')" % joined_table[0]
-
-                    is_joined = False
-                    for row in self.execute(query).fetchall():
-                        if row[2].lower() == table_name.lower():  # 2nd column is target table
-                            is_joined = True
-                            break
-
-                    if is_joined:
-                        tables.append(joined_table[0])
-                        relationships.append((joined_table[0], table_pk, '%s.%s' % (joined_table[0], row[3])))
+            for name in self.schema().table_names():
+                row = self.execute('SELECT COUNT(*) FROM "%s"' % name).fetchone()
+                if row:
+                    result[name] = row[0]
 
         elif self.is_mysql():
             query = """
-                SELECT DISTINCT TABLE_NAME, COLUMN_NAME, REFERENCED_COLUMN_NAME
+                SELECT TABLE_NAME, TABLE_ROWS
                 FROM
-                  information_schema.KEY_COLUMN_USAGE
+                  information_schema.TABLES
                 WHERE
-                  REFERENCED_TABLE_NAME = '%s'
-            """ % table_name
+                  TABLE_SCHEMA = DATABASE()
+            """
             for row in self.execute(query).fetchall():
-                if row[0]:
-                    tables.append(row[0])
-                    from_key = '%s.%s' % (table_name, row[2])
-                    to_key = '%s.%s' % (row[0], row[1])
-                    relationships.append((row[0], from_key, to_key))
+                result[row[0]] = row[1]
 
+        elif self.is_postgres():
             query = """
-                SELECT DISTINCT REFERENCED_TABLE_NAME, COLUMN_NAME, REFERENCED_COLUMN_NAME
+                SELECT c.relname, CAST(c.reltuples AS BIGINT)
                 FROM
-                  information_schema.KEY_COLUMN_USAGE
+                  pg_catalog.pg_class AS c
+                  JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
                 WHERE
-                  TABLE_NAME = '%s'
-            """ % table_name
+                  n.nspname = 'public' AND c.relkind = 'r'
+            """
             for row in self.execute(query).fetchall():
-                if row[0]:
-                    tables.append(row[0])
-                    from_key = '%s.%s' % (row[1], table_name)
-                    to_key = '%s.%s' % (row[0], row[2])
-                    relationships.append((row[0], from_key, to_key))
+                # tables that were never analyzed have no estimate
+                if row[1] >= 0:
+                    result[row[0]] = row[1]
 
-        elif self.is_postgres():
-            # foreign keys referencing table_name
-            query = """
-                SELECT DISTINCT information_schema.columns.table_name, information_schema.columns.column_name, ccu.column_name
-                FROM information_schema.columns
-                JOIN information_schema.table_constraints AS tc
-                    ON tc.table_name = information_schema.columns.table_name
-                JOIN information_schema.key_column_usage AS kcu
-                    ON tc.constraint_name = kcu.constraint_name AND kcu.column_name = information_schema.columns.column_name
-                JOIN information_schema.constraint_column_usage AS ccu
-                    ON ccu.constraint_name = tc.constraint_name
-                WHERE constraint_type = 'FOREIGN KEY' AND (ccu.table_name = '%s')
-            """ % table_name
-            for row in self.execute(query).fetchall():
-                tables.append(row[0])
-                from_key = '%s.%s' % (table_name, row[2])
-                to_key = '%s.%s' % (row[0], row[1])
-                relationships.append((row[0], from_key, to_key))
+        return result
 
-            # foreign keys referenced by table_name
-            query = """
-                SELECT DISTINCT ccu.table_name, information_schema.columns.column_name, ccu.column_name
-                FROM information_schema.columns
-                JOIN information_schema.table_constraints AS tc
-                    ON tc.table_name = information_schema.columns.table_name
-                JOIN information_schema.key_column_usage AS kcu
-                    ON tc.constraint_name = kcu.constraint_name AND kcu.column_name = information_schema.columns.column_name
-                JOIN information_schema.constraint_column_usage AS ccu
-                    ON ccu.constraint_name = tc.constraint_name
-                WHERE constraint_type = 'FOREIGN KEY' AND (information_schema.columns.table_name = '%s')
-            """ % table_name
-            for row in self.execute(query).fetchall():
-                tables.append(row[0])
-                from_key = '%s.%s' % (row[0], row[2])
-                to_key = '%s.%s' % (table_name, row[1])
-                relationships.append((row[0], from_key, to_key))
+    def tables(self):
+        """
+        :return: a list of all tables in this connection
+        """
+        return [(name,) for name in self.schema().table_names()]
+
+    def primary_key_of(self, table_name):
+        """
+        :return: the primary key of this table
+        """
+        column = self.schema().primary_key(table_name)
+        if column is None:
+            raise ValueError('Could not find primary key of table "%s"' % table_name)
+
+        return '%s.%s@%s' % (table_name, column, self.id)
+
+    def get_data_properties(self, table_name, from_related=False):
+        """
+        If from_related is set to true, columns from other tables pointing to [table_name] will also be included
+        :return: (all non-auto increment columns of table, all foreign key pairs)
+        """
+        result = []
+
+        # check on which
+        tables = [table_name]
+        relationships = []
+        if from_related:
+            res = self.get_related_tables(table_name)
+            tables += res[0]
+            relationships += res[1]
 
-        # recursively search all referenced tables
-        final_result = []
+        # look for columns in the table(s)
         for table in tables:
-            if table not in already_accessed:
-                final_result.append(table)
-                old_already_accessed = already_accessed[:]
-                already_accessed.append(table)
-                res = self.get_related_tables(table, already_accessed)
-
-                # filter out relations
-                final_result += res[0]
-                for rel in res[1]:
-                    if rel[0] not in old_already_accessed:
-                        relationships.append(rel)
+            for column, tp in self.schema().columns(table, data_only=True):
+                result.append((column, tp, '%s.%s@%s' % (table, column, self.id)))
+
+        # save detected foreign keys
+        return result, relationships
+
+    def get_foreign_key_between(self, from_table, to_table):
+        column = self.schema().foreign_key_between(from_table, to_table)
+        if column is None:
+            return None
+
+        return '%s.%s@%s' % (from_table, column, self.id)
+
+    def get_related_tables(self, table_name):
+        """
+        :param table_name: The name of the table that is examined
+        :return: (all tables that can reach/be reached from this table,
+                  the [joined table, column, column] foreign keys that connect them)
+        """
+        tables, relationships = self.schema().related_tables(table_name)
 
         # add connection string
-        final_relationships = []
-        for relationship in relationships:
-            rel_1 = relationship[1]
-            if '@' not in rel_1:
-                rel_1 += '@' + conn
+        return tables, [[table, '%s@%s' % (left, self.id), '%s@%s' % (right, self.id)]
+                        for table, left, right in relationships]
+
 
-            rel_2 = relationship[2]
-            if '@' not in rel_2:
-                rel_2 += '@' + conn
+def connect(conn_info):
+    """
+    :return: A new database connection for the connection info of a configuration
+    """
+    engine = conn_info['engine']
 
-            final_relationships.append([
-                relationship[0],
-                rel_1,
-                rel_2,
-            ])
+    if engine == 'django.db.backends.sqlite3':
+        # pooled connections move between threads
+        return sqlite3.connect(conn_info['name'], check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    elif engine == 'django.db.backends.mysql':
+        return mysql_connect(host=conn_info['host'], port=conn_info['port'],
+                             user=conn_info['user'], password=conn_info['password'],
+                             database=conn_info['name'])
+    elif engine == 'django.db.backends.psycopg2':
+        return psycopg2.connect("host='%s' port='%s' user='%s' password='%s' dbname='%s'" %
+                                (conn_info['host'], conn_info['port'], conn_info['user'],
+                                 conn_info['password'], conn_info['name']))
 
-        # return all connected tables
-        return final_result, final_relationships
+    raise UnsupportedEngine('Unsupported engine: ' + engine)
 
 
 class ConnectionManager:
     """
     The connection manager handles connections to different databases manifested in the specified file
+    Database connections are borrowed from the process-wide pools, so creating a manager does not connect
     """
 
-    def __init__(self, connection_dict):
+    def __init__(self, connection_dict, pools=connection_pools):
         self.connections = []
 
         # create connection to all databases & save them
         for conn_info in connection_dict:
-            connection = Connection(id=conn_info['id'], engine=conn_info['engine'])
-
-            if connection.is_sqlite3():
-                conn = sqlite3.connect(conn_info['name'])
-            elif connection.is_mysql():
-                conn = mysql_connect(host=conn_info['host'], port=conn_info['port'],
-                                     user=conn_info['user'], password=conn_info['password'],
-                                     database=conn_info['name'])
-            elif connection.is_postgres():
-                conn = psycopg2.connect("host='%s' port='%s' user='%s' password='%s' dbname='%s'" %
-                                        (conn_info['host'], conn_info['port'], conn_info['user'],
-                                         conn_info['password'], conn_info['name']))
-            else:
-                raise UnsupportedEngine('Unsupported engine: ' + conn_info['engine'])
-
-            # save the connection object
-            connection.conn = conn
+            connection = Connection(id=conn_info['id'], engine=conn_info['engine'],
+                                    pool=pools.get(conn_info, partial(connect, conn_info)))
 
             # add to connections array
             self.connections.append(connection)
@@ -0,0 +1,207 @@
+__author__ = 'dipap'
+
+import json
+
+# placeholder of a parameter in the SQL templates of the managers, a character that can't appear in SQL text
+PARAMETER = '\0'
+
+# legacy aggregate of the hour of a datetime, saved by older configurations
+TO_CHAR_HOUR = "to_char(@param, 'HH24')"
+
+
+def is_bucket(aggregate):
+    """
+    :return: True if an aggregate of the configuration puts single values in buckets instead of aggregating them
+    """
+    return aggregate is not None and (aggregate.lower() == 'hour' or aggregate == TO_CHAR_HOUR)
+
+
+class Dialect:
+    """
+    Generates the SQL that differs between database engines
+    The defaults follow Postgres
+    """
+    # most parameters in a single statement
+    max_parameters = 32767
+
+    # True if date columns keep any text, not only dates the date functions of the database can read
+    text_dates = False
+
+    def array_agg(self, expression):
+        """
+        :return: Aggregate of the values of `expression` into a single list value
+        """
+        return 'array_agg(%s)' % expression
+
+    def parse_array(self, value):
+        """
+        :return: The python list of a value returned by `array_agg`
+        """
+        return value
+
+    def group_concat(self, expression):
+        """
+        :return: Aggregate of the values of `expression` into a comma separated string
+        """
+        return "string_agg(CAST(%s AS TEXT), ',')" % expression
+
+    def hour(self, expression):
+        """
+        :return: The hour (0-23) of a datetime expression
+        """
+        return 'CAST(EXTRACT(HOUR FROM {0}) AS INTEGER)'.format(expression)
+
+    def years_since(self, expression):
+        """
+        :return: The number of full years from a date expression up to the current UTC time
+        """
+        return "CAST(EXTRACT(YEAR FROM AGE(CAST(timezone('UTC', now()) AS timestamp), CAST({0} AS timestamp))) " \
+               "AS INTEGER)".format(expression)
+
+    def as_date(self, expression):
+        """
+        :return: `expression` as a value that compares as a date, e.g against a date parameter
+        """
+        return expression
+
+    def aggregate(self, aggregate, expression):
+        """
+        :param aggregate: The aggregate of a property, a function name (e.g `avg`) or an expression of `@param`
+        :return: The aggregate applied on `expression`
+        """
+        if aggregate.lower() == 'group_concat':
+            return self.group_concat(expression)
+        elif '@param' in aggregate:
+            return aggregate.replace('@param', expression)
+
+        return '%s(%s)' % (aggregate, expression)
+
+    def bucket(self, bucket, expression):
+        """
+        :param bucket: A bucket aggregate, see `is_bucket`
+        :return: The bucket of the value of `expression`, e.g the hour of a datetime
+        """
+        return self.hour(expression)
+
+    def bind(self, template):
+        """
+        :param template: SQL with a `PARAMETER` in place of each parameter
+        :return: The SQL for the parameter style of the driver
+        """
+        # `%` is the start of a placeholder in the format style
+        return template.replace('%', '%%').replace(PARAMETER, '%s')
+
+    def paginate(self, offset, limit):
+        """
+        :param offset: Number of rows to skip or None
+        :param limit: Maximum number of rows or None
+        :return: The pagination clause of a query
+        """
+        result = ''
+        if limit is not None:
+            result += ' LIMIT %d' % limit
+        if offset:
+            result += ' OFFSET %d' % offset
+
+        return result
+
+
+class SQLite3Dialect(Dialect):
+    max_parameters = 999
+
+    # dates are kept as text in the format they were written, strftime & co only read ISO 8601 ones
+    text_dates = True
+
+    def array_agg(self, expression):
+        return 'json_group_array(%s)' % expression
+
+    def parse_array(self, value):
+        if value is None:
+            return None
+
+        return json.loads(value)
+
+    def group_concat(self, expression):
+        return 'group_concat(%s)' % expression
+
+    def bind(self, template):
+        return template.replace(PARAMETER, '?')
+
+    def hour(self, expression):
+        return "CAST(strftime('%H', {0}) AS INTEGER)".format(expression)
+
+    def years_since(self, expression):
+        return "(CAST(strftime('%Y', 'now') AS INTEGER) - CAST(strftime('%Y', {0}) AS INTEGER) - " \
+               "(strftime('%m-%d', 'now') < strftime('%m-%d', {0})))".format(expression)
+
+    def as_date(self, expression):
+        # text compares as text, `1991-02-12` is before `1991-02-12 00:00:00`
+        return 'datetime(%s)' % expression
+
+    def paginate(self, offset, limit):
+        # an offset needs a limit, -1 means no limit
+        if offset and limit is None:
+            limit = -1
+
+        return Dialect.paginate(self, offset, limit)
+
+
+class MySQLDialect(Dialect):
+    max_parameters = 65535
+
+    def array_agg(self, expression):
+        return 'JSON_ARRAYAGG(%s)' % expression
+
+    def parse_array(self, value):
+        if value is None:
+            return None
+
+        return json.loads(value)
+
+    def group_concat(self, expression):
+        return 'GROUP_CONCAT(%s)' % expression
+
+    def bind(self, template):
+        # the driver only replaces the placeholders & leaves `%%` as is
+        return template.replace(PARAMETER, '%s')
+
+    def hour(self, expression):
+        return 'HOUR({0})'.format(expression)
+
+    def years_since(self, expression):
+        return 'TIMESTAMPDIFF(YEAR, {0}, UTC_TIMESTAMP())'.format(expression)
+
+    def as_date(self, expression):
+        # text compares as text, `1991-02-12` is before `1991-02-12 00:00:00`
+        return 'datetime(%s)' % expression
+
+    def paginate(self, offset, limit):
+        # an offset needs a limit, use the largest one
+        if offset and limit is None:
+            limit = 18446744073709551615
+
+        return Dialect.paginate(self, offset, limit)
+
+
+class PostgresDialect(Dialect):
+
+    def prepare(self, name, template):
+        """
+        :return: Statement that prepares `template` once on the server under `name`
+        """
+        parts = template.split(PARAMETER)
+
+        sql = parts[0]
+        for pos, part in enumerate(parts[1:]):
+            sql += '$%d%s' % (pos + 1, part)
+
+        return 'PREPARE %s AS %s' % (name, sql)
+
+    def execute_prepared(self, name, n_of_params):
+        """
+        :return: Statement that executes a prepared statement with `n_of_params` parameters
+        """
+        if not n_of_params:
+            return 'EXECUTE ' + name
+
+        return 'EXECUTE %s (%s)' % (name, ','.join(['%s'] * n_of_params))
@@ -1,14 +1,23 @@
-import random
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from collections import OrderedDict
+from functools import partial
+from operator import eq, ne, gt, ge, lt, le
+from anonymizer.datasource.dialects import PARAMETER, is_bucket
+from anonymizer.datasource.util import KeyedRandom, LRUCache, is_date_type, prefetch
+from anonymizer.datasource.managers.joins import JoinPlanner
+from anonymizer.datasource.managers.workers import WorkerPool
 
 __author__ = 'dipap'
 
 from pydoc import locate
 import hashlib
+import logging
 import re
 import csv
 import uuid
 
+logger = logging.getLogger(__name__)
+
 
 class PropertyManagerException(Exception):
     """
@@ -52,6 +61,13 @@ class UnknownOperatorException(Exception):
     pass
 
 
+class InvalidFilterException(ValueError):
+    """
+    Raised when a filter or a value it is checked against is not one of the options of a property
+    """
+    pass
+
+
 class InvalidSegmentOperation(Exception):
     """
     Raised when an offset/limit pair is invalid
@@ -121,6 +137,9 @@ class Property:
         self.is_pk = is_pk
         self._is_generated = self.source[0] in ['^']
 
+        # SQL expression of a generated property that is computed by the database
+        self.sql = None
+
         if options and options_auto:
             raise InvalidPropertyConfiguration('Both options and options_auto can\'t be enabled at the same time.')
 
@@ -134,6 +153,12 @@ class Property:
         else:
             self.name = name
 
+        # buckets (e.g the hour of a datetime) apply to each value & are not aggregates
+        self.bucket = None
+        if is_bucket(aggregate):
+            self.bucket = aggregate
+            self.aggregate = None
+
         self.label = label
         if not label:
             self.label = Property.humanize(self.name)
@@ -161,6 +186,15 @@ class Property:
             except AttributeError:
                 raise ProviderMethodNotFound('Provider method ' + fn_name + ' was not found')
 
+            # optional helper that rewrites conditions on the result into conditions on the argument
+            self.fn_inverse = getattr(cls, fn_name + '__inverse', None)
+
+            # optional helper that computes the result in the database
+            self.fn_sql = getattr(cls, fn_name + '__sql', None)
+
+            # optional helper that computes the results of many rows with a single call
+            self.fn_batch = getattr(cls, fn_name + '__batch', None)
+
             # load arguments
             pos = self.source.find('(')
             args_str = self.source[pos + 1:-1]
@@ -226,108 +260,172 @@ class Property:
     def is_generated(self):
         return self._is_generated
 
+    def is_selected(self):
+        """
+        :return: True if the value of this property is part of the query results
+        """
+        return not self.is_generated() or self.sql is not None
+
     def full(self):
-        result = self.table + '.' + self.column
+        if self.sql is not None:
+            return self.sql
+
+        result = self.value()
         if self.aggregate:
-            param_str = '@param'
-            if param_str not in self.aggregate:  # plain style
-                result = self.aggregate + '(%s)' % result
-            else:  # @param style
-                result = self.aggregate.replace(param_str, result)
+            result = self.connection.dialect.aggregate(self.aggregate, result)
 
-        if self.table != self.property_manager.user_pk.table and not self.aggregate:
-            result = 'array_agg(%s)' % result  # POSTGRES-only!! TODO investigate
+        if self.is_list():
+            result = self.connection.dialect.array_agg(result)
 
         return result
 
+    def value(self):
+        """
+        :return: SQL expression of the value of this property in a single row
+        """
+        result = self.table + '.' + self.column
+        if self.bucket:
+            result = self.connection.dialect.bucket(self.bucket, result)
+
+        return result
+
+    def is_list(self):
+        """
+        :return: True if the value of this property is the list of its values in the related rows of a user
+        """
+        return not self.is_generated() and not self.aggregate and \
+            self.table != self.property_manager.user_pk.table
+
     def matches(self, val, filter_exp):
         """
         Checks if the value `val` follows the filter expression
         E.g val = "5", filter_exp = ">10" returns false
         """
-        f_name = re.split('[=!<>]', filter_exp)[0]
-        operator = ''
-        exp = ''
+        return FilterPredicate(self, filter_exp).matches(val)
 
-        for char in filter_exp[len(f_name):]:
-            if not exp:
-                if char in ['=', '<', '>', '!']:
-                    operator += char
-                else:
-                    exp = char
-            else:
-                exp += char
 
-        # remove quotes
-        if type(val) in [str, unicode]:
-            if (val[0] == val[-1] == '"') or (val[0] == val[-1] == "'"):
-                val = val[1:-1]
+def parse_filter(filter_exp):
+    """
+    Splits a filter expression like `age>=30` into its property name, operator & expression
+    """
+    f_name = re.split('[=!<>]', filter_exp)[0]
 
-        exps = []
-        exps_ids = []
-        for e in exp.split('||'):
-            if (e[0] == e[-1] == '"') or (e[0] == e[-1] == "'"):
-                e = e[1:-1]
-            exps.append(e)
+    pos = len(f_name)
+    while pos < len(filter_exp) and filter_exp[pos] in ['=', '<', '>', '!']:
+        pos += 1
 
-        if self.tp.lower().startswith('scalar'):
-            ranges = self.tp.split('(')[1][:-1].split(',')
+    return f_name, filter_exp[len(f_name):pos], filter_exp[pos:]
 
-            for idx, r in enumerate(ranges):
-                r_arr = r.split('=')
-                if len(r_arr) == 1:
-                    r_arr.append(r_arr[0])
 
-                if val in r_arr:
-                    val = idx
-                for e in exps:
-                    if e in r_arr:
-                        exps_ids.append(idx)
+def split_expression(filter_exp):
+    """
+    Splits a filter expression like `age=37 OR gender="Male" and age<30` into the filters it combines
+    AND binds tighter than OR, connectives are case insensitive & quoted values are never split
+    :return: A list of alternatives, each a list of filters that must all match
+    """
+    alternatives = [[]]
+    pos = 0
+    for match in re.finditer(r'"[^"]*"|\'[^\']*\'|\s+(OR|AND)\s+', filter_exp, re.IGNORECASE):
+        if not match.group(1):
+            continue
+
+        alternatives[-1].append(filter_exp[pos:match.start()].strip())
+        if match.group(1).upper() == 'OR':
+            alternatives.append([])
+        pos = match.end()
+
+    alternatives[-1].append(filter_exp[pos:].strip())
+
+    return alternatives
+
+
+def unquote_operand(exp):
+    """
+    Unquotes one of the `||` separated values of a filter expression
+    Raises UnknownOperatorException for anything that is not a single value, e.g the unparsed `20 xor x=1`
+    """
+    operand = unquote(exp)
+    if operand == exp and re.search(r'[\s"\'=<>!()]', exp):
+        raise UnknownOperatorException(exp)
+
+    return operand
+
+
+def unquote(value):
+    if type(value) in [str, unicode] and value and ((value[0] == value[-1] == '"') or (value[0] == value[-1] == "'")):
+        return value[1:-1]
+
+    return value
+
+
+class FilterPredicate:
+    """
+    A filter expression on a single property compiled once
+    The operator, the coerced operands & the scalar option order are resolved at compile time
+    """
+    OPERATORS = {
+        '=': eq,
+        '!=': ne,
+        '>': gt,
+        '>=': ge,
+        '<': lt,
+        '<=': le,
+    }
+
+    def __init__(self, prop, filter_exp):
+        self.prop = prop
+        _, operator, exp = parse_filter(filter_exp)
+
+        try:
+            self.compare = FilterPredicate.OPERATORS[operator]
+        except KeyError:
+            raise UnknownOperatorException(operator)
+
+        operands = [unquote_operand(e) for e in exp.split('||')]
+
+        self.scalar_index = None
+        if prop.tp.lower().startswith('scalar'):
+            # map both the range & its name to the order of the option
+            self.scalar_index = {}
+            for idx, r in enumerate(prop.tp.split('(')[1][:-1].split(',')):
+                for label in r.split('='):
+                    self.scalar_index.setdefault(label, idx)
 
             # replace text-based with scalar order codes
-            exps = exps_ids
+            try:
+                self.operands = [self.scalar_index[e] for e in operands]
+            except KeyError as e:
+                raise InvalidFilterException('Invalid option: ' + unicode(e.args[0]))
+        else:
+            # read as numbers if possible
+            self.operands = [FilterPredicate.to_number(e) for e in operands]
+
+    @staticmethod
+    def to_number(e):
+        try:
+            return int(e)
+        except ValueError:
+            try:
+                return float(e)
+            except ValueError:
+                return e
+
+    def matches(self, val):
+        val = unquote(val)
 
+        if self.scalar_index is not None:
             if val is None:
                 return False
 
             if type(val) != int:
-                raise ValueError('Invalid option: ' + str(val))
-
-            for e in exps:
-                if type(e) != int:
-                    raise ValueError('Invalid option: ' + str(e))
-        else:
-            # read as numbers if possible
-            for i, e in enumerate(exps):
                 try:
-                    exps[i] = int(e)
-                except ValueError:
-                    try:
-                        exps[i] = float(e)
-                    except ValueError:
-                        pass
-
-        # apply the operator
-        results = []
-        for e in exps:
-            if operator == '=':
-                results.append(val == e)
-            elif operator == '!=':
-                results.append(val != e)
-            elif operator == '>':
-                results.append(val > e)
-            elif operator == '>=':
-                results.append(val >= e)
-            elif operator == '<':
-                results.append(val < e)
-            elif operator == '<=':
-                results.append(val <= e)
-            else:
-                raise UnknownOperatorException(operator)
+                    val = self.scalar_index[val]
+                except (KeyError, TypeError):
+                    raise InvalidFilterException('Invalid option: ' + unicode(val))
 
         # OR - joint results, return True if any comparison was True
-        for r in results:
-            if r:
+        for e in self.operands:
+            if self.compare(val, e):
                 return True
 
         return False
@@ -382,6 +480,18 @@ class PropertyManager:
         for prop in self.properties:
             self._property_hash[prop.name] = prop
 
+        # evaluation plans by requested properties, the default one also checks for circular dependencies
+        self._plans = LRUCache()
+        self.plan()
+
+        # let the database compute the generated properties it can
+        for prop in self.properties:
+            if prop.is_generated():
+                prop.sql = self.sql_expression(prop)
+
+        # the dependencies of properties computed by the database are no longer part of the plans
+        self._plans = LRUCache()
+
         # generate manager token
         if not token:
             token = uuid.uuid4()
@@ -389,8 +499,24 @@ class PropertyManager:
 
         # save foreign keys
         self.foreign_keys = self.configuration.data['sites'][0]['foreign_keys']
-        # query cache
-        self._query = None
+        # join planner & query cache
+        self.joins = JoinPlanner(self.user_pk.table, self.foreign_keys)
+        self._queries = LRUCache()
+
+        # filter query templates by the shape of their filters
+        self._statements = LRUCache()
+
+        # compiled filter cache
+        self._predicates = LRUCache()
+
+        # number of rows fetched & anonymized at a time
+        self.chunk_size = 500
+
+        # optional pool of processes that anonymize rows in parallel
+        self._workers = None
+
+        # number of chunks fetched in the background ahead of the one being anonymized, 0 to disable
+        self.prefetch = 0
 
     def get_primary_key(self):
         for prop in self.properties:
@@ -436,103 +562,439 @@ class PropertyManager:
         else:
             return []
 
-    def info(self, row, true_id=False):
-        idx = 0
-        result = {}
+    def direct_dependencies(self, prop):
+        """
+        :return: The properties that are arguments of a generated property
+        """
+        if not prop.is_generated():
+            return []
 
-        # use the token as a seed to get the same results for the same token/row pair
-        random.seed(self.token + row[idx])
+        return [self.get_property_by_name(arg[1:]) for arg in prop.fn_args if arg and arg[0] == '@']
+
+    def plan(self, properties=None):
+        """
+        Evaluation plan for a set of properties, built once for each set
+        :param properties: The requested properties, by default the exposed ones
+        :return: The primary key, the requested properties & the properties they depend on,
+                 each property after its dependencies
+                 Properties computed in SQL don't need their dependencies
+        """
+        key = None
+        if properties is not None:
+            key = tuple([prop.name for prop in properties])
+
+        try:
+            return self._plans[key]
+        except KeyError:
+            pass
+
+        if properties is None:
+            properties = [prop for prop in self.properties if prop.filter_by]
+
+        requested = set(properties)
+        plan = []
+        for prop in [self.user_pk] + [prop for prop in self.properties if prop in requested]:
+            self.add_to_plan(prop, plan, [])
+
+        self._plans[key] = plan
+
+        return plan
+
+    def add_to_plan(self, prop, plan, path):
+        """
+        Adds `prop` to `plan` after the properties it depends on
+        :param path: The properties that depend on `prop` & are being added
+        """
+        if prop in plan:
+            return
+
+        if prop in path:
+            raise InvalidPropertyConfiguration('Circular dependency between properties: ' +
+                                               ' -> '.join([p.name for p in path[path.index(prop):] + [prop]]))
+
+        # the database computes `prop` from the columns of its dependencies, they are not fetched on their own
+        if prop.sql is None:
+            for dependency in self.direct_dependencies(prop):
+                self.add_to_plan(dependency, plan, path + [prop])
+
+        plan.append(prop)
+
+    def sql_expression(self, prop):
+        """
+        :return: SQL expression that computes the value of `prop` for a user or None if it must be computed in python
+        """
+        if not prop.is_generated():
+            # only single values of the user can be used
+            if prop.aggregate or prop.cache_match or prop.table != self.user_pk.table:
+                return None
+
+            return prop.full()
+
+        if not prop.fn_sql:
+            return None
+
+        args = []
+        types = []
+        for fn_arg in prop.fn_args:
+            if fn_arg and fn_arg[0] == '@':
+                dependency = self.get_property_by_name(fn_arg[1:])
+                expression = self.sql_expression(dependency)
+                if expression is None:
+                    return None
+
+                args.append(expression)
+                types.append(dependency.tp)
+            else:
+                args.append(fn_arg)
+                types.append(None)
+
+        return prop.fn_sql(args, types, self.user_pk.connection)
+
+    def info(self, row, true_id=False, properties=None):
+        """
+        :param properties: The evaluation plan of the properties to compute, by default the one of the exposed ones
+                           `row` must contain the values of the non-generated ones, in the same order
+        """
+        return self.info_page([row], true_id=true_id, properties=properties)[0]
+
+    def info_page(self, rows, true_id=False, properties=None, known=None):
+        """
+        Anonymizes a page of rows one property at a time
+        Each generated property is computed for the whole page with a single provider call
+        :param properties: The evaluation plan of the properties to compute, by default the one of the exposed
+                           properties, see `plan`
+                           each row must contain the values of the non-generated ones, in the same order
+        :param known: {property name: {primary key: value}} for generated properties that are already computed
+        :return: A list with the anonymized user of each row
+        """
+        if properties is None:
+            properties = self.plan()
+
+        idx = 0
+        columns = {}
 
         # fill property values from database
-        for prop in self.properties:
-            if not prop.is_generated():
+        for prop in properties:
+            if prop.is_selected():
+                values = [row[idx] for row in rows]
+
                 if prop.is_pk:
                     # primary key
                     if true_id:
-                        result['__id__'] = row[idx]
-                        result[prop.name] = row[idx]
+                        columns['__id__'] = values
+                        columns[prop.name] = values
                     else:
-                        result[prop.name] = hashlib.sha1(str(self.token) + '###' + str(row[idx])).hexdigest()
+                        columns[prop.name] = [hashlib.sha1(str(self.token) + '###' + str(value)).hexdigest()
+                                              for value in values]
 
                 elif prop.cache_match:
                     # cached
-                    result[prop.name] = prop.cached_table.value_of(row[idx])
+                    if prop.is_list():
+                        values = [prop.connection.dialect.parse_array(value) for value in values]
+                    columns[prop.name] = [prop.cached_table.value_of(value) for value in values]
+                elif prop.is_list():
+                    columns[prop.name] = [prop.connection.dialect.parse_array(value) for value in values]
                 else:
                     # default property
-                    result[prop.name] = row[idx]
+                    columns[prop.name] = values
                 idx += 1
 
         # generate other properties
-        for prop in self.properties:
-            if prop.is_generated():
-                fn_args = prop.fn_args[:]
-
-                # search for 'special' arguments the must be replaced
-                # e.g property names like `@age`
-                for idx, fn_arg in enumerate(fn_args):
-                    if fn_arg:
-                        # replace property names with their values
-                        if type(fn_arg) == str and fn_arg[0] == '@':
-                            try:
-                                fn_args[idx] = result[fn_arg[1:]]
-                            except KeyError:
-                                raise PropertyNotFoundException('Property "' + fn_arg[1:] + '" was not found.')
-
-                # apply function and save the result
-                # must apply multiple times for list arguments
-                if len(fn_args) > 0 and \
-                        list(set([type(fn_argi) for fn_argi in fn_args])) == [list] and \
-                        len(list(set([len(fn_argi) for fn_argi in fn_args]))) == 1:
-                    result[prop.name] = []
-                    for idx in range(len(fn_args[0])):
-                        result[prop.name].append(prop.fn([fn_argi[idx] for fn_argi in fn_args]))
-                else:
-                    result[prop.name] = prop.fn(fn_args)
+        # the random generators are keyed by token, row & property to get the same results for the same user,
+        # no matter which other properties or rows are computed
+        pks = [row[0] for row in rows]
+        for prop in properties:
+            if not prop.is_selected():
+                if known and prop.name in known:
+                    columns[prop.name] = [known[prop.name][pk] for pk in pks]
+                    continue
+
+                rngs = [KeyedRandom(self.token, pk, prop.name) for pk in pks]
+                columns[prop.name] = self.generate(prop, columns, rngs)
 
         # removed non-exposed properties
-        for key in result.keys():
-            if key != '__id__' and not self.get_property_by_name(key).filter_by:
-                del result[key]
+        names = [name for name in columns.keys()
+                 if name == '__id__' or self.get_property_by_name(name).filter_by]
+
+        return [dict((name, columns[name][pos]) for name in names) for pos in range(len(rows))]
+
+    def start_workers(self, workers):
+        """
+        Anonymizes the rows of large pages across `workers` processes from now on
+        The processes are shared by all managers of this process, see managers.workers,
+        & each one loads this configuration once
+        """
+        self.stop_workers()
+
+        if workers > 1:
+            self._workers = WorkerPool(self.configuration, workers)
+
+    def stop_workers(self):
+        """
+        Anonymizes all pages in this process from now on, the shared worker processes keep serving other managers
+        """
+        self._workers = None
+
+    def fetch_size(self):
+        """
+        :return: The number of rows to fetch at a time, a chunk for each worker process
+        """
+        if self._workers:
+            return self.chunk_size * self._workers.workers
+
+        return self.chunk_size
+
+    def anonymize(self, rows, true_id=False, properties=None, known=None):
+        """
+        Same as `info_page`, but pages of more than `chunk_size` rows are split across the worker processes
+        """
+        workers = self._workers
+        if workers and len(rows) > self.chunk_size:
+            return workers.info_page(rows, self.token, true_id=true_id, properties=properties, known=known)
+
+        return self.info_page(rows, true_id=true_id, properties=properties, known=known)
+
+    def generate(self, prop, columns, rngs):
+        """
+        :param columns: The values of the already computed properties, by property name
+        :param rngs: The random generator of `prop` for each row
+        :return: The values of the generated property `prop` for each row
+        """
+        # search for 'special' arguments the must be replaced
+        # e.g property names like `@age`, constant arguments are repeated for each row
+        arg_columns = []
+        for fn_arg in prop.fn_args:
+            if fn_arg and type(fn_arg) == str and fn_arg[0] == '@':
+                try:
+                    arg_columns.append(columns[fn_arg[1:]])
+                except KeyError:
+                    raise PropertyNotFoundException('Property "' + fn_arg[1:] + '" was not found.')
+            else:
+                arg_columns.append([fn_arg] * len(rngs))
+
+        # must apply multiple times for list arguments
+        # their elements are passed to the provider as separate rows & grouped again afterwards
+        flat_columns = [[] for _ in arg_columns]
+        flat_rngs = []
+        segments = []
+        for pos, rng in enumerate(rngs):
+            fn_args = [arg_column[pos] for arg_column in arg_columns]
+
+            if len(fn_args) > 0 and \
+                    list(set([type(fn_argi) for fn_argi in fn_args])) == [list] and \
+                    len(list(set([len(fn_argi) for fn_argi in fn_args]))) == 1:
+                segments.append((len(flat_rngs), len(fn_args[0])))
+                for flat_column, fn_argi in zip(flat_columns, fn_args):
+                    flat_column.extend(fn_argi)
+                flat_rngs.extend([rng] * len(fn_args[0]))
+            else:
+                segments.append((len(flat_rngs), None))
+                for flat_column, fn_argi in zip(flat_columns, fn_args):
+                    flat_column.append(fn_argi)
+                flat_rngs.append(rng)
+
+        values = self.apply(prop, flat_columns, flat_rngs)
+
+        return [values[offset] if size is None else values[offset:offset + size] for offset, size in segments]
+
+    @staticmethod
+    def apply(prop, columns, rngs):
+        """
+        Calls the provider of `prop` on columns of arguments
+        Providers without a `__batch` helper are called once per row, with the generator of that row as `rng`
+        """
+        if prop.fn_batch:
+            return prop.fn_batch(columns, rngs)
+
+        result = []
+        for pos, rng in enumerate(rngs):
+            result.append(prop.fn([column[pos] for column in columns], rng=rng))
 
         return result
 
+    def predicate(self, filter_exp):
+        """
+        :return: The compiled predicate of a filter expression, cached by the expression
+        """
+        try:
+            return self._predicates[filter_exp]
+        except KeyError:
+            predicate = FilterPredicate(self.get_property_by_name(parse_filter(filter_exp)[0]), filter_exp)
+
+            self._predicates[filter_exp] = predicate
+
+            return predicate
+
+    def invert(self, prop, matches):
+        """
+        Follows invertible providers from a generated property down to the database column it is computed from
+        :param matches: Function that checks if a value of `prop` satisfies a condition
+        :return: (column property, value intervals, whether NULL is accepted) or None if the condition can't be
+                 expressed on a column
+        """
+        intervals = None
+        include_null = False
+
+        while prop.is_generated():
+            dependencies = [arg for arg in prop.fn_args if arg and arg[0] == '@']
+            if not prop.fn_inverse or len(dependencies) != 1:
+                return None
+
+            intervals = prop.fn_inverse(prop.fn_args[:], matches)
+            if intervals is None:
+                return None
+
+            # the value the provider produces for a missing argument decides about NULL
+            try:
+                include_null = matches(prop.fn([None if arg in dependencies else arg for arg in prop.fn_args]))
+            except Exception:
+                return None
+
+            prop = self.get_property_by_name(dependencies[0][1:])
+            matches = partial(PropertyManager.in_intervals, intervals, include_null)
+
+        # the condition must apply to a single value of each user
+        if prop.aggregate or prop.cache_match or prop.table != self.user_pk.table:
+            return None
+
+        # don't compare dates with numbers
+        is_date_column = is_date_type(prop.tp)
+        for interval in intervals:
+            for bound in [interval[0], interval[2]]:
+                if bound is not None and (type(bound) in [date, datetime]) != is_date_column:
+                    return None
+
+        return prop, intervals, include_null
+
+    @staticmethod
+    def in_intervals(intervals, include_null, value):
+        if value is None:
+            return include_null
+
+        for low, low_inclusive, high, high_inclusive in intervals:
+            if low is not None and (value < low or (value == low and not low_inclusive)):
+                continue
+            if high is not None and (value > high or (value == high and not high_inclusive)):
+                continue
+
+            return True
+
+        return False
+
+    def pushdown(self, filter_exp):
+        """
+        :return: A `where` clause condition equivalent to a filter on a generated property & its parameters, or None
+        """
+        predicate = self.predicate(filter_exp)
+
+        inverse = self.invert(predicate.prop, predicate.matches)
+        if not inverse:
+            return None
+
+        prop, intervals, include_null = inverse
+        column = prop.full()
+
+        # both sides of the comparison of a date column
+        value, parameter = column, PARAMETER
+        if is_date_type(prop.tp):
+            value, parameter = prop.connection.dialect.as_date(column), prop.connection.dialect.as_date(PARAMETER)
+
+        conditions = []
+        params = []
+        for low, low_inclusive, high, high_inclusive in intervals:
+            parts = []
+            if low is not None:
+                parts.append('%s %s %s' % (value, '>=' if low_inclusive else '>', parameter))
+                params.append(low)
+            if high is not None:
+                parts.append('%s %s %s' % (value, '<=' if high_inclusive else '<', parameter))
+                params.append(high)
+
+            conditions.append(' AND '.join(parts) or '%s IS NOT NULL' % column)
+
+        if include_null:
+            conditions.append('%s IS NULL' % column)
+
+        if not conditions:
+            return '1=0', []
+
+        return '(%s)' % ' OR '.join(['(%s)' % condition for condition in conditions]), params
+
+    @staticmethod
+    def condition(column, filter_exp):
+        """
+        Compiles a filter expression on an SQL column, e.g `age>=30` on `users.age` to `users.age>=?`
+        :return: (SQL condition with a `PARAMETER` in place of each value, the values)
+        """
+        _, operator, exp = parse_filter(filter_exp)
+        if operator not in FilterPredicate.OPERATORS:
+            raise UnknownOperatorException(operator)
+
+        params = []
+        for e in exp.split('||'):
+            operand = unquote_operand(e)
+            if operand == e:
+                # not in quotes, read as a number if possible
+                operand = FilterPredicate.to_number(e)
+
+            params.append(operand)
+
+        # multiple choices
+        if operator == '=' and len(params) > 1:
+            return '%s IN (%s)' % (column, ','.join([PARAMETER] * len(params))), params
+
+        condition = ' OR '.join([column + operator + PARAMETER] * len(params))
+        if len(params) > 1:
+            condition = '(%s)' % condition
+
+        return condition, params
+
     def filter_by_generated(self, results, generated_filters):
         for g_filter in generated_filters:
-            f_name = re.split('[=<>]', g_filter)[0]
-            prop = self.get_property_by_name(f_name)
+            predicate = self.predicate(g_filter)
+            prop = predicate.prop
 
             if prop.is_generated():
-                new_results = []
-                for result in results:
-                    if prop.matches(result[prop.name], g_filter):
-                        new_results.append(result)
-
-                results = new_results
+                results = [result for result in results if predicate.matches(result[prop.name])]
 
         return results
 
-    @staticmethod
-    def insert_key(keys, new_key):
+    def filter_properties(self, filters_generated):
+        """
+        :return: The evaluation plan of the properties needed to apply filters on generated properties, i.e the
+                 primary key, the filtered properties & the properties they depend on
         """
-        Inserts a foreign key at the correct position in the list, according to how they rely on each other
+        return self.plan([self.get_property_by_name(parse_filter(f)[0]) for f in filters_generated])
+
+    def match_generated(self, rows, true_id, properties, filters_generated):
+        """
+        Applies filters on generated properties computing only the properties they need
+        :param rows: Rows with the values of `properties`, see `filter_properties`
+        :return: (the rows that match `filters_generated`,
+                  {property name: {primary key: value}} of these rows for the generated properties that were computed)
         """
-        pos = len(keys)
-        for idx, key in enumerate(keys):
-            if new_key[0].lower() == key[1].split('.')[0].lower():
-                pos = idx
-                break
+        users = self.anonymize(rows, true_id, properties)
 
-        keys.insert(pos - 1, new_key)
+        # keep the values before lists are flattened, other properties are computed from them
+        names = [prop.name for prop in properties if not prop.is_selected() and prop.filter_by]
+        values = dict((name, [user[name] for user in users]) for name in names)
 
-    @staticmethod
-    def paginate(start=None, end=None):
-        # TODO only works for postres & mysql
-        result = ''
+        matching = set([id(user) for user in self.filter_by_generated(self.flatten(users), filters_generated)])
+        positions = [pos for pos, user in enumerate(users) if id(user) in matching]
+
+        # by primary key, the matching rows may be fetched again in another order
+        known = dict((name, dict((rows[pos][0], column[pos]) for pos in positions)) for name, column in values.items())
+
+        return [rows[pos] for pos in positions], known
+
+    def paginate(self, start=None, end=None):
+        offset = None
+        limit = None
         if start or end:
             if start:
                 if start < 0:
                     raise InvalidSegmentOperation('Negative indexes not supported')
-                result += ' OFFSET %d' % start
+                offset = start
             if end:
                 if end < 0:
                     raise InvalidSegmentOperation('Negative indexes not supported')
@@ -543,74 +1005,185 @@ class PropertyManager:
                     if limit < 0:
                         raise InvalidSegmentOperation('Invalid segment [%d:%d]' % (start, end))
                 else:
-                    start = 0
                     limit = end
 
-                result += ' LIMIT %d' % limit
+        return self.user_pk.connection.dialect.paginate(offset, limit)
 
-        return result
+    def branch_of(self, prop):
+        """
+        :return: The table through which the rows of `prop` are joined to the users table,
+                 the users table itself for aggregates of user columns & None for single user values
+        """
+        if prop.is_generated() or (prop.table.lower() == self.user_pk.table.lower() and not prop.aggregate):
+            return None
 
-    def join_clause(self):
+        return self.joins.branch(prop.table)
+
+    @staticmethod
+    def branch_alias(branch):
+        return 'branch_' + branch
+
+    def branch_column(self, prop):
         """
-        Returns the join clause of the query
+        :return: The column with the value of `prop` in the query of its branch
         """
-        # initially only the users table is ok because it's contained in the FROM clause
-        current_tables = [self.user_pk.table]
-        target_tables = list(set([prop.table for prop in self.properties
-                                  if not prop.is_generated()]))
-        current_keys = []
+        column = '%s.%s' % (self.branch_alias(self.branch_of(prop)), prop.name)
 
-        while target_tables:  # while there are tables that are not covered by any join
-            t = target_tables[0]
+        # users without rows in the branch are not counted, but they have a count of 0
+        if prop.aggregate and 'count' in prop.aggregate.lower():
+            column = 'COALESCE(%s, 0)' % column
 
-            if t in current_tables:
-                target_tables = target_tables[1:]
-                continue
+        return column
 
-            for key in self.foreign_keys:  # foreach possible join
-                if key[0].lower() == t.lower():
-                    current_tables.append(t)
-                    self.insert_key(current_keys, key)
-                    t2 = key[1].split('.')[0]
-                    if t2 not in current_tables:
-                        target_tables.append(t2)
-                    break
-
-            if t in current_tables:
-                target_tables = target_tables[1:]
-                continue
+    def branch_key(self, branch):
+        """
+        :return: (column of the branch, column of the users table) the branch is joined on
+        """
+        if branch.lower() == self.user_pk.table.lower():
+            return self.user_pk.full(), self.user_pk.full()
 
-            raise Exception('Could not autodetect joins')
+        join = self.joins.joins([branch])[0]
+        if join[1].split('.')[0].lower() == branch.lower():
+            return join[1], join[2]
 
-        # return the actual part of SQL
-        join_clause = ''
-        for key in current_keys:
-            join_left = key[1].split('@')[0]
-            join_right = key[2].split('@')[0]
+        return join[2], join[1]
+
+    def branch_joins(self, branch, tables):
+        """
+        :return: Join clause for `tables` within a branch, starting from the branch table
+        """
+        joins = [join for join in self.joins.joins(tables) if join[0].lower() != branch.lower()]
+        return ''.join(['LEFT OUTER JOIN {0} ON {1}={2} '.format(*join) for join in joins])
+
+    def branch_query(self, branch, properties, n_of_keys=None):
+        """
+        Aggregates the values of `properties` over the rows of a branch separately from other branches,
+        so rows of one table are not repeated for each row of another
+        :param n_of_keys: If set, only the rows of this many users are aggregated, given as parameters
+        :return: SQL subquery with one row per user, keyed by the primary key of the user
+        """
+        key_column, user_column = self.branch_key(branch)
+
+        # when the users table holds the key of the branch (many-to-one), its rows are joined back to the users,
+        # so that rows are grouped & filtered by the primary key of their user and not by the key of the branch
+        join_back = ''
+        if user_column.lower() != self.user_pk.full().lower():
+            join_back = 'INNER JOIN {0} ON {1}={2} '.format(self.user_pk.table, user_column, key_column)
+            key_column = self.user_pk.full()
+
+        select_clause = 'SELECT ' + ','.join([key_column + ' AS branch_key'] +
+                                             [prop.full() + ' AS ' + prop.name for prop in properties]) + ' '
+
+        from_clause = 'FROM {0} '.format(branch)
+        join_clause = join_back + self.branch_joins(branch, [prop.table for prop in properties])
+
+        where_clause = ''
+        if n_of_keys:
+            where_clause = 'WHERE %s IN (%s) ' % (key_column, ','.join([PARAMETER] * n_of_keys))
+
+        return select_clause + from_clause + join_clause + where_clause + 'GROUP BY ' + key_column
+
+    def semi_join(self, branch, filters):
+        """
+        :param filters: {table: filters} filters on the columns of tables in the branch
+        :return: Condition that is true for users with a row of the branch that matches all `filters`
+                 The database can stop at the first matching row & the aggregated values are not affected
+        """
+        key_column, user_column = self.branch_key(branch)
+
+        conditions = ['%s=%s' % (key_column, user_column)]
+        for table in sorted(filters.keys()):
+            conditions += filters[table]
+
+        return 'EXISTS (SELECT 1 FROM {0} {1}WHERE {2})'.format(branch, self.branch_joins(branch, filters.keys()),
+                                                                 ' AND '.join(conditions))
+
+    def branches(self, properties):
+        """
+        :return: {branch: properties} for the properties of other tables, see `branch_of`
+        """
+        branches = OrderedDict()
+        for prop in properties:
+            branch = self.branch_of(prop)
+            if branch:
+                branch_properties = branches.setdefault(branch, [])
+                if prop not in branch_properties:
+                    branch_properties.append(prop)
+
+        return branches
 
-            join_clause += 'LEFT OUTER JOIN {0} ON {1}={2} '.format(key[0], join_left, join_right)
+    def query(self, properties=None, aggregated=(), n_of_keys=None):
+        """
+        :param properties: The properties to select, by default the exposed ones & their dependencies
+        :param aggregated: Other aggregated properties that must be computed, e.g because they are filtered
+        :param n_of_keys: If set, the values of other tables are only aggregated for this many users,
+                          whose primary keys are given as parameters once for each branch
+        Values from other tables are aggregated in one subquery per branch of the join graph, only the branches of the
+        selected & filtered properties are joined
+        """
+        selected = [prop for prop in properties or self.plan() if prop.is_selected()]
 
-        return join_clause
+        key = (tuple([prop.name for prop in selected]), tuple([prop.name for prop in aggregated]), n_of_keys)
+        try:
+            return self._queries[key]
+        except KeyError:
+            pass
 
-    def query(self):
-        if self._query:
-            return self._query
+        # group the properties of other tables by branch
+        branches = self.branches(selected + list(aggregated))
 
-        select_clause = 'SELECT ' + ','.join([prop.full() + ' AS ' + prop.name
-                                             for prop in self.properties if not prop.is_generated()]) + ' '
+        columns = []
+        for prop in selected:
+            if self.branch_of(prop):
+                columns.append(self.branch_column(prop) + ' AS ' + prop.name)
+            else:
+                columns.append(prop.full() + ' AS ' + prop.name)
+
+        select_clause = 'SELECT ' + ','.join(columns) + ' '
 
         from_clause = 'FROM {0} '.format(self.user_pk.table)
 
         # create the join clause
-        join_clause = self.join_clause()
+        join_clause = ''
+        for branch, properties in branches.items():
+            join_clause += 'LEFT OUTER JOIN ({0}) AS {1} ON {2}={1}.branch_key '.format(
+                self.branch_query(branch, properties, n_of_keys), self.branch_alias(branch), self.user_pk.full())
 
-        self._query = select_clause + from_clause + join_clause
+        query = select_clause + from_clause + join_clause
+
+        self._queries[key] = query
+
+        return query
+
+    def hydrate(self, pks, properties=None):
+        """
+        Fetches the rows of the users with primary keys `pks`, in the order of their primary keys
+        Values of other tables are only aggregated for these users, so the cost depends on the number of keys &
+        not on the size of the tables
+        :param properties: The properties to select, by default the exposed ones & their dependencies
+        """
+        selected = [prop for prop in properties or self.plan() if prop.is_selected()]
+        n_of_lists = len(self.branches(selected)) + 1
 
-        # return the `all` query
-        return self._query
+        # the keys are repeated in each branch & the users table
+        connection = self.user_pk.connection
+        size = max(1, min(self.chunk_size, connection.dialect.max_parameters // n_of_lists))
 
-    def group_by(self):
-        return ' GROUP BY %s' % self.user_pk.full()
+        rows = []
+        for pos in range(0, len(pks), size):
+            keys = list(pks[pos:pos + size])
+
+            key = ('hydrate', tuple([prop.name for prop in selected]), len(keys))
+            try:
+                query = self._statements[key]
+            except KeyError:
+                query = self.query(selected, n_of_keys=len(keys)) + \
+                    'WHERE %s IN (%s)' % (self.user_pk.full(), ','.join([PARAMETER] * len(keys))) + self.order_by()
+                self._statements[key] = query
+
+            rows += connection.execute(query, keys * n_of_lists).fetchall()
+
+        return rows
 
     def order_by(self):
         return ' ORDER BY ' + self.user_pk.column
@@ -623,12 +1196,42 @@ class PropertyManager:
 
         return res
 
-    def all(self, true_id=False, start=None, end=None):
-        return self.filter(filters=[], true_id=true_id, start=start, end=end)
+    def all(self, true_id=False, start=None, end=None, fields=None):
+        return self.filter(filters=[], true_id=true_id, start=start, end=end, fields=fields)
+
+    def projection(self, fields):
+        """
+        :param fields: Names of the exposed properties to return, as a list or a comma separated string,
+                       None or empty for all of them
+        :return: The requested properties or None for all of them
+        """
+        if type(fields) in [str, unicode]:
+            fields = [field.strip() for field in fields.split(',')]
+
+        if not fields:
+            return None
+
+        properties = []
+        for name in [field for field in fields if field]:
+            try:
+                prop = self.get_property_by_name(name)
+            except KeyError:
+                raise PropertyNotFoundException('Property "%s" was not found.' % name)
+
+            if not prop.filter_by:
+                raise PropertyNotFoundException('Property "%s" was not found.' % name)
+
+            properties.append(prop)
 
-    def filter(self, filters, true_id=False, start=None, end=None):
-        t = datetime.now()
+        return properties
 
+    def prepare_filters(self, filters):
+        """
+        Splits the filters between those on generated properties, simple columns and aggregates
+        Filters that the database applies are compiled to (SQL condition, parameters) pairs
+        :return: (generated filters, conditions on users table columns, (property, condition) pairs for aggregates,
+                  {table: conditions} for conditions on the columns of other tables)
+        """
         if type(filters) in [str, unicode]:
             filters = filters.strip()
 
@@ -645,100 +1248,325 @@ class PropertyManager:
         filters_generated = []
         filters_concrete = []
         filters_aggregate = []
-        filter_properties = []
-        for f in filters:
-            # check if the filtered property actually exists & was exposed for filtering
-            p_name = re.split('[=<>]', f)[0]
+        filters_related = {}
+        for expression in filters:
+            alternatives = split_expression(expression)
+            if len(alternatives) > 1:
+                filters_concrete.append(self.combine(alternatives))
+                continue
+
+            # filters combined with AND only are the same as a list of filters
+            for f in alternatives[0]:
+                prop = self.filtered_property(f)
+                if prop.is_generated():
+                    # let the database apply it on the source column if the provider can be inverted
+                    condition = self.pushdown(f)
+                    if condition:
+                        filters_concrete.append(condition)
+                    else:
+                        filters_generated.append(f)
+                elif prop.aggregate is None:
+                    condition = self.condition(prop.value(), f)
+
+                    if prop.table.lower() == self.user_pk.table.lower():
+                        filters_concrete.append(condition)
+                    else:
+                        filters_related.setdefault(prop.table, []).append(condition)
+                else:
+                    # aggregates are filtered on the column of their branch
+                    filters_aggregate.append((prop, self.condition(self.branch_column(prop), f)))
+
+        return filters_generated, filters_concrete, filters_aggregate, filters_related
+
+    def filtered_property(self, filter_exp):
+        """
+        :return: The property a filter expression is on
+        Raises PropertyNotFoundException if it does not exist or was not exposed for filtering
+        """
+        p_name = parse_filter(filter_exp)[0]
+        try:
             prop = self.get_property_by_name(p_name)
-            if not prop:
-                raise PropertyNotFoundException('Property "%s" was not found.' % p_name)
-            if not prop.filter_by:
-                raise PropertyNotFoundException('Property "%s" was not found.' % prop.name)
+        except KeyError:
+            raise PropertyNotFoundException('Property "%s" was not found.' % p_name)
 
-            if prop.is_generated():
-                filters_generated.append(f)
-            elif prop.aggregate is None:
-                f = f.replace(prop.name, prop.column)
-                # multiple choices
-                if '=' in f and '||' in f:
-                    f1 = f.split('=')[0]
-                    f2 = ' in (%s)' % ','.join(f.split('=')[1].split('||'))
-                    f = f1 + f2
-
-                filters_concrete.append(f)
-                filter_properties.append(prop.name)
-            else:
-                filters_aggregate.append(f)
-                filter_properties.append(prop)
-                filter_properties.append(prop.name)
+        if not prop.filter_by:
+            raise PropertyNotFoundException('Property "%s" was not found.' % prop.name)
+
+        return prop
+
+    def combine(self, alternatives):
+        """
+        Compiles alternatives combined with OR, see `split_expression`, to a single condition on the users table
+        Each filter must be one the database can check on the row of a user on its own,
+        so filters on aggregates & on generated properties that can not be pushed down are refused
+        (expressions with AND only are a list of filters, see `prepare_filters`)
+        :return: (SQL condition, parameters)
+        """
+        conditions = []
+        params = []
+        for filters in alternatives:
+            parts = []
+            for f in filters:
+                prop = self.filtered_property(f)
+
+                condition = None
+                if prop.is_generated():
+                    condition = self.pushdown(f)
+                elif prop.aggregate is None:
+                    condition = self.condition(prop.value(), f)
+
+                    if prop.table.lower() != self.user_pk.table.lower():
+                        condition = (self.semi_join(self.joins.branch(prop.table), {prop.table: [condition[0]]}),
+                                     condition[1])
+
+                if not condition:
+                    raise PropertyManagerException('Filter "%s" can not be combined with OR.' % f)
+
+                parts.append(condition[0])
+                params += condition[1]
+
+            conditions.append(' AND '.join(parts))
 
-        query = self.query()
+        return '(%s)' % ' OR '.join(['(%s)' % condition for condition in conditions]), params
+
+    def filter_query(self, filters_concrete, filters_aggregate, after=None, properties=None, filters_related=None):
+        """
+        :param filters_concrete: Conditions on users table columns, see `prepare_filters`
+        :param filters_aggregate: (property, condition) pairs for aggregates
+        :param after: If set, only users with a primary key greater than `after` are included (keyset pagination)
+        :param properties: The properties to select, by default the exposed ones & their dependencies
+        :param filters_related: {table: conditions} conditions on the columns of other tables
+        :return: (SQL template of the query for the users matching the filters without offset/limit, its parameters)
+                 Filters that only differ in their values share the same template, so the database can reuse its plan
+        """
+        conditions = []
+        params = []
+        for condition, condition_params in filters_concrete:
+            conditions.append(condition)
+            params += condition_params
+
+        aggregated = []
+        for prop, (condition, condition_params) in filters_aggregate:
+            aggregated.append(prop)
+            conditions.append(condition)
+            params += condition_params
+
+        # filters on other tables are checked with one semi-join per branch
+        branches = OrderedDict()
+        for table in sorted((filters_related or {}).keys()):
+            branches.setdefault(self.joins.branch(table), {})[table] = filters_related[table]
+
+        for branch, filters in branches.items():
+            related = {}
+            for table in sorted(filters.keys()):
+                related[table] = [condition for condition, _ in filters[table]]
+                for _, condition_params in filters[table]:
+                    params += condition_params
+
+            conditions.append(self.semi_join(branch, related))
+
+        if after is not None:
+            conditions.append('%s > %s' % (self.user_pk.full(), PARAMETER))
+            params.append(after)
+
+        key = (tuple(conditions), tuple([prop.name for prop in aggregated]),
+               tuple([prop.name for prop in properties]) if properties is not None else None)
+        try:
+            return self._statements[key], params
+        except KeyError:
+            pass
+
+        query = self.query(properties, aggregated)
 
         # construct where clause
-        if filters_concrete:
-            where_clause = 'WHERE ' + ' AND '.join(filters_concrete)
+        if conditions:
+            where_clause = 'WHERE ' + ' AND '.join(conditions)
             query += where_clause
 
-        # construct group by clause
-        query += self.group_by()
+        query += self.order_by()
 
-        # aggregate filters must go after the group by in the `having` clause
-        if filters_aggregate:
-            having_clause = ' HAVING ' + ' AND '.join(filters_aggregate)
-            query += having_clause
+        self._statements[key] = query
 
-        # add offset & limit
-        query += self.order_by()
+        return query, params
 
-        # postgres fix
-        query = query.replace('"', '\'')
+    def iterate(self, filters, true_id=False, start=None, end=None, after=None, fields=None):
+        """
+        Lazy version of `filter`
+        Rows are fetched & anonymized in chunks of `chunk_size`, so each user is available as soon as its chunk is
+        processed & memory does not grow with the size of the result
+        Filters & fields are validated before the generator is returned
+        """
+        scan = self.scan(filters, true_id=true_id, start=start, end=end, after=after, fields=fields)
+        return (user for _, user in scan)
 
-        # execute query & get results
-        total_result = []
+    def scan(self, filters, true_id=False, start=None, end=None, after=None, fields=None):
+        """
+        :param fields: The properties to return, see `projection`
+                       Only these properties & the ones they depend on are fetched & computed, the primary key is
+                       always included
+        :return: A generator of (primary key, anonymized user) pairs for the users matching `filters`
+        """
+        filters_generated, filters_concrete, filters_aggregate, filters_related = self.prepare_filters(filters)
+
+        return self._scan(filters_generated, filters_concrete, filters_aggregate, filters_related,
+                          true_id, start, end, after, self.projection(fields))
+
+    def _scan(self, filters_generated, filters_concrete, filters_aggregate, filters_related,
+              true_id, start, end, after, requested):
+        # we might need more items from the database in case of filters on generated fields
+        limit = None
+        if end is not None and filters_generated:
+            limit = end - (start or 0)
+
+        properties = None
+        if requested is not None:
+            properties = self.plan(requested)
+            names = ['__id__', self.user_pk.name] + [prop.name for prop in requested]
+
+        # with filters on generated fields, only the properties they need are fetched & computed first,
+        # the other properties are computed for the matching users only
+        fetched = properties
+        if filters_generated:
+            fetched = self.filter_properties(filters_generated)
+
+        chunks = self.fetch(filters_concrete, filters_aggregate, filters_related, start, end, after, limit,
+                            fetched)
+        if self.prefetch:
+            # fetch the next chunks while the current one is anonymized,
+            # the connection the background thread checks out is given back to the pool when it is done
+            chunks = prefetch(chunks, self.prefetch, release=self.user_pk.connection.release)
+
+        n_of_results = 0
+        t_anonymize = t_filter = timedelta()
+        try:
+            for rows in chunks:
+                t = datetime.now()
+
+                # filter by generated fields
+                known = None
+                if filters_generated:
+                    rows, known = self.match_generated(rows, true_id, fetched, filters_generated)
+                    rows = self.hydrate([row[0] for row in rows], properties)
+                t2 = datetime.now(); t_filter += t2 - t; t = t2
+
+                result = self.flatten(self.anonymize(rows, true_id, properties, known=known))
+                if requested is not None:
+                    # leave out the dependencies of the requested properties
+                    result = [dict((name, user[name]) for name in names if name in user) for user in result]
+                t_anonymize += datetime.now() - t
+
+                for row, user in zip(rows, result):
+                    yield row[0], user
+
+                    n_of_results += 1
+                    if n_of_results == limit:
+                        return
+        finally:
+            chunks.close()
+
+            logger.debug('Anonymizing: %s, filtering: %s', t_anonymize, t_filter)
+
+    def fetch(self, filters_concrete, filters_aggregate, filters_related, start, end, after, limit,
+              properties=None):
+        """
+        :param limit: If set, the rows are read in segments of `limit` rows until no rows are left,
+                      otherwise only the [start:end] segment is read
+        :param properties: The properties to fetch, by default the exposed ones & their dependencies
+        :return: A generator of lists of rows
+        Pages are read in two phases, the primary keys of the matching users are found first & then only the rows of
+        these users are fetched
+        """
+        # unless an offset is requested each segment starts right after the last row that was read
+        keyset = not start
 
         while True:
-            q = query + self.paginate(start, end)
+            t = datetime.now()
+            if end is not None:
+                query, params = self.filter_query(filters_concrete, filters_aggregate, after=after,
+                                                  properties=[self.user_pk], filters_related=filters_related)
+                stream = self.user_pk.connection.fetch_chunks(query + self.paginate(start, end), self.fetch_size(),
+                                                              params)
+                chunks = (self.hydrate([row[0] for row in rows], properties) for rows in stream)
+            else:
+                query, params = self.filter_query(filters_concrete, filters_aggregate, after=after,
+                                                  properties=properties, filters_related=filters_related)
+                stream = chunks = self.user_pk.connection.fetch_chunks(query + self.paginate(start, end),
+                                                                       self.fetch_size(), params)
 
-            t2 = datetime.now(); print 'Create SQL: ' + str(t2 - t); t = t2
-            qs = self.user_pk.connection.execute(q).fetchall()
-            t2 = datetime.now(); print 'Running SQL: ' + str(t2 - t); t = t2
+            has_rows = False
+            try:
+                for rows in chunks:
+                    if not has_rows:
+                        logger.debug('Running SQL: %s', datetime.now() - t)
+                    has_rows = True
+                    last_pk = rows[-1][0]
+
+                    yield rows
+            finally:
+                # frees the server-side cursor, also when the caller stops early
+                stream.close()
+
+            if limit is None or not has_rows:
+                return
+
+            # fetch the next segment
+            if keyset:
+                after = last_pk
+            else:
+                start, end = end, end + limit
 
-            if not qs:
-                break
+    def filter(self, filters, true_id=False, start=None, end=None, fields=None):
+        return list(self.iterate(filters, true_id=true_id, start=start, end=end, fields=fields))
 
-            result = [self.info(row, true_id) for row in qs]
-            t2 = datetime.now(); print 'Anonymizing: ' + str(t2 - t); t = t2
+    def count(self, filters):
+        """
+        Counts the users matching `filters` without anonymizing them
+        Concrete & aggregate filters are counted by the database
+        With filters on generated properties, only the properties these filters need are computed for each row
+        """
+        filters_generated, filters_concrete, filters_aggregate, filters_related = self.prepare_filters(filters)
 
-            # flatten
-            result = self.flatten(result)
+        if not filters_generated:
+            query, params = self.filter_query(filters_concrete, filters_aggregate, properties=[self.user_pk],
+                                              filters_related=filters_related)
+            query = 'SELECT COUNT(*) FROM (%s) AS matching' % query
 
-            # filter by generated fields & return result
-            result = self.filter_by_generated(result, filters_generated)
-            t2 = datetime.now(); print 'Filtering: ' + str(t2 - t); t = t2
+            return self.user_pk.connection.execute(query, params).fetchone()[0]
 
-            total_result += result
+        # only the filtered properties & the properties they depend on are computed
+        properties = self.filter_properties(filters_generated)
 
-            # we might need more items for the database in case of filters on generated fields
-            if end is not None:
-                page_size = end - start
-                if len(total_result) > page_size:
-                    total_result = total_result[:end - start]
-                    break
-                else:
-                    start = end
-                    end = start + page_size
-            else:
-                break
+        query, params = self.filter_query(filters_concrete, filters_aggregate, properties=properties,
+                                          filters_related=filters_related)
 
-        return total_result
+        chunks = self.user_pk.connection.fetch_chunks(query, self.fetch_size(), params)
+        if self.prefetch:
+            chunks = prefetch(chunks, self.prefetch, release=self.user_pk.connection.release)
 
-    def get(self, pk):
-        where_clause = 'WHERE {0}={1}'.format(self.user_pk.full(), pk)
-        group_by_clause = ' GROUP BY {0}'.format(self.user_pk.full())
+        n_of_users = 0
+        for rows in chunks:
+            n_of_users += len(self.match_generated(rows, False, properties, filters_generated)[0])
+
+        return n_of_users
 
-        # construct full query
-        query = self.query() + where_clause + group_by_clause
+    def page(self, filters, after=None, limit=None, true_id=False, fields=None):
+        """
+        Keyset pagination: fetches at most `limit` users with a primary key greater than `after`
+        The cost of a page does not depend on how many pages came before it
+        :return: (users, primary key to continue after or None if there are no more users)
+        """
+        users = []
+        last_pk = None
 
-        # execute query & return results
-        return self.info(self.user_pk.connection.execute(query).fetchone())
+        for pk, user in self.scan(filters, true_id=true_id, end=limit, after=after, fields=fields):
+            users.append(user)
+            last_pk = pk
+
+        if limit is None or len(users) < limit:
+            last_pk = None
+
+        return users, last_pk
+
+    def get(self, pk):
+        return self.info(self.hydrate([pk])[0])
 
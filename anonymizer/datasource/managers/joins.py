@@ -0,0 +1,110 @@
+__author__ = 'dipap'
+
+from collections import deque
+
+
+class JoinNotFound(Exception):
+    """
+    A table can not be reached from the users table through the foreign keys of the configuration
+    """
+    pass
+
+
+class JoinPlanner:
+    """
+    Finds the joins that connect tables to the users table
+    The foreign keys form an undirected graph of tables, which is searched once (breadth first) from the users table,
+    so each table is reached through the shortest join path
+    """
+
+    def __init__(self, user_table, foreign_keys):
+        self.user_table = user_table
+
+        # join graph, each foreign key connects the joined table with the table of its other column
+        # (either column may belong to the joined table)
+        graph = {}
+        for key in foreign_keys:
+            table = key[0]
+            left = key[1].split('@')[0]
+            right = key[2].split('@')[0]
+
+            other_table = left.split('.')[0]
+            if other_table.lower() == table.lower():
+                other_table = right.split('.')[0]
+
+            graph.setdefault(table.lower(), []).append((other_table, (other_table, left, right)))
+            graph.setdefault(other_table.lower(), []).append((table, (table, left, right)))
+
+        # the join that reaches each table first & the order in which tables are reached
+        self._parents = {user_table.lower(): None}
+        self._order = {user_table.lower(): 0}
+
+        queue = deque([user_table])
+        while queue:
+            table = queue.popleft()
+
+            for next_table, join in graph.get(table.lower(), []):
+                if next_table.lower() in self._parents:
+                    continue
+
+                self._parents[next_table.lower()] = (table, join)
+                self._order[next_table.lower()] = len(self._order)
+                queue.append(next_table)
+
+        self._plans = {}
+
+    def joins(self, tables):
+        """
+        :return: The (table to join, left column, right column) joins needed for `tables`,
+                 each join only refers to tables joined before it
+        """
+        key = frozenset([table.lower() for table in tables])
+
+        try:
+            return self._plans[key]
+        except KeyError:
+            pass
+
+        needed = {}
+        for table in key:
+            # walk back towards the users table
+            while table not in needed:
+                if table not in self._parents:
+                    raise JoinNotFound('Could not autodetect joins for table "%s"' % table)
+
+                parent = self._parents[table]
+                if parent is None:
+                    break
+
+                needed[table] = parent[1]
+                table = parent[0].lower()
+
+        plan = [needed[table] for table in sorted(needed.keys(), key=lambda t: self._order[t])]
+        self._plans[key] = plan
+
+        return plan
+
+    def branch(self, table):
+        """
+        :return: The table joined directly to the users table on the join path of `table`
+        """
+        table = table.lower()
+        if table not in self._parents:
+            raise JoinNotFound('Could not autodetect joins for table "%s"' % table)
+
+        branch = self.user_table
+        while self._parents[table] is not None:
+            branch = self._parents[table][1][0]
+            table = self._parents[table][0].lower()
+
+        return branch
+
+    def join_clause(self, tables):
+        """
+        :return: The SQL join clause for `tables`
+        """
+        join_clause = ''
+        for table, left, right in self.joins(tables):
+            join_clause += 'LEFT OUTER JOIN {0} ON {1}={2} '.format(table, left, right)
+
+        return join_clause
@@ -0,0 +1,72 @@
+__author__ = 'dipap'
+
+import threading
+from collections import OrderedDict
+
+
+class UserManagerRegistry:
+    """
+    Process-wide cache of ready-to-use user managers
+    Entries are keyed by (configuration id, token) and remember the configuration version they were built from,
+    so a changed configuration is rebuilt on its next lookup
+    The least recently used entries are evicted when more than `max_size` managers are cached
+    Managers that are dropped from the cache are closed, if they have a `close` method
+    """
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, config_id, version, token, factory):
+        """
+        :param config_id: The id of the configuration the manager is built from
+        :param version: The current version of that configuration
+        :param token: The token of the manager
+        :param factory: A callable that creates a new manager in case there is no valid cached one
+        :return: The cached manager if its version is up to date, otherwise a newly created one
+        """
+        key = (config_id, token)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[0] == version:
+                    # re-insert to mark as most recently used
+                    self._entries[key] = entry
+                    return entry[1]
+
+                self._discard(entry[1])
+
+        # build outside the lock -- creating a manager opens database connections
+        manager = factory()
+
+        with self._lock:
+            self._entries[key] = (version, manager)
+            while len(self._entries) > self.max_size:
+                self._discard(self._entries.popitem(last=False)[1][1])
+
+        return manager
+
+    def invalidate(self, config_id):
+        """
+        Removes all cached managers of a configuration
+        """
+        with self._lock:
+            for key in [key for key in self._entries.keys() if key[0] == config_id]:
+                self._discard(self._entries.pop(key)[1])
+
+    def clear(self):
+        with self._lock:
+            for _, manager in self._entries.values():
+                self._discard(manager)
+            self._entries.clear()
+
+    @staticmethod
+    def _discard(manager):
+        close = getattr(manager, 'close', None)
+        if close:
+            close()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,12 +1,30 @@
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
 from django.test import TestCase
 from anonymizer.datasource.connections import ConnectionManager
-from anonymizer.datasource.managers.data import PropertyNotFoundException, PropertyManager
+from anonymizer.datasource.dialects import PARAMETER
+from anonymizer.datasource.managers.data import PropertyNotFoundException, PropertyManager, \
+    InvalidPropertyConfiguration, PropertyManagerException, UnknownOperatorException
+from anonymizer.datasource.managers.joins import JoinPlanner, JoinNotFound
+from anonymizer.datasource.managers.registry import UserManagerRegistry
 from anonymizer.datasource.managers.users import UserManager, UserManagerException
+from anonymizer.datasource.managers import workers
+from anonymizer.datasource.managers.workers import shared_pool, stop_pool
 from anonymizer.datasource.util import Configuration
 
 __author__ = 'dipap'
 
 
+def is_loaded(config_str):
+    """
+    Runs in the worker processes, checks if they keep the property manager of a configuration
+    """
+    return config_str in workers._property_managers
+
+
 class PropertyManagerTests(TestCase):
 
     def setUp(self):
@@ -23,6 +41,67 @@ class PropertyManagerTests(TestCase):
     def test_n_of_walking_users(self):
         self.assertEqual(len(self.pm.filter('activity="Walking"')), 4)
 
+    def test_iterate(self):
+        self.pm.chunk_size = 5
+        self.assertEqual(list(self.pm.iterate([], true_id=True)), self.pm.all(true_id=True))
+
+    def test_compiled_predicates(self):
+        predicate = self.pm.predicate('age=..17||35..54')
+
+        self.assertIs(self.pm.predicate('age=..17||35..54'), predicate)
+        self.assertEqual(predicate.operands, [0, 3])
+        self.assertTrue(predicate.matches('35..54'))
+        self.assertFalse(predicate.matches('18..24'))
+        self.assertFalse(predicate.matches(None))
+
+    def test_keyset_pages(self):
+        users, after = self.pm.page([], limit=10, true_id=True)
+        next_users, last = self.pm.page([], after=after, limit=10, true_id=True)
+
+        self.assertEqual(users + next_users, self.pm.all(true_id=True))
+        self.assertIsNone(last)
+
+    def test_branch_subqueries(self):
+        query = self.pm.query()
+
+        # activities & their dates are aggregated per user in a subquery on the performs table
+        self.assertIn('LEFT OUTER JOIN (SELECT activitytracker_performs.user_id AS branch_key', query)
+        self.assertIn('branch_activitytracker_performs.activity AS activity', query)
+        self.assertNotIn('GROUP BY activitytracker_user.id', query)
+
+    def test_semi_join_filters(self):
+        filters_related = self.pm.prepare_filters('activity="Walking"')[3]
+        query, params = self.pm.filter_query([], [], properties=[self.pm.user_pk], filters_related=filters_related)
+
+        # filters on other tables don't need the aggregated values of their branch
+        self.assertEqual(query, 'SELECT activitytracker_user.id AS id FROM activitytracker_user '
+                                'WHERE EXISTS (SELECT 1 FROM activitytracker_performs '
+                                'LEFT OUTER JOIN activitytracker_activity '
+                                'ON activitytracker_performs.activity_key=activitytracker_activity.activity_id '
+                                'WHERE activitytracker_performs.user_id=activitytracker_user.id '
+                                'AND activitytracker_activity.activity_name=' + PARAMETER + ') ORDER BY id')
+        self.assertEqual(params, ['Walking'])
+
+    def test_filter_parameters(self):
+        _, filters_concrete, _, filters_related = self.pm.prepare_filters(['age=35..54', 'activity="Walking"'])
+        query, params = self.pm.filter_query(filters_concrete, [], filters_related=filters_related)
+
+        # the values of the filters are parameters, so filters of the same shape share the query
+        _, filters_concrete, _, filters_related = self.pm.prepare_filters(['age=18..24', 'activity="Running"'])
+        self.assertIs(self.pm.filter_query(filters_concrete, [], filters_related=filters_related)[0], query)
+        self.assertNotIn('Walking', query)
+
+        # values that contain quotes need no escaping
+        self.assertEqual(self.pm.count('activity="O\'Walking"'), 0)
+
+    def test_prefetch(self):
+        users = self.pm.all(true_id=True)
+
+        self.pm.chunk_size = 5
+        self.pm.prefetch = 2
+        self.assertEqual(self.pm.all(true_id=True), users)
+        self.assertEqual(self.pm.filter('age=..17', end=3), self.pm.filter('age=..17')[:3])
+
 
 class UserManagerTests(TestCase):
 
@@ -53,11 +132,328 @@ class UserManagerTests(TestCase):
         res = self.um.filter('age=37 OR gender="Male"')
         self.assertEqual(len(res), 51)
 
+    def test_combined_filter(self):
+        res = self.um.filter('age=37 AND gender="Male" OR gender="Female" AND age<30')
+        self.assertEqual(len(res), 7)
+
+        # quoted values are not split
+        self.assertEqual(len(self.um.filter('age=37 OR gender="Male OR Female"')), 2)
+
+        # connectives are case insensitive
+        self.assertEqual(len(self.um.filter('age=37 or gender="Male"')), 51)
+        self.assertEqual(len(self.um.filter('age<35 and gender="Male"')), 18)
+        self.assertEqual(len(self.um.filter('age=37 and gender="Male" Or gender="Female" AND age<30')), 7)
+
+        # anything that is not a value is refused instead of being compared as text
+        with self.assertRaises(UnknownOperatorException):
+            self.um.filter('age<20 xor gender="Male"')
+
+        # aggregates can't be alternatives
+        with self.assertRaises(PropertyManagerException):
+            self.um.filter('age=37 OR run_duration_avg<13')
+
+        # but with AND only they are a list of filters
+        self.assertEqual(self.um.filter('age=37 AND run_duration_avg<13'),
+                         self.um.filter(['age=37', 'run_duration_avg<13']))
+        self.assertEqual(len(self.um.filter('age=37 and run_duration_avg<13')), 1)
+        self.assertEqual(self.um.filter('last_name="T." AND age<30', true_id=True),
+                         self.um.filter(['last_name="T."', 'age<30'], true_id=True))
+
+    def test_count(self):
+        self.assertEqual(self.um.count(), 100)
+        self.assertEqual(self.um.count('gender="Male"'), 50)
+        self.assertEqual(self.um.count('age=37'), 2)
+
+    def test_count_generated(self):
+        um = UserManager('test-data/config/sqlite3_config.json', token=7)
+        self.assertEqual(um.count('last_name="T."'), len(um.filter('last_name="T."')))
+
+    def test_parallel_anonymization(self):
+        users = UserManager('test-data/config/sqlite3_config.json', token=7).all()
+
+        um = UserManager('test-data/config/sqlite3_config.json', token=7, workers=2)
+        um.pm.chunk_size = 5
+        try:
+            self.assertEqual(um.all(), users)
+            self.assertEqual(um.count('last_name="T."'), len([u for u in users if u['last_name'] == 'T.']))
+        finally:
+            um.close()
+
+    def test_shared_worker_processes(self):
+        users = UserManager('test-data/config/sqlite3_config.json', token=7).all()
+        processes = len(multiprocessing.active_children())
+
+        managers = [UserManager('test-data/config/sqlite3_config.json', token=7, workers=2) for _ in range(2)]
+        try:
+            for um in managers:
+                um.pm.chunk_size = 5
+                self.assertEqual(um.all(), users)
+
+            # all managers use the same worker processes
+            self.assertLessEqual(len(multiprocessing.active_children()), processes + 2)
+        finally:
+            for um in managers:
+                um.close()
+
+        stop_pool()
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_worker_warm_up(self):
+        um = UserManager('test-data/config/sqlite3_config.json', token=7, workers=2)
+        other = UserManager('test-data/config/sqlite3_config.json', token=7, workers=3)
+        try:
+            config_str = json.dumps(um.pm.configuration.data)
+
+            # each worker process loads the configuration before the first page
+            self.assertEqual(shared_pool(2).map(is_loaded, [config_str] * 10), [True] * 10)
+
+            # each number of workers gets its own processes
+            self.assertEqual(shared_pool(3).map(is_loaded, [config_str] * 10), [True] * 10)
+            self.assertEqual(len(multiprocessing.active_children()), 5)
+        finally:
+            um.close()
+            other.close()
+            stop_pool()
+
+    def test_worker_configurations_lru(self):
+        data = json.loads(open('test-data/config/sqlite3_config.json').read())
+        configs = []
+        for name in ['a', 'b', 'c']:
+            data['sites'][0]['name'] = name
+            configs.append(json.dumps(data))
+
+        cached = workers.CACHED_CONFIGURATIONS
+        workers.CACHED_CONFIGURATIONS = 2
+        try:
+            pm = workers._property_manager(configs[0])
+            workers._property_manager(configs[1])
+
+            # the least recently used configuration is dropped, not all of them
+            self.assertIs(workers._property_manager(configs[0]), pm)
+            workers._property_manager(configs[2])
+            self.assertEqual(set(workers._property_managers.keys()), set([configs[0], configs[2]]))
+        finally:
+            workers.CACHED_CONFIGURATIONS = cached
+            workers._property_managers.clear()
+
     def test_aggregate_filter(self):
         res = self.um.filter(['age=37', 'run_duration_avg<13'])
         self.assertEqual(len(res), 1)
 
+    def test_two_phase_pages(self):
+        users = self.um.filter('gender="Male"', true_id=True)
+        self.assertEqual(self.um.filter('gender="Male"', true_id=True, start=5, end=15), users[5:15])
+        self.assertEqual(self.um.filter('run_duration_avg<13', true_id=True, end=3),
+                         self.um.filter('run_duration_avg<13', true_id=True)[:3])
+
+        # the runs of a page are only aggregated for its users
+        self.assertIn('WHERE Running.user IN (', self.um.pm.query(n_of_keys=10))
+        self.assertEqual([row[0] for row in self.um.pm.hydrate([7, 3, 5])], [3, 5, 7])
+
+    def test_generated_filter(self):
+        users = self.um.all()
+        first_name = users[0]['first_name']
+
+        # the other properties are computed for the matching users only, with the same values
+        self.assertEqual(self.um.filter('first_name="%s"' % first_name),
+                         [user for user in users if user['first_name'] == first_name])
+
+        pm = self.um.pm
+        properties = pm.filter_properties(['first_name="%s"' % first_name])
+        self.assertEqual([prop.name for prop in properties], ['id', 'gender', 'first_name'])
+
+        rows, known = pm.match_generated([[1, 'Male'], [2, 'Female']], False, properties, ['first_name="Nobody"'])
+        self.assertEqual((rows, known), ([], {'first_name': {}}))
+
+        # known values follow their user, whatever the order of the rows
+        users = pm.info_page([[2, 'Female'], [1, 'Male']], true_id=True, properties=properties,
+                             known={'first_name': {1: 'Nick', 2: 'Maria'}})
+        self.assertEqual([(user['id'], user['first_name']) for user in users], [(2, 'Maria'), (1, 'Nick')])
+
+    def test_fields(self):
+        users = self.um.filter('gender="Male"', true_id=True)
+
+        # only the requested properties, their dependencies & the primary key are fetched & computed
+        self.assertEqual(self.um.filter('gender="Male"', true_id=True, fields='first_name'),
+                         [dict((name, user[name]) for name in ['__id__', 'id', 'first_name']) for user in users])
+        self.assertNotIn('Running', self.um.pm.query(self.um.pm.plan(self.um.pm.projection(['first_name']))))
+
+        with self.assertRaises(PropertyNotFoundException):
+            self.um.all(fields='first_name,password')
+
+    def test_evaluation_plan(self):
+        data = json.loads(open('test-data/config/sqlite3_config.json').read())
+        properties = data['sites'][0]['properties']
+
+        # declared before the property it depends on, which is not exposed
+        properties.insert(0, {'name': 'nickname', 'type': 'string', 'source': '^Person.first_name(@alias,Male,Female)'})
+        properties.append({'name': 'alias', 'type': 'string', 'source': '^Person.first_name(@gender,Male,Female)',
+                           'expose': False})
+        properties[-2]['expose'] = False
+
+        um = UserManager(from_str=json.dumps(data))
+        self.assertEqual([prop.name for prop in um.pm.plan()],
+                         ['id', 'gender', 'alias', 'nickname', 'age', 'first_name', 'last_name'])
+        self.assertEqual([prop.name for prop in um.pm.plan([um.pm.get_property_by_name('first_name')])],
+                         ['id', 'gender', 'first_name'])
+
+        # properties computed by the database don't fetch their dependencies
+        properties.append({'name': 'age_group', 'type': '###', 'source': '^Ranges.from_int_value(..17|18..,@age)'})
+        um = UserManager(from_str=json.dumps(data))
+        self.assertIsNotNone(um.pm.get_property_by_name('age_group').sql)
+        self.assertEqual([prop.name for prop in um.pm.plan([um.pm.get_property_by_name('age_group')])],
+                         ['id', 'age_group'])
+        properties.pop()
+
+        # circular dependencies are found when the configuration is loaded
+        properties[-1]['source'] = '^Person.first_name(@nickname,Male,Female)'
+        with self.assertRaises(InvalidPropertyConfiguration):
+            UserManager(from_str=json.dumps(data))
+
     def test_non_exposed_filter(self):
         um = UserManager('test-data/config/sqlite3_config_hide-age.json')
         with self.assertRaises(PropertyNotFoundException):
             um.filter('age=37')
+
+    def test_unknown_filter(self):
+        with self.assertRaises(PropertyNotFoundException):
+            self.um.filter('wrong>35')
+
+        with self.assertRaises(PropertyNotFoundException):
+            self.um.filter('age=37 OR wrong=1')
+
+
+class ManyToOneTests(TestCase):
+
+    def setUp(self):
+        # users reference their team, team ids don't overlap with user ids
+        fd, self.db = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+
+        conn = sqlite3.connect(self.db)
+        conn.executescript('''
+            CREATE TABLE Teams (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TABLE Users (id INTEGER PRIMARY KEY, age INTEGER, team_id INTEGER REFERENCES Teams(id));
+            INSERT INTO Teams VALUES (10, 'Blue'), (20, 'Red');
+            INSERT INTO Users VALUES (1, 30, 20), (2, 40, 10), (3, 50, 20), (4, 60, NULL);
+        ''')
+        conn.commit()
+        conn.close()
+
+        self.um = UserManager(from_str=json.dumps({'sites': [{
+            'name': 'teams',
+            'connections': [{'id': 'db', 'engine': 'django.db.backends.sqlite3', 'name': self.db}],
+            'user_pk': 'Users.id@db',
+            'properties': [
+                {'name': 'age', 'type': 'int', 'source': 'Users.age@db'},
+                {'name': 'team', 'type': 'string', 'aggregate': 'max', 'source': 'Teams.name@db'},
+            ],
+            'foreign_keys': [['Teams', 'Users.team_id@db', 'Teams.id']],
+        }]}), token=7)
+
+    def tearDown(self):
+        self.um.close()
+        os.remove(self.db)
+
+    def test_values_of_referenced_rows(self):
+        users = [(30, 'Red'), (40, 'Blue'), (50, 'Red'), (60, None)]
+        self.assertEqual([(u['age'], u['team']) for u in self.um.all()], users)
+
+        # pages are fetched for the primary keys of their users
+        self.assertEqual([(u['age'], u['team']) for u in self.um.all(start=1, end=3)], users[1:3])
+        self.assertEqual(self.um.get(3)['team'], 'Red')
+
+    def test_filters_on_referenced_rows(self):
+        self.assertEqual([u['age'] for u in self.um.filter('team="Red"')], [30, 50])
+        self.assertEqual(self.um.count('team="Red"'), 2)
+
+
+class UserManagerRegistryTests(TestCase):
+
+    def setUp(self):
+        self.registry = UserManagerRegistry(max_size=2)
+
+    def test_cached_manager_is_reused(self):
+        m1 = self.registry.get(1, 'v1', 1, object)
+        self.assertIs(self.registry.get(1, 'v1', 1, object), m1)
+
+    def test_new_version_rebuilds_manager(self):
+        m1 = self.registry.get(1, 'v1', 1, object)
+        self.assertIsNot(self.registry.get(1, 'v2', 1, object), m1)
+        self.assertEqual(len(self.registry), 1)
+
+    def test_invalidate(self):
+        m1 = self.registry.get(1, 'v1', 1, object)
+        self.registry.get(2, 'v1', 2, object)
+        self.registry.invalidate(1)
+
+        self.assertEqual(len(self.registry), 1)
+        self.assertIsNot(self.registry.get(1, 'v1', 1, object), m1)
+
+    def test_lru_eviction(self):
+        m1 = self.registry.get(1, 'v1', 1, object)
+        m2 = self.registry.get(2, 'v1', 2, object)
+
+        # use the first manager so that the second one is the least recently used
+        self.registry.get(1, 'v1', 1, object)
+        self.registry.get(3, 'v1', 3, object)
+
+        self.assertEqual(len(self.registry), 2)
+        self.assertIs(self.registry.get(1, 'v1', 1, object), m1)
+        self.assertIsNot(self.registry.get(2, 'v1', 2, object), m2)
+
+    def test_discarded_managers_are_closed(self):
+        closed = []
+
+        class Manager:
+            def close(self):
+                closed.append(self)
+
+        m1 = self.registry.get(1, 'v1', 1, Manager)
+        m2 = self.registry.get(2, 'v1', 2, Manager)
+        self.registry.get(1, 'v2', 1, Manager)
+        self.registry.invalidate(2)
+
+        self.assertEqual(closed, [m1, m2])
+
+
+class JoinPlannerTests(TestCase):
+
+    def setUp(self):
+        self.planner = JoinPlanner('user', [
+            ['performs', 'user.id@db', 'performs.user_id'],
+            ['activity', 'performs.activity_id@db', 'activity.id'],
+            ['friend', 'user.id@db', 'friend.user_id'],
+            ['group', 'membership.group_id@db', 'group.id'],
+            ['membership', 'user.id@db', 'membership.user_id'],
+        ])
+
+    def test_only_needed_joins(self):
+        self.assertEqual(self.planner.joins(['user']), [])
+        self.assertEqual(self.planner.joins(['friend']), [('friend', 'user.id', 'friend.user_id')])
+
+    def test_join_path_order(self):
+        # joins only refer to tables joined before them, no matter the order of the foreign keys
+        self.assertEqual(self.planner.joins(['group', 'activity']), [
+            ('performs', 'user.id', 'performs.user_id'),
+            ('membership', 'user.id', 'membership.user_id'),
+            ('activity', 'performs.activity_id', 'activity.id'),
+            ('group', 'membership.group_id', 'group.id'),
+        ])
+
+    def test_join_clause(self):
+        self.assertEqual(self.planner.join_clause(['friend']),
+                         'LEFT OUTER JOIN friend ON user.id=friend.user_id ')
+
+    def test_key_from_joined_table(self):
+        planner = JoinPlanner('Users', [['Running', 'Running.user@db', 'Users.id']])
+        self.assertEqual(planner.join_clause(['Running']), 'LEFT OUTER JOIN Running ON Running.user=Users.id ')
+
+    def test_branch(self):
+        self.assertEqual(self.planner.branch('group'), 'membership')
+        self.assertEqual(self.planner.branch('performs'), 'performs')
+        self.assertEqual(self.planner.branch('user'), 'user')
+
+    def test_unreachable_table(self):
+        with self.assertRaises(JoinNotFound):
+            self.planner.joins(['unknown'])
@@ -2,6 +2,7 @@ __author__ = 'dipap'
 
 from anonymizer.datasource.util import Configuration
 from anonymizer.datasource.connections import ConnectionManager
+from anonymizer.datasource.dialects import PARAMETER
 from data import PropertyManager
 
 
@@ -17,21 +18,36 @@ class UserManager:
     The User manager is responsible for fetching and filtering user information
     """
 
-    def __init__(self, config_file='', from_str='', token=None):
+    def __init__(self, config_file='', from_str='', token=None, workers=0, prefetch=0):
+        """
+        :param workers: Number of processes that anonymize large pages in parallel, disabled by default
+        :param prefetch: Number of chunks fetched in the background while a chunk is anonymized, disabled by default
+        """
         if config_file:
             from_str = open(config_file).read()
 
         self.config = Configuration(from_str=from_str)
         self.cm = ConnectionManager(self.config.get_connection_info())
         self.pm = PropertyManager(self.cm, self.config, token=token)
+        self.pm.prefetch = prefetch
+
+        if workers:
+            self.pm.start_workers(workers)
+
+    def close(self):
+        """
+        Stops sending pages of this manager to the worker processes, if any
+        """
+        self.pm.stop_workers()
 
     def reset_token(self, new_token):
         self.pm.token = new_token
 
     def get(self, pk):
         # Ensures the user exists
-        query = "SELECT {0} AS pk FROM {1} WHERE {0}={2}".format(self.pm.user_pk.full(), self.pm.user_pk.table, pk)
-        result = self.pm.user_pk.connection.execute(query).fetchall()
+        query = "SELECT {0} AS pk FROM {1} WHERE {0}={2}".format(self.pm.user_pk.full(), self.pm.user_pk.table,
+                                                                  PARAMETER)
+        result = self.pm.user_pk.connection.execute(query, [pk]).fetchall()
 
         # check uniqueness
         if len(result) == 0:
@@ -41,19 +57,20 @@ class UserManager:
 
         return self.pm.get(pk)
 
-    def filter(self, filters, true_id=False, start=None, end=None):
-        return self.pm.filter(filters, true_id, start=start, end=end)
+    def filter(self, filters, true_id=False, start=None, end=None, fields=None):
+        return self.pm.filter(filters, true_id, start=start, end=end, fields=fields)
 
-    def all(self, start=None, end=None):
-        return self.pm.all(start=start, end=end)
+    def iterate(self, filters, true_id=False, start=None, end=None, after=None, fields=None):
+        return self.pm.iterate(filters, true_id, start=start, end=end, after=after, fields=fields)
 
-    def count(self, filters=None):
-        if filters:
-            qs = self.pm.filter(filters)
-        else:
-            qs = self.pm.all()
+    def page(self, filters, after=None, limit=None, true_id=False, fields=None):
+        return self.pm.page(filters, after=after, limit=limit, true_id=true_id, fields=fields)
+
+    def all(self, start=None, end=None, fields=None):
+        return self.pm.all(start=start, end=end, fields=fields)
 
-        return len(qs)
+    def count(self, filters=None):
+        return self.pm.count(filters or [])
 
     def list_filters(self, ignore_options=False):
         return self.pm.list_filters(ignore_options)
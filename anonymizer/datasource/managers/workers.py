@@ -0,0 +1,197 @@
+__author__ = 'dipap'
+
+import atexit
+import json
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+
+# number of configurations a worker process keeps the property manager of
+CACHED_CONFIGURATIONS = 16
+
+# seconds a worker waits for the other workers to pick up their part of a warm up
+WARM_UP_TIMEOUT = 60
+
+# the property managers of a worker process, by configuration, least recently used first
+_property_managers = OrderedDict()
+
+# set in each worker process by `_start_worker`, see `_warm_up`
+_warm_ups = None
+
+# the worker processes shared by all managers of this process, by number of processes
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def _property_manager(config_str):
+    """
+    Runs in the worker processes
+    Builds the property manager of a configuration once & keeps it for the next pages,
+    so providers, cached tables, SQL expressions & evaluation plans are only loaded once
+    """
+    try:
+        pm = _property_managers.pop(config_str)
+    except KeyError:
+        from anonymizer.datasource.managers.users import UserManager
+
+        pm = UserManager(from_str=config_str).pm
+
+        # drop the least recently used configuration
+        if len(_property_managers) >= CACHED_CONFIGURATIONS:
+            _property_managers.popitem(last=False)
+
+    _property_managers[config_str] = pm
+    return pm
+
+
+def _start_worker(warm_ups):
+    """
+    Pool initializer, keeps the state the warm ups of the pool share
+    """
+    global _warm_ups
+    _warm_ups = warm_ups
+
+
+def _warm_up(config_str, n_of_warm_ups):
+    """
+    Runs in the worker processes
+    Builds the property manager of a configuration, then waits until the first `n_of_warm_ups` warm ups were picked up,
+    so that no worker picks up two of them & each worker of the pool builds the manager
+    """
+    _property_manager(config_str)
+
+    arrived, condition = _warm_ups
+    deadline = time.time() + WARM_UP_TIMEOUT
+    with condition:
+        arrived.value += 1
+        condition.notify_all()
+
+        # a worker that died is replaced without its warm up, don't wait for it forever
+        while arrived.value < n_of_warm_ups and time.time() < deadline:
+            condition.wait(max(deadline - time.time(), 0))
+
+
+def _anonymize(task):
+    config_str, rows, token, true_id, property_names, known = task
+    property_manager = _property_manager(config_str)
+
+    properties = None
+    if property_names is not None:
+        properties = [property_manager.get_property_by_name(name) for name in property_names]
+
+    property_manager.token = token
+    return property_manager.info_page(rows, true_id=true_id, properties=properties, known=known)
+
+
+class SharedPool:
+    """
+    Worker processes of this process & the configurations they were warmed up with
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        # the configurations the workers keep, least recently used first
+        self.configurations = OrderedDict()
+        self.n_of_warm_ups = 0
+
+        warm_ups = (multiprocessing.Value('i', 0, lock=False), multiprocessing.Condition())
+        self.pool = multiprocessing.Pool(workers, initializer=_start_worker, initargs=(warm_ups,))
+
+    def warm_up(self, config_str):
+        """
+        Builds the property manager of a configuration in each worker process, in the background
+        """
+        if config_str in self.configurations:
+            self.configurations[config_str] = self.configurations.pop(config_str)
+            return
+
+        # the workers drop the least recently used configuration, it has to be loaded again next time
+        if len(self.configurations) >= CACHED_CONFIGURATIONS:
+            self.configurations.popitem(last=False)
+        self.configurations[config_str] = True
+
+        self.n_of_warm_ups += self.workers
+        for _ in range(self.workers):
+            self.pool.apply_async(_warm_up, (config_str, self.n_of_warm_ups))
+
+
+def start_pools(*workers):
+    """
+    Starts the worker processes for each number of `workers`
+    Worker processes are forked, so they get a copy of everything the process has at that time, e.g open database
+    connections & the state of its threads: call this at startup, before connections are opened or threads started,
+    pools started later by `shared_pool` are forked from wherever they are first needed
+    """
+    for n in workers:
+        shared_pool(n)
+
+
+def shared_pool(workers, config_str=None):
+    """
+    :param config_str: If set, the worker processes are warmed up with this configuration, see `SharedPool.warm_up`
+    :return: The `workers` worker processes of this process, started the first time they are needed
+    """
+    with _pool_lock:
+        try:
+            pool = _pools[workers]
+        except KeyError:
+            pool = _pools[workers] = SharedPool(workers)
+
+        if config_str is not None:
+            pool.warm_up(config_str)
+
+        return pool.pool
+
+
+def stop_pool():
+    """
+    Stops the worker processes once they are done with the pages they were given & waits for them to exit
+    """
+    with _pool_lock:
+        for pool in _pools.values():
+            pool.pool.close()
+            pool.pool.join()
+
+        _pools.clear()
+
+atexit.register(stop_pool)
+
+
+class WorkerPool:
+    """
+    Anonymizes pages of rows of a configuration across the worker processes of this process
+    Pages are split in one part per worker & the results are put back together in the order of the rows,
+    so they are the same as those of PropertyManager.info_page
+    """
+
+    def __init__(self, configuration, workers):
+        self.workers = workers
+        self._config_str = json.dumps(configuration.data)
+
+        # start the processes & load the configuration right away, so they are ready before the first page
+        shared_pool(workers, self._config_str)
+
+    def info_page(self, rows, token, true_id=False, properties=None, known=None):
+        property_names = None
+        if properties is not None:
+            property_names = [prop.name for prop in properties]
+
+        size = (len(rows) + self.workers - 1) // self.workers
+        tasks = []
+        for pos in range(0, len(rows), size):
+            part = rows[pos:pos + size]
+
+            # only the known values of the rows of this part
+            part_known = None
+            if known is not None:
+                part_known = dict((name, dict((row[0], values[row[0]]) for row in part))
+                                  for name, values in known.items())
+
+            tasks.append((self._config_str, part, token, true_id, property_names, part_known))
+
+        result = []
+        for users in shared_pool(self.workers).imap(_anonymize, tasks):
+            result += users
+
+        return result
@@ -0,0 +1,253 @@
+__author__ = 'dipap'
+
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+class PoolExhausted(Exception):
+    """
+    No database connection became available in time
+    """
+    pass
+
+
+class PooledConnection:
+    """
+    A database connection of a pool & the statements prepared on it
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.last_used = time.time()
+
+        # SQL to run for each parameterized template, see Connection.statement
+        self.statements = {}
+        self.n_of_prepared = 0
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    Database connections to a single database, shared between the threads of the process
+    Each thread checks out one connection on its first query & keeps it until it releases it,
+    so the cursors of a thread are never mixed with the ones of another
+    Connections are checked with a rollback before they are handed out & closed after being idle for `idle_timeout`
+    seconds, but at least `min_size` connections are kept open
+    """
+
+    def __init__(self, connect, min_size=0, max_size=10, idle_timeout=300, timeout=30):
+        """
+        :param connect: Function that opens a new connection
+        :param timeout: Seconds to wait for a connection when `max_size` connections are checked out
+        """
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._idle = deque()
+        self._checked_out = {}
+        self._size = 0
+        self._closed = False
+        self._lock = threading.Condition()
+
+        for _ in range(min_size):
+            self._idle.append(PooledConnection(self.connect()))
+            self._size += 1
+
+    def acquire(self):
+        """
+        :return: The connection of the current thread, borrowed from the pool on the first call
+        """
+        thread = threading.current_thread()
+
+        with self._lock:
+            connection = self._checked_out.get(thread)
+            if connection is not None:
+                return connection
+
+        connection = self.borrow()
+
+        with self._lock:
+            self._checked_out[thread] = connection
+
+        return connection
+
+    def borrow(self):
+        """
+        :return: A connection for exclusive use that is not bound to the current thread, see `give_back`
+        """
+        deadline = time.time() + self.timeout
+
+        with self._lock:
+            while True:
+                self._reclaim()
+                self._prune()
+
+                while self._idle:
+                    # most recently used first, so the others can time out
+                    connection = self._idle.pop()
+                    if self._is_healthy(connection):
+                        return connection
+
+                    connection.close()
+                    self._size -= 1
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolExhausted('All %d connections are in use' % self.max_size)
+
+                self._lock.wait(remaining)
+
+        # connect outside the lock
+        try:
+            return PooledConnection(self.connect())
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+
+    def give_back(self, connection, broken=False):
+        """
+        Returns a connection from `borrow` to the pool
+        :param broken: If set, the connection is closed instead
+        """
+        with self._lock:
+            if self._closed or broken:
+                connection.close()
+                self._size -= 1
+            else:
+                connection.last_used = time.time()
+                self._idle.append(connection)
+
+            self._lock.notify()
+
+    def release(self):
+        """
+        Gives the connection of the current thread back to the pool, if it has one
+        """
+        with self._lock:
+            connection = self._checked_out.pop(threading.current_thread(), None)
+
+        if connection is not None:
+            self.give_back(connection)
+
+    def close(self):
+        """
+        Closes the idle connections, connections that are checked out are closed when they are released
+        """
+        with self._lock:
+            self._closed = True
+
+            while self._idle:
+                self._idle.pop().close()
+                self._size -= 1
+
+    def _reclaim(self):
+        # connections of threads that ended without releasing them
+        for thread in [thread for thread in self._checked_out.keys() if not thread.is_alive()]:
+            self._idle.append(self._checked_out.pop(thread))
+
+    def _prune(self):
+        # the least recently used connections are at the left
+        now = time.time()
+        while self._idle and self._size > self.min_size and now - self._idle[0].last_used > self.idle_timeout:
+            self._idle.popleft().close()
+            self._size -= 1
+
+    @staticmethod
+    def _is_healthy(connection):
+        # a rollback fails on broken connections & ends a transaction left open by the previous thread
+        try:
+            connection.conn.rollback()
+        except Exception:
+            return False
+
+        return True
+
+    def __len__(self):
+        return self._size
+
+
+class ConnectionPools:
+    """
+    Process-wide connection pools, one for each database
+    Connections that only differ in their id share a pool
+    Forked processes (e.g anonymization workers) start with new pools, connections are never shared between processes
+    """
+
+    def __init__(self, min_size=0, max_size=10, idle_timeout=300):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+
+        self._pools = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def configure(self, min_size=None, max_size=None, idle_timeout=None):
+        """
+        Sets the limits of pools that are created from now on
+        """
+        if min_size is not None:
+            self.min_size = min_size
+        if max_size is not None:
+            self.max_size = max_size
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+
+    def get(self, conn_info, connect):
+        """
+        :param conn_info: The connection info from a configuration
+        :param connect: Function that opens a new connection to the database of `conn_info`
+        :return: The pool of that database
+        """
+        key = json.dumps(dict((k, v) for k, v in conn_info.items() if k != 'id'), sort_keys=True)
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # the connections belong to the parent process, leave them open for it
+                self._pools = {}
+                self._pid = os.getpid()
+
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(connect, min_size=self.min_size, max_size=self.max_size,
+                                      idle_timeout=self.idle_timeout)
+                self._pools[key] = pool
+
+        return pool
+
+    def release(self):
+        """
+        Gives all connections of the current thread back to their pools, e.g at the end of a request
+        """
+        with self._lock:
+            pools = self._pools.values()
+
+        for pool in pools:
+            pool.release()
+
+    def clear(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
+
+
+# the pools of this process
+connection_pools = ConnectionPools()
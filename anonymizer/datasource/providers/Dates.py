@@ -1,9 +1,11 @@
 __author__ = 'dipap'
 
 from django.utils.timezone import now
+from bisect import bisect_right
 from datetime import datetime
 from dateutil import parser
 from dateutil.relativedelta import relativedelta
+from anonymizer.datasource.util import sql_literal, is_date_type, is_numeric_type
 
 
 class InvalidBirthday(Exception):
@@ -14,7 +16,23 @@ def age_from_birthday(*args):
     if len(*args) != 1:
         raise ValueError('Exactly one argument (birthday) was expected, %d were found' % len(*args))
 
-    birthday = zip(*args)[0][0]
+    return age_at(zip(*args)[0][0], now().replace(tzinfo=None))
+
+
+def age_from_birthday__batch(columns, rngs):
+    if len(columns) != 1:
+        raise ValueError('Exactly one argument (birthday) was expected, %d were found' % len(columns))
+
+    # all ages are computed at the same time
+    today = now().replace(tzinfo=None)
+
+    return [age_at(birthday, today) for birthday in columns[0]]
+
+
+def age_at(birthday, today):
+    """
+    :return: The age at `today` of someone born on `birthday`
+    """
     if not birthday:
         return None
 
@@ -26,7 +44,54 @@ def age_from_birthday(*args):
         except ValueError:
             raise InvalidBirthday('%s can not be parsed into a valid date' % birthday)
 
-    return relativedelta(now().replace(tzinfo=None), birthday).years
+    return relativedelta(today, birthday).years
+
+
+def age_from_birthday__sql(args, types, connection):
+    """
+    Computes the age in the database, counting full years up to the current UTC time
+    Birthdays in any other format than ISO 8601 can't be read by a database that keeps dates as text,
+    those are computed in python
+    """
+    if not is_date_type(types[0]) or connection.dialect.text_dates:
+        return None
+
+    return connection.dialect.years_since(args[0])
+
+
+# ages checked when inverting a condition on the age
+MAX_AGE = 200
+
+
+def age_from_birthday__inverse(args, matches):
+    """
+    Rewrites a condition on the age into birthday intervals
+    Ages are checked between -MAX_AGE & MAX_AGE, accepted bounds are considered open
+    :param args: The arguments of the provider
+    :param matches: Function that checks if an age satisfies the condition
+    :return: A list of (low, low inclusive, high, high inclusive) birthday intervals
+    """
+    today = now().replace(tzinfo=None)
+
+    intervals = []
+    first = None
+    for age in range(-MAX_AGE, MAX_AGE + 2):
+        accepted = age <= MAX_AGE and matches(age)
+
+        if accepted and first is None:
+            first = age
+        elif not accepted and first is not None:
+            last = age - 1
+
+            # age >= first  <=>  birthday <= today - first years
+            high = None if first == -MAX_AGE else (today - relativedelta(years=first)).date()
+            # age <= last  <=>  birthday > today - (last + 1) years
+            low = None if last == MAX_AGE else (today - relativedelta(years=last + 1)).date()
+
+            intervals.append((low, False, high, True))
+            first = None
+
+    return intervals
 
 DAY_PERIODS = [
     {'hour': 0, 'name': 'Night'},
@@ -37,6 +102,28 @@ DAY_PERIODS = [
     {'hour': 21, 'name': 'Night'},
 ]
 
+# starting hour of each day period
+DAY_PERIOD_HOURS = [period['hour'] for period in DAY_PERIODS]
+
+
+def day_period(hour):
+    """
+    :return: The name of the day period an hour belongs to
+    """
+    return DAY_PERIODS[max(bisect_right(DAY_PERIOD_HOURS, hour) - 1, 0)]['name']
+
+
+def day_period_sql(hour):
+    """
+    :return: SQL expression with the name of the day period of an SQL hour expression
+    """
+    cases = ['WHEN %s IS NULL THEN NULL' % hour]
+    for idx in range(len(DAY_PERIODS) - 1):
+        cases.append('WHEN %s < %d THEN %s' % (hour, DAY_PERIODS[idx + 1]['hour'],
+                                               sql_literal(DAY_PERIODS[idx]['name'])))
+
+    return 'CASE %s ELSE %s END' % (' '.join(cases), sql_literal(DAY_PERIODS[-1]['name']))
+
 
 def part_of_day(*args):
     if len(*args) != 1:
@@ -66,6 +153,34 @@ def part_of_day(*args):
     return r
 
 
+def part_of_day__batch(columns, rngs):
+    if len(columns) != 1:
+        raise ValueError('Exactly one argument (datetime) was expected, %d were found' % len(columns))
+
+    result = []
+    for t in columns[0]:
+        if not t:
+            result.append(None)
+            continue
+
+        if type(t) != datetime:
+            try:
+                t = parser.parse(t)
+            except ValueError:
+                raise ValueError('%s can not be parsed into a valid datetime' % t)
+
+        result.append(day_period(t.hour))
+
+    return result
+
+
+def part_of_day__sql(args, types, connection):
+    if not is_date_type(types[0]):
+        return None
+
+    return day_period_sql(connection.dialect.hour(args[0]))
+
+
 def part_of_day_from_hour(*args):
     if len(*args) != 1:
         raise ValueError('Exactly one argument (hour) was expected, %d were found' % len(*args))
@@ -104,3 +219,32 @@ def part_of_day_from_hour(*args):
         result.append(r)
 
     return result
+
+
+def part_of_day_from_hour__batch(columns, rngs):
+    if len(columns) != 1:
+        raise ValueError('Exactly one argument (hour) was expected, %d were found' % len(columns))
+
+    return [[hour_period(tv) for tv in t] if type(t) == list else hour_period(t) for t in columns[0]]
+
+
+def hour_period(t):
+    """
+    :return: The name of the day period of a 24-based hour value or None for a missing one
+    """
+    if t is None:
+        return None
+
+    try:
+        hour = int(t)
+    except ValueError:
+        raise ValueError('%s can not be parsed into a 24-based hour value' % t)
+
+    return day_period(hour)
+
+
+def part_of_day_from_hour__sql(args, types, connection):
+    if not is_numeric_type(types[0]):
+        return None
+
+    return day_period_sql(args[0])
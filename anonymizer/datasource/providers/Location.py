@@ -49,7 +49,8 @@ def address_to_city__helper(address, info=None):
     return city_name, info
 
 
-def address_to_city(*args):
+# providers are called with the random generator of the row as `rng`, location lookups don't need it
+def address_to_city(*args, **kwargs):
     """
     Given an address, detect the city where this address is located
     """
@@ -78,7 +79,7 @@ def address_to_country__helper(address, info=None):
     return country_name, info
 
 
-def address_to_country(*args):
+def address_to_country(*args, **kwargs):
     """
     Given an address, detect the country where this address is located
     """
@@ -89,7 +90,7 @@ def address_to_country(*args):
     return address_to_country__helper(address)[0]
 
 
-def address_to_city_country(*args):
+def address_to_city_country(*args, **kwargs):
     address = zip(*args)[0][0]
     if not address:
         return ''
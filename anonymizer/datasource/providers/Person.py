@@ -20,7 +20,10 @@ class NoGenderOptions(Exception):
 
 # provides a random first name
 # can be based on gender
-def first_name(*args):
+# the `rng` keyword argument sets the random generator to use, by default the global one
+def first_name(*args, **kwargs):
+    rng = kwargs.get('rng', random)
+
     if len(args) > 0:
         # get gender information
         gender = zip(*args)[0][0]
@@ -45,9 +48,40 @@ def first_name(*args):
             raise InvalidGenderOption()
 
     # pick a random name
-    return names[random.randint(1, len(names) - 1)]
+    return names[rng.randint(1, len(names) - 1)]
+
+
+# batch version of first_name
+# `columns` holds the values of each argument for all rows, `rngs` the random generator of each row
+def first_name__batch(columns, rngs):
+    if len(columns) > 0 and len(columns) != 3:
+        raise NoGenderOptions()
+
+    result = []
+    for pos, rng in enumerate(rngs):
+        gender = columns[0][pos] if columns else None
+
+        # create the list of all usable names
+        if not gender:
+            names = all_names
+        elif gender == columns[1][pos]:
+            names = male_names
+        elif gender == columns[2][pos]:
+            names = female_names
+        else:
+            raise InvalidGenderOption()
+
+        # pick a random name
+        result.append(names[rng.randint(1, len(names) - 1)])
+
+    return result
 
 
 # creates the initial of a surname
-def last_name_initial(*args):
-    return random.choice(string.ascii_letters).upper() + '.'
+def last_name_initial(*args, **kwargs):
+    rng = kwargs.get('rng', random)
+    return rng.choice(string.ascii_letters).upper() + '.'
+
+
+def last_name_initial__batch(columns, rngs):
+    return [rng.choice(string.ascii_letters).upper() + '.' for rng in rngs]
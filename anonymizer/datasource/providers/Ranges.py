@@ -1,3 +1,5 @@
+from anonymizer.datasource.util import sql_literal, is_numeric_type
+
 __author__ = 'dipap'
 
 
@@ -5,28 +7,128 @@ class InvalidArgumentsException(Exception):
     pass
 
 
+def parse_ranges(ranges_str):
+    """
+    :return: A list of (low, high, label) tuples, with number bounds or None for open ones
+    """
+    ranges = []
+    for r in ranges_str.split('|'):
+        range_arr = r.split('..')
+        low = range_arr[0]
+        high = range_arr[1].split('=')[0]
+
+        if '=' in range_arr[1]:
+            label = '%s' % range_arr[1].split('=')[1]
+        else:
+            label = '%s..%s' % (low, high)
+
+        ranges.append((to_number(low), to_number(high), label))
+
+    return ranges
+
+
+def to_number(value):
+    if value == '':
+        return None
+
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def in_range(inclusive, low, high, value):
+    if inclusive:
+        return (low is None or low <= value) and (high is None or high >= value)
+    else:
+        return (low is None or low <= value) and (high is None or high > value)
+
+
 def from_value(inclusive, *args):
     if len(*args) != 2:
         raise InvalidArgumentsException()
 
-    ranges = zip(*args)[0][0].split('|')
+    ranges = zip(*args)[0][0]
     value = zip(*args)[1][0]
 
-    for r in ranges:
-        range_arr = r.split('..')
-        low = range_arr[0]
-        high = range_arr[1].split('=')[0]
+    for low, high, label in parse_ranges(ranges):
+        if in_range(inclusive, low, high, value):
+            return label
 
-        if inclusive:
-            exp = (low == '' or float(low) <= value) and (high == '' or float(high) >= value)
-        else:
-            exp = (low == '' or float(low) <= value) and (high == '' or float(high) > value)
 
-        if exp:
-            if '=' in range_arr[1]:
-                return '%s' % range_arr[1].split('=')[1]
-            else:
-                return '%s..%s' % (low, high)
+def from_value__batch(inclusive, columns, rngs):
+    """
+    Batch version of from_value, each distinct ranges argument is parsed once
+    """
+    if len(columns) != 2:
+        raise InvalidArgumentsException()
+
+    parsed = {}
+    result = []
+    for ranges_str, value in zip(*columns):
+        try:
+            ranges = parsed[ranges_str]
+        except KeyError:
+            ranges = parsed[ranges_str] = parse_ranges(ranges_str)
+
+        label = None
+        for low, high, range_label in ranges:
+            if in_range(inclusive, low, high, value):
+                label = range_label
+                break
+
+        result.append(label)
+
+    return result
+
+
+def from_value__inverse(inclusive, args, matches):
+    """
+    Rewrites a condition on the returned range into intervals of the value
+    :param args: The arguments of the provider, the value is the one starting with `@`
+    :param matches: Function that checks if a returned range satisfies the condition
+    :return: A list of (low, low inclusive, high, high inclusive) value intervals or None if not invertible
+    """
+    # values outside of all ranges return None, which must not be accepted
+    if matches(None):
+        return None
+
+    ranges = parse_ranges(args[0])
+
+    # the first matching range wins, so overlapping ranges can't be described by independent intervals
+    ordered = sorted(ranges, key=lambda r: (r[0] is not None, r[0]))
+    for r1, r2 in zip(ordered, ordered[1:]):
+        if r1[1] is None or r2[0] is None or r1[1] > r2[0] or (inclusive and r1[1] == r2[0]):
+            return None
+
+    return [(low, True, high, inclusive) for low, high, label in ranges if matches(label)]
+
+
+def from_value__sql(inclusive, args, types, connection):
+    """
+    Computes from_value in the database with a CASE WHEN ladder
+    :param args: The arguments of the provider, with `@` arguments replaced by their SQL expressions
+    :param types: The types of the arguments, None for constant ones
+    :return: An SQL expression or None if the value can't be compared in SQL
+    """
+    if not is_numeric_type(types[1]):
+        return None
+
+    value = args[1]
+
+    # a missing value gets the same range as in python
+    cases = ['WHEN %s IS NULL THEN %s' % (value, sql_literal(from_value(inclusive, [args[0], None])))]
+
+    for low, high, label in parse_ranges(args[0]):
+        conditions = []
+        if low is not None:
+            conditions.append('%s >= %s' % (value, low))
+        if high is not None:
+            conditions.append('%s %s %s' % (value, '<=' if inclusive else '<', high))
+
+        cases.append('WHEN %s THEN %s' % (' AND '.join(conditions) or '1=1', sql_literal(label)))
+
+    return 'CASE %s ELSE NULL END' % ' '.join(cases)
 
 
 # type helper to return the exact data type returned by a call to from_value
@@ -46,6 +148,18 @@ def from_int_value__type(*args):
     return from_value__type(True, *args)
 
 
+def from_int_value__batch(columns, rngs):
+    return from_value__batch(True, columns, rngs)
+
+
+def from_int_value__inverse(args, matches):
+    return from_value__inverse(True, args, matches)
+
+
+def from_int_value__sql(args, types, connection):
+    return from_value__sql(True, args, types, connection)
+
+
 # float ranges are NOT inclusive
 # e.g 5..10 contains all real numbers x where 5 <= x < 10
 def from_float_value(*args):
@@ -54,3 +168,15 @@ def from_float_value(*args):
 
 def from_float_value__type(*args):
     return from_value__type(False, *args)
+
+
+def from_float_value__batch(columns, rngs):
+    return from_value__batch(False, columns, rngs)
+
+
+def from_float_value__inverse(args, matches):
+    return from_value__inverse(False, args, matches)
+
+
+def from_float_value__sql(args, types, connection):
+    return from_value__sql(False, args, types, connection)
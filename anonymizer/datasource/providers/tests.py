@@ -1,12 +1,33 @@
-from anonymizer.datasource.providers.Dates import age_from_birthday, InvalidBirthday
+import random
+import sqlite3
+from anonymizer.datasource.connections import Connection
+from anonymizer.datasource.providers.Dates import age_from_birthday, InvalidBirthday, age_from_birthday__inverse, \
+    age_from_birthday__sql, part_of_day_from_hour, part_of_day_from_hour__sql, age_from_birthday__batch, \
+    part_of_day_from_hour__batch
 from anonymizer.datasource.providers.Location import address_to_city, address_to_country, address_to_city_country
 from anonymizer.datasource.providers.Ranges import from_int_value, from_float_value, \
-    from_int_value__type, from_float_value__type
+    from_int_value__type, from_float_value__type, from_int_value__inverse, from_float_value__inverse, \
+    from_int_value__sql, from_float_value__sql, from_int_value__batch, from_float_value__batch
 
 __author__ = 'dipap'
 
 from django.test import TestCase
-from Person import first_name, last_name_initial, male_names, female_names, NoGenderOptions, InvalidGenderOption
+from Person import first_name, last_name_initial, male_names, female_names, NoGenderOptions, InvalidGenderOption, \
+    first_name__batch, last_name_initial__batch
+
+
+def sqlite3_value(expression, column_type, value):
+    """
+    Evaluates an SQL expression on column `v` of an in-memory sqlite3 table that contains `value`
+    """
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t (v %s)' % column_type)
+    conn.execute('INSERT INTO t VALUES (?)', [value])
+
+    return conn.execute('SELECT %s FROM t' % expression).fetchone()[0]
+
+
+SQLITE3 = Connection(id='memory', engine='django.db.backends.sqlite3')
 
 
 class PersonTests(TestCase):
@@ -51,6 +72,22 @@ class PersonTests(TestCase):
         self.assertEqual(len(surname), 2)
         self.assertEqual(surname[1], '.')
 
+    def test_batch(self):
+        genders = ['man', 'woman', None, 'man']
+        columns = [genders, ['man'] * 4, ['woman'] * 4]
+
+        # same names as the scalar versions with the same random state
+        names = first_name__batch(columns, [random.Random(seed) for seed in range(4)])
+        for seed, gender in enumerate(genders):
+            self.assertEqual(names[seed], first_name((gender, 'man', 'woman'), rng=random.Random(seed)))
+
+        surnames = last_name_initial__batch([], [random.Random(seed) for seed in range(4)])
+        for seed in range(4):
+            self.assertEqual(surnames[seed], last_name_initial(rng=random.Random(seed)))
+
+        with self.assertRaises(InvalidGenderOption):
+            first_name__batch([['Male'], ['Man'], ['Woman']], [random.Random(0)])
+
 
 class RangesTests(TestCase):
 
@@ -87,6 +124,39 @@ class RangesTests(TestCase):
         v = from_float_value(('..10=Low|10..20=Medium|20..=High', 20))
         self.assertEqual(v, 'High')
 
+    def test_from_value__inverse(self):
+        # int ranges include their top limit
+        intervals = from_int_value__inverse(['..10=Low|11..20=Medium|21..=High', '@age'], lambda v: v == 'Medium')
+        self.assertEqual(intervals, [(11, True, 20, True)])
+
+        # float ranges don't
+        intervals = from_float_value__inverse(['..10|10..20|20..', '@age'], lambda v: v in ['..10', '20..'])
+        self.assertEqual(intervals, [(None, True, 10, False), (20, True, None, False)])
+
+        # overlapping ranges can't be inverted
+        self.assertIsNone(from_int_value__inverse(['1..10|10..20', '@age'], lambda v: v == '1..10'))
+
+    def test_from_value__batch(self):
+        values = [None, -4, 10, 10.5, 11, 20, 21, 56]
+
+        for ranges in ['..10=Low|11..20=Medium|21..=High', '1..10|11..20']:
+            columns = [[ranges] * len(values), values]
+
+            self.assertEqual(from_int_value__batch(columns, None), [from_int_value((ranges, v)) for v in values])
+            self.assertEqual(from_float_value__batch(columns, None), [from_float_value((ranges, v)) for v in values])
+
+    def test_from_value__sql(self):
+        for ranges in ['..10=Low|11..20=Medium|21..=High', '1..10|11..20']:
+            for value in [None, -4, 10, 10.5, 11, 20, 21, 56]:
+                expression = from_int_value__sql([ranges, 'v'], [None, 'int'], SQLITE3)
+                self.assertEqual(sqlite3_value(expression, 'REAL', value), from_int_value((ranges, value)))
+
+                expression = from_float_value__sql([ranges, 'v'], [None, 'float'], SQLITE3)
+                self.assertEqual(sqlite3_value(expression, 'REAL', value), from_float_value((ranges, value)))
+
+        # non-numeric values are ranged in python
+        self.assertIsNone(from_int_value__sql(['1..10', 'v'], [None, 'varchar(255)'], SQLITE3))
+
 
 class LocationTests(TestCase):
 
@@ -112,3 +182,35 @@ class DatesTests(TestCase):
             age_from_birthday(())
         with self.assertRaises(InvalidBirthday):
             age_from_birthday(('undefined',))
+
+    def test_birthday_to_age__sql(self):
+        # sqlite3 can't read e.g `1991-2-12`, the age is computed in python
+        self.assertIsNone(age_from_birthday__sql(['v'], ['date'], SQLITE3))
+
+        expression = SQLITE3.dialect.years_since('v')
+        for birthday in ['1991-02-12', '2000-02-29', '1985-12-31', None]:
+            self.assertEqual(sqlite3_value(expression, 'DATE', birthday), age_from_birthday((birthday,)))
+
+    def test_birthday_to_age__batch(self):
+        birthdays = ['1991-02-12', '2000-02-29', None, 1985]
+        self.assertEqual(age_from_birthday__batch([birthdays], None), [age_from_birthday((b,)) for b in birthdays])
+
+    def test_part_of_day_from_hour__batch(self):
+        hours = [None, 0, 5, 6, 12, '14', 15, 19, 20, 21, 23, [3, 13]]
+        self.assertEqual(part_of_day_from_hour__batch([hours], None), [part_of_day_from_hour((h,)) for h in hours])
+
+    def test_part_of_day_from_hour__sql(self):
+        expression = part_of_day_from_hour__sql(['v'], ['int'], SQLITE3)
+
+        for hour in [None, 0, 5, 6, 12, 14, 15, 19, 20, 21, 23]:
+            self.assertEqual(sqlite3_value(expression, 'INTEGER', hour), part_of_day_from_hour((hour,)))
+
+    def test_birthday_to_age__inverse(self):
+        intervals = age_from_birthday__inverse(['@birthday'], lambda age: 30 <= age <= 39)
+        self.assertEqual(len(intervals), 1)
+
+        low, low_inclusive, high, high_inclusive = intervals[0]
+        self.assertEqual(age_from_birthday((high,)), 30)
+        self.assertEqual(age_from_birthday((low,)), 40)
+        self.assertFalse(low_inclusive)
+        self.assertTrue(high_inclusive)
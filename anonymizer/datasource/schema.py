@@ -0,0 +1,123 @@
+__author__ = 'dipap'
+
+
+class Schema:
+    """
+    The tables, columns, primary keys & foreign keys of a database, introspected in a single pass
+    Related tables are found by walking the foreign key graph in memory, without further catalog queries
+    """
+
+    def __init__(self, tables):
+        """
+        :param tables: A list of tables, each a dict with
+                       `name`,
+                       `columns`: a [name, type] pair for each column,
+                       `primary_key`: the name of the primary key column or None,
+                       `foreign_keys`: a [column, referenced table, referenced column] triple for each foreign key,
+                                       the referenced column may be None for the primary key of the referenced table
+                       `internal`: the names of the columns that are not data, e.g auto-increment & foreign key columns
+                       `rows`: optionally, the estimated number of rows
+        """
+        self.tables = tables
+        self._tables = dict((table['name'].lower(), table) for table in tables)
+
+        # each foreign key (table, column, referenced table, referenced column) is an edge of both its tables
+        self._edges = {}
+        for table in tables:
+            for column, referenced_table, referenced_column in table['foreign_keys']:
+                if referenced_column is None:
+                    referenced_column = self.primary_key(referenced_table)
+
+                edge = (table['name'], column, referenced_table, referenced_column)
+                self._edges.setdefault(table['name'].lower(), []).append(edge)
+                if referenced_table.lower() != table['name'].lower():
+                    self._edges.setdefault(referenced_table.lower(), []).append(edge)
+
+    def table_names(self):
+        return [table['name'] for table in self.tables]
+
+    def columns(self, table_name, data_only=False):
+        """
+        :param data_only: If set, internal columns are left out
+        :return: The (name, type) of each column of a table, none if the table does not exist
+        """
+        table = self._tables.get(table_name.lower())
+        if table is None:
+            return []
+
+        return [(column[0], column[1]) for column in table['columns']
+                if not (data_only and column[0] in table['internal'])]
+
+    def primary_key(self, table_name):
+        """
+        :return: The name of the primary key column of a table or None
+        """
+        table = self._tables.get(table_name.lower())
+        if table is None:
+            return None
+
+        return table['primary_key']
+
+    def rows(self, table_name):
+        """
+        :return: The estimated number of rows of a table or None if it is not known
+        """
+        table = self._tables.get(table_name.lower())
+        if table is None:
+            return None
+
+        return table.get('rows')
+
+    def foreign_key_between(self, from_table, to_table):
+        """
+        :return: The column of `from_table` that references `to_table` or None
+        """
+        for table, column, referenced_table, _ in self._edges.get(from_table.lower(), []):
+            if table.lower() == from_table.lower() and referenced_table.lower() == to_table.lower():
+                return column
+
+        return None
+
+    def related_tables(self, table_name):
+        """
+        :return: (the tables connected to `table_name` through foreign keys,
+                  a (joined table, column, column) triple for each of these foreign keys)
+        Tables are visited depth first, through their own foreign keys first & then through the first foreign key of
+        each table that references them, so the result is the same as that of the former per-table catalog queries
+        """
+        return self._related_tables(table_name, [table_name.lower()])
+
+    def _related_tables(self, name, accessed):
+        tables = []
+        relationships = []
+        edges = self._edges.get(name.lower(), [])
+
+        # foreign keys from this table
+        for table, column, referenced_table, referenced_column in edges:
+            if table.lower() == name.lower():
+                tables.append(referenced_table)
+                relationships.append((referenced_table, '%s.%s' % (name, column),
+                                      '%s.%s' % (referenced_table, referenced_column)))
+
+        # foreign keys to this table, only the first one of each table
+        referencing = set()
+        for table, column, referenced_table, referenced_column in edges:
+            if referenced_table.lower() == name.lower() and table.lower() not in referencing:
+                referencing.add(table.lower())
+                tables.append(table)
+                relationships.append((table, '%s.%s' % (name, referenced_column), '%s.%s' % (table, column)))
+
+        # visit the tables that were not reached yet, keeping the foreign keys to tables reached after this one
+        connected = []
+        for table in tables:
+            if table.lower() not in accessed:
+                before = accessed[:]
+                accessed.append(table.lower())
+                connected.append(table)
+
+                connected_tables, connected_relationships = self._related_tables(table, accessed)
+                connected += connected_tables
+                relationships += [relationship for relationship in connected_relationships
+                                  if relationship[0].lower() not in before]
+
+        return connected, relationships
@@ -1,8 +1,20 @@
+import base64
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
 from managers.data import Property, ProviderNotFound, ProviderMethodNotFound, PropertyNotFoundException, \
-    UnknownOperatorException
+    UnknownOperatorException, InvalidFilterException, PropertyManager
 from managers.users import UserManagerException, UserManager
-from anonymizer.datasource.connections import ConnectionManager, ConnectionNotFound
-from anonymizer.datasource.util import Configuration
+from anonymizer.datasource.connections import Connection, ConnectionManager, ConnectionNotFound
+from anonymizer.datasource.dialects import PARAMETER, SQLite3Dialect, MySQLDialect, PostgresDialect
+from anonymizer.datasource.providers.Person import last_name_initial, last_name_initial__batch
+from anonymizer.datasource.pools import ConnectionPool, PoolExhausted
+from anonymizer.datasource.schema import Schema
+from anonymizer.datasource.util import Configuration, encode_cursor, decode_cursor, InvalidCursor, KeyedRandom, \
+    LRUCache, prefetch
 
 __author__ = 'dipap'
 
@@ -65,6 +77,68 @@ class ConnectionTests(TestCase):
                          self.pg.get_related_tables('users')[1])
 
 
+class SchemaTests(TestCase):
+
+    def setUp(self):
+        self.schema = Schema([
+            {'name': 'users', 'columns': [['id', 'integer'], ['name', 'text']], 'primary_key': 'id',
+             'foreign_keys': [], 'internal': ['id']},
+            {'name': 'orders', 'columns': [['id', 'integer'], ['user_id', 'integer']], 'primary_key': 'id',
+             'foreign_keys': [['user_id', 'users', None]], 'internal': ['id', 'user_id']},
+            {'name': 'items', 'columns': [['id', 'integer'], ['order_id', 'integer'], ['user_id', 'integer']],
+             'primary_key': 'id', 'foreign_keys': [['order_id', 'orders', 'id'], ['user_id', 'users', 'id']],
+             'internal': []},
+            {'name': 'logs', 'columns': [['id', 'integer']], 'primary_key': None, 'foreign_keys': [],
+             'internal': []},
+        ])
+
+    def test_columns(self):
+        self.assertEqual(self.schema.columns('Users'), [('id', 'integer'), ('name', 'text')])
+        self.assertEqual(self.schema.columns('users', data_only=True), [('name', 'text')])
+        self.assertEqual(self.schema.columns('missing'), [])
+        self.assertEqual(self.schema.primary_key('ORDERS'), 'id')
+        self.assertIsNone(self.schema.primary_key('logs'))
+
+    def test_foreign_key_between(self):
+        self.assertEqual(self.schema.foreign_key_between('items', 'orders'), 'order_id')
+        self.assertIsNone(self.schema.foreign_key_between('users', 'orders'))
+
+    def test_related_tables(self):
+        tables, relationships = self.schema.related_tables('Users')
+
+        # each foreign key is reported once & unreferenced tables are not reached
+        self.assertEqual(tables, ['orders', 'items'])
+        self.assertEqual(relationships, [
+            ('orders', 'Users.id', 'orders.user_id'),
+            ('items', 'Users.id', 'items.user_id'),
+            ('items', 'orders.id', 'items.order_id'),
+        ])
+
+    def test_related_tables_of_ctc(self):
+        config = Configuration('test-data/config/ctc_config.json')
+        connection = ConnectionManager(config.get_connection_info()).get('Activity tracker data')
+        tables, relationships = connection.get_related_tables('activitytracker_user')
+
+        # same tables, orientation & order as the former per-table catalog queries
+        self.assertEqual(len(tables), 34)
+        self.assertEqual(tables[:6], ['activitytracker_user_groups', 'auth_group', 'auth_group_permissions',
+                                      'auth_permission', 'django_content_type', 'django_admin_log'])
+        self.assertEqual(len(relationships), 43)
+        self.assertEqual(relationships[0], ['activitytracker_user_groups',
+                                            'activitytracker_user.id@Activity tracker data',
+                                            'activitytracker_user_groups.user_id@Activity tracker data'])
+        self.assertEqual(relationships[20], ['django_content_type',
+                                             'auth_permission.content_type_id@Activity tracker data',
+                                             'django_content_type.id@Activity tracker data'])
+        self.assertEqual(relationships[23], ['django_admin_log',
+                                             'django_content_type.id@Activity tracker data',
+                                             'django_admin_log.content_type_id@Activity tracker data'])
+
+        # only the first foreign key of a table that references a visited table is followed
+        self.assertEqual([r[2] for r in relationships if r[0] == 'activitytracker_hassuperactivity'],
+                         ['activitytracker_hassuperactivity.superactivity_id@Activity tracker data'])
+
+
 class ConnectionManagerTests(TestCase):
 
     def test_exception_connection_not_found(self):
@@ -168,4 +242,287 @@ class PropertyTests(TestCase):
         self.assertTrue(p.matches('H', '>L'))
         self.assertTrue(p.matches('M', '!=L'))
 
+    def test_invalid_option(self):
+        p = Property(self.um.pm, '^Ranges.from_float_value(10..20|20..30|30..40, 35)', None, tp='###')
+
+        # both an unknown option in the filter & an unknown value are invalid filters
+        with self.assertRaises(InvalidFilterException):
+            p.matches('20..30', '!=10..15')
+
+        with self.assertRaises(InvalidFilterException):
+            p.matches('20..29', '>10..20')
+
+
+class CursorTests(TestCase):
+
+    def test_cursor_round_trip(self):
+        state = {'after': 42, 'filters': 'gender="Male"', 'fields': 'age,gender'}
+        self.assertEqual(decode_cursor('secret', encode_cursor('secret', state)), state)
+
+    def test_changed_cursor(self):
+        cursor = encode_cursor('secret', {'after': 42, 'filters': 'gender="Male"', 'fields': None})
+
+        # any changed character is refused
+        position = len(cursor) // 2
+        changed = cursor[:position] + ('A' if cursor[position] != 'A' else 'B') + cursor[position + 1:]
+        with self.assertRaises(InvalidCursor):
+            decode_cursor('secret', changed)
+
+    def test_cursor_of_other_secret(self):
+        with self.assertRaises(InvalidCursor):
+            decode_cursor('other_secret', encode_cursor('secret', {'after': 42}))
+
+    def test_malformed_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            decode_cursor('secret', 'not-a-cursor')
+
+    def test_cursor_hides_state(self):
+        cursor = encode_cursor('secret', {'after': 987654, 'filters': 'gender="Male"', 'fields': None})
+
+        # the primary key can't be read from the cursor, not even once it is decoded without the secret
+        raw = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+        self.assertNotIn('987654', cursor)
+        self.assertNotIn('987654', raw)
+        self.assertNotIn('gender', raw)
+
+
+class KeyedRandomTests(TestCase):
+
+    def test_same_key_same_numbers(self):
+        rng = KeyedRandom('token', 42, 'first_name')
+        numbers = [rng.random() for _ in range(10)]
+
+        self.assertEqual(KeyedRandom('token', 42, 'first_name').random(), numbers[0])
+
+        # other generators don't affect the numbers of a key
+        other = KeyedRandom('token', 43, 'first_name')
+        rng = KeyedRandom('token', 42, 'first_name')
+        mixed = []
+        for _ in range(10):
+            other.random()
+            mixed.append(rng.random())
+        self.assertEqual(mixed, numbers)
+
+    def test_other_key_other_numbers(self):
+        numbers = [KeyedRandom('token', 42, 'first_name').random(),
+                   KeyedRandom('token', 42, 'last_name').random(),
+                   KeyedRandom('token', 43, 'first_name').random(),
+                   KeyedRandom('other_token', 42, 'first_name').random()]
+        self.assertEqual(len(set(numbers)), 4)
+
+    def test_ranges(self):
+        rng = KeyedRandom('token', 42)
+        for _ in range(100):
+            self.assertTrue(0 <= rng.random() < 1)
+            self.assertTrue(1 <= rng.randint(1, 6) <= 6)
+            self.assertTrue(rng.getrandbits(70) < 2 ** 70)
+
+    def test_providers_without_batch_helper(self):
+        class Prop:
+            fn = staticmethod(last_name_initial)
+            fn_batch = None
+
+        state = random.getstate()
+        values = PropertyManager.apply(Prop(), [], [KeyedRandom('token', pk, 'last_name') for pk in range(10)])
+
+        # each row gets the values of its own generator & the global generator is left alone
+        self.assertEqual(values, last_name_initial__batch([], [KeyedRandom('token', pk, 'last_name')
+                                                               for pk in range(10)]))
+        self.assertEqual(random.getstate(), state)
+
+
+class PrefetchTests(TestCase):
+
+    def test_same_items(self):
+        self.assertEqual(list(prefetch(iter(range(100)), 2)), range(100))
+
+    def test_error_is_raised(self):
+        def items():
+            yield 1
+            raise ValueError('fetch failed')
+
+        with self.assertRaises(ValueError):
+            list(prefetch(items(), 2))
+
+    def test_early_stop(self):
+        closed = []
+
+        def items():
+            try:
+                for i in range(100):
+                    yield i
+            finally:
+                closed.append(True)
+
+        result = prefetch(items(), 2)
+        self.assertEqual(next(result), 0)
+        result.close()
+
+        # the background iteration is stopped & cleaned up
+        self.assertEqual(closed, [True])
+
+    def test_release(self):
+        released = []
+
+        def release():
+            released.append(threading.current_thread())
+
+        self.assertEqual(list(prefetch(iter(range(10)), 2, release=release)), range(10))
+
+        # called once, by the background thread
+        self.assertEqual(len(released), 1)
+        self.assertIsNot(released[0], threading.current_thread())
+
+
+class LRUCacheTests(TestCase):
+
+    def test_least_recently_used_is_dropped(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+
+        # `a` was used last, `b` is dropped to make room for `c`
+        self.assertEqual(cache['a'], 1)
+        cache['c'] = 3
+
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        with self.assertRaises(KeyError):
+            cache['b']
+
+
+class DialectTests(TestCase):
+
+    def test_sqlite3_array_agg(self):
+        dialect = SQLite3Dialect()
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE t (u INTEGER, v VARCHAR(10))')
+        conn.executemany('INSERT INTO t VALUES (?, ?)', [(1, 'a'), (1, 'b'), (2, None)])
+
+        query = 'SELECT %s FROM t GROUP BY u ORDER BY u' % dialect.array_agg('v')
+        self.assertEqual([dialect.parse_array(row[0]) for row in conn.execute(query)], [['a', 'b'], [None]])
+
+    def test_sqlite3_hour(self):
+        conn = sqlite3.connect(':memory:')
+        self.assertEqual(conn.execute('SELECT ' + SQLite3Dialect().hour("'2015-06-01 14:35:00'")).fetchone()[0], 14)
+
+    def test_sqlite3_as_date(self):
+        dialect = SQLite3Dialect()
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE t (v DATE)')
+        conn.execute("INSERT INTO t VALUES ('1991-02-12')")
+
+        # a datetime parameter is bound as `1991-02-12 00:00:00`, which is after `1991-02-12` as text
+        condition = '%s >= %s' % (dialect.as_date('v'), dialect.as_date(PARAMETER))
+        query = dialect.bind('SELECT COUNT(*) FROM t WHERE ' + condition)
+        self.assertEqual(conn.execute(query, [datetime(1991, 2, 12)]).fetchone()[0], 1)
+
+    def test_paginate(self):
+        for dialect in [SQLite3Dialect(), MySQLDialect(), PostgresDialect()]:
+            self.assertEqual(dialect.paginate(None, 10), ' LIMIT 10')
+            self.assertEqual(dialect.paginate(20, 10), ' LIMIT 10 OFFSET 20')
+
+        # offsets without a limit
+        self.assertEqual(SQLite3Dialect().paginate(20, None), ' LIMIT -1 OFFSET 20')
+        self.assertEqual(PostgresDialect().paginate(20, None), ' OFFSET 20')
+
+    def test_aggregate(self):
+        self.assertEqual(PostgresDialect().aggregate('avg', 't.v'), 'avg(t.v)')
+        self.assertEqual(PostgresDialect().aggregate('count(DISTINCT @param)', 't.v'), 'count(DISTINCT t.v)')
+        self.assertEqual(PostgresDialect().aggregate('GROUP_CONCAT', 't.v'), "string_agg(CAST(t.v AS TEXT), ',')")
+        self.assertEqual(MySQLDialect().aggregate('GROUP_CONCAT', 't.v'), 'GROUP_CONCAT(t.v)')
+
+
+class ConnectionPoolTests(TestCase):
+
+    @staticmethod
+    def connect():
+        return sqlite3.connect(':memory:', check_same_thread=False)
+
+    @staticmethod
+    def in_thread(fn):
+        result = []
+
+        def run():
+            try:
+                result.append(fn())
+            except Exception as e:
+                result.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+        if isinstance(result[0], Exception):
+            raise result[0]
+
+        return result[0]
+
+    def test_checkout_per_thread(self):
+        pool = ConnectionPool(self.connect, max_size=2)
+        connection = pool.acquire()
+
+        self.assertIs(pool.acquire(), connection)
+        other = self.in_thread(pool.acquire)
+        self.assertIsNot(other, connection)
+
+        # released connections & the ones of finished threads are reused
+        pool.release()
+        self.assertIn(self.in_thread(pool.acquire), [connection, other])
+        self.assertEqual(len(pool), 2)
+
+    def test_max_size(self):
+        pool = ConnectionPool(self.connect, max_size=1, timeout=0.1)
+        pool.acquire()
+
+        with self.assertRaises(PoolExhausted):
+            self.in_thread(pool.acquire)
+
+    def test_broken_connections_are_replaced(self):
+        pool = ConnectionPool(self.connect, min_size=1)
+        connection = pool.acquire()
+        connection.conn.close()
+        pool.release()
+
+        self.assertIsNot(pool.acquire(), connection)
+        self.assertEqual(len(pool), 1)
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(self.connect, idle_timeout=0.01)
+        connection = pool.acquire()
+        pool.release()
+        time.sleep(0.05)
+
+        self.assertIsNot(pool.acquire(), connection)
+        self.assertEqual(len(pool), 1)
+
+    def test_borrow(self):
+        pool = ConnectionPool(self.connect, max_size=2)
+        connection = pool.acquire()
+
+        # borrowed connections are not the one of the thread
+        borrowed = pool.borrow()
+        self.assertIsNot(borrowed, connection)
+        self.assertIs(pool.acquire(), connection)
+
+        pool.give_back(borrowed, broken=True)
+        self.assertEqual(len(pool), 1)
+
+    def test_fetch_chunks(self):
+        connection = Connection('db', 'django.db.backends.sqlite3', pool=ConnectionPool(self.connect))
+        connection.execute('CREATE TABLE numbers (n INTEGER)')
+        connection.checkout().conn.executemany('INSERT INTO numbers VALUES (?)', [(n,) for n in range(10)])
+
+        chunks = connection.fetch_chunks('SELECT n FROM numbers WHERE n < %s ORDER BY n' % PARAMETER, 4, [7])
+        self.assertEqual([[row[0] for row in rows] for rows in chunks], [[0, 1, 2, 3], [4, 5, 6]])
+
+        # stopping early leaves the connection ready for other queries
+        chunks = connection.fetch_chunks('SELECT n FROM numbers', 3)
+        self.assertEqual(len(next(chunks)), 3)
+        chunks.close()
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM numbers').fetchone()[0], 10)
 
+        # a failing query is not mistaken for an empty result
+        with self.assertRaises(sqlite3.OperationalError):
+            list(connection.fetch_chunks('SELECT n FROM no_such_table', 3))
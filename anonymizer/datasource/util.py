@@ -1,8 +1,20 @@
 __author__ = 'dipap'
 
+import base64
+import hashlib
 import json
-import sys
 import os
+import Queue
+import random
+import struct
+import sys
+import threading
+from collections import OrderedDict
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 
 class Configuration:
@@ -18,5 +30,196 @@ class Configuration:
         return self.data['sites'][0]['connections']
 
 
+def sql_literal(value):
+    """
+    :return: `value` as an SQL literal
+    """
+    if value is None:
+        return 'NULL'
+    elif type(value) in [int, long, float]:
+        return str(value)
+
+    return "'%s'" % unicode(value).replace("'", "''")
+
+
+class LRUCache:
+    """
+    Cache of at most `size` entries, the least recently used one is dropped to make room for a new one
+    Used for what is built for arbitrary api requests, e.g queries by the shape of their filters
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._entries.pop(key)
+            self._entries[key] = value
+
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            if len(self._entries) >= self.size:
+                self._entries.popitem(last=False)
+
+            self._entries[key] = value
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def is_numeric_type(tp):
+    return tp is not None and any([t in tp.lower() for t in ['int', 'float', 'real', 'double', 'decimal', 'numeric']])
+
+
+def is_date_type(tp):
+    return tp is not None and ('date' in tp.lower() or 'time' in tp.lower())
+
+
+def prefetch(iterable, depth, release=None):
+    """
+    Iterates `iterable` in a background thread that stays at most `depth` items ahead of the consumer
+    Errors of the background iteration are raised to the consumer
+    When the consumer stops early, the background thread is stopped before the generator returns
+    :param release: If set, called by the background thread when it is done, e.g to give its connections back
+    """
+    items = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        # wait for space in the queue, unless the consumer is gone
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.05)
+                return True
+            except Queue.Full:
+                pass
+
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+
+            put((end, None))
+        except Exception:
+            put((end, sys.exc_info()))
+        finally:
+            try:
+                close = getattr(iterable, 'close', None)
+                if close:
+                    close()
+            finally:
+                if release is not None:
+                    release()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error:
+                    raise error[0], error[1], error[2]
+                return
 
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
+
+class KeyedRandom(random.Random):
+    """
+    Counter-based random generator
+    The n-th number it returns is derived from a hash of its key & n, so it only depends on the key
+    and not on which other generators were used before it
+    """
+    def __new__(cls, *key):
+        # the base generator only accepts a seed
+        return random.Random.__new__(cls)
+
+    def __init__(self, *key):
+        self._key = '###'.join([unicode(part).encode('utf8') for part in key])
+        self._hash = None
+        random.Random.__init__(self)
+
+    def seed(self, a=None):
+        self._counter = 0
+        self.gauss_next = None
+
+    def getstate(self):
+        return self._counter
+
+    def setstate(self, state):
+        self._counter = state
+
+    def _next(self):
+        # the key is hashed once, on the first draw
+        if self._hash is None:
+            self._hash = hashlib.sha256(self._key)
+
+        h = self._hash.copy()
+        h.update(struct.pack('<Q', self._counter))
+        self._counter += 1
+
+        return struct.unpack('<Q', h.digest()[:8])[0]
+
+    def random(self):
+        return (self._next() >> 11) * (1.0 / (1 << 53))
+
+    def getrandbits(self, k):
+        value = 0
+        n_of_bits = 0
+        while n_of_bits < k:
+            value = (value << 64) | self._next()
+            n_of_bits += 64
+
+        return value >> (n_of_bits - k)
+
+
+class InvalidCursor(Exception):
+    """
+    A pagination cursor was tampered with or was issued for another configuration
+    """
+    pass
+
+
+def _cursor_fernet(secret):
+    """
+    :return: Fernet (authenticated encryption) with a key derived from `secret`
+    """
+    key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info='anonymizer.datasource.cursor',
+               backend=default_backend()).derive(secret)
+
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def encode_cursor(secret, state):
+    """
+    Turns `state` into an opaque, url-safe pagination cursor
+    The state is encrypted & authenticated with `secret`, so it can't be read, changed or used with another secret
+    """
+    return _cursor_fernet(secret).encrypt(json.dumps(state, separators=(',', ':'))).rstrip('=')
+
+
+def decode_cursor(secret, cursor):
+    """
+    :return: The state stored in a cursor created by `encode_cursor` with the same secret
+    """
+    try:
+        cursor = str(cursor)
+        return json.loads(_cursor_fernet(secret).decrypt(cursor + '=' * (-len(cursor) % 4)))
+    except (InvalidToken, UnicodeEncodeError, TypeError, ValueError):
+        raise InvalidCursor('Invalid cursor')
@@ -125,6 +125,13 @@ class UserTableSelectionForm(forms.Form):
         for table in not_suggested:
             choices.append((table, table))
 
+        # show the size of each table, if it was estimated during schema discovery
+        schema = connection.schema()
+        for idx, (table_name, label) in enumerate(choices):
+            rows = schema.rows(table_name)
+            if rows is not None:
+                choices[idx] = (table_name, '%s, ~%d rows' % (label, rows))
+
         self.fields['users_table'] = forms.ChoiceField(choices=choices)
 
 
@@ -0,0 +1,180 @@
+__author__ = 'dipap'
+
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection as db_connection
+from django.db.models import Q
+from django.utils import timezone
+from anonymizer.datasource.pools import connection_pools
+from anonymizer.models import ConnectionConfiguration, SchemaDiscoveryJob
+
+logger = logging.getLogger(__name__)
+
+# seconds without a progress report after which a running job is considered abandoned by its worker
+JOB_TIMEOUT = getattr(settings, 'ANONYMIZER_JOB_TIMEOUT', 3600)
+
+
+def discover_schema(config):
+    """
+    Queues a discovery of the schema of a configuration, unless one is already queued or running
+    :return: The job
+    """
+    job = config.discovery_jobs.filter(status__in=[SchemaDiscoveryJob.PENDING, SchemaDiscoveryJob.RUNNING]) \
+        .order_by('-created', '-pk').first()
+    if job is None:
+        job = SchemaDiscoveryJob.objects.create(configuration=config)
+
+    wake_worker()
+    return job
+
+
+def latest_job(config):
+    """
+    :return: The most recently queued discovery job of a configuration or None
+    """
+    return config.discovery_jobs.order_by('-created', '-pk').first()
+
+
+def _claimable():
+    abandoned = timezone.now() - timedelta(seconds=JOB_TIMEOUT)
+    return Q(status=SchemaDiscoveryJob.PENDING) | Q(status=SchemaDiscoveryJob.RUNNING, updated__lt=abandoned)
+
+
+def claim_next():
+    """
+    Marks the oldest queued job as running
+    Claiming is a conditional update, so each job is run once even with workers in several processes
+    :return: The job or None if the queue is empty
+    """
+    while True:
+        job = SchemaDiscoveryJob.objects.filter(_claimable()).order_by('created', 'pk').first()
+        if job is None:
+            return None
+
+        now = timezone.now()
+        if SchemaDiscoveryJob.objects.filter(_claimable(), pk=job.pk).update(status=SchemaDiscoveryJob.RUNNING,
+                                                                             updated=now):
+            job.status = SchemaDiscoveryJob.RUNNING
+            job.updated = now
+            return job
+
+        # claimed by another worker in the meantime
+
+
+def run(job):
+    """
+    Discovers the schema of the job's configuration & stores it as the configuration's snapshot
+    Configurations without properties yet also get the default properties of their users table
+    The job is marked stale instead if the connection info changed while it was running
+    """
+    def progress(percent, description):
+        SchemaDiscoveryJob.objects.filter(pk=job.pk).update(progress=percent, description=description,
+                                                            updated=timezone.now())
+
+    try:
+        config = ConnectionConfiguration.objects.get(pk=job.configuration_id)
+        config.refresh_schema(progress=progress)
+
+        properties = ''
+        if config.users_table and not config.properties:
+            progress(90, 'Suggesting properties')
+
+            columns = config.get_connection().get_data_properties(config.users_table, from_related=True)[0]
+            columns.insert(0, ('', '', ''))
+            properties = config.get_default_properties(columns)
+
+        # only write the snapshot, the wizard may be saving the rest of the configuration meanwhile,
+        # unless the snapshot is of a database the configuration no longer uses
+        unchanged = ConnectionConfiguration.objects.filter(pk=config.pk, connection_type=config.connection_type,
+                                                           info=config.info)
+        stored = unchanged.update(schema=config.schema, schema_updated=config.schema_updated)
+
+        if stored and properties:
+            unchanged.filter(users_table=config.users_table, properties='').update(properties=properties)
+    except Exception, e:
+        logger.exception('Schema discovery job %d failed', job.pk)
+        SchemaDiscoveryJob.objects.filter(pk=job.pk).update(status=SchemaDiscoveryJob.FAILED, error=str(e),
+                                                            updated=timezone.now())
+    else:
+        if stored:
+            SchemaDiscoveryJob.objects.filter(pk=job.pk).update(status=SchemaDiscoveryJob.DONE, progress=100,
+                                                                description='Done', updated=timezone.now())
+        else:
+            SchemaDiscoveryJob.objects.filter(pk=job.pk).update(status=SchemaDiscoveryJob.STALE,
+                                                                description='The connection changed, reading again',
+                                                                updated=timezone.now())
+
+
+def run_pending():
+    """
+    Runs queued jobs until the queue is empty
+    :return: The number of jobs that were run
+    """
+    n_of_jobs = 0
+    while True:
+        job = claim_next()
+        if job is None:
+            return n_of_jobs
+
+        try:
+            run(job)
+        finally:
+            # there is no request end to release the source database connections of a worker
+            connection_pools.release()
+
+        n_of_jobs += 1
+
+
+class JobWorker(threading.Thread):
+    """
+    Runs queued jobs in a background thread of the web process
+    The queue is checked when a job is queued & every `poll_interval` seconds, e.g for jobs abandoned by other workers
+    """
+
+    def __init__(self, poll_interval=60):
+        threading.Thread.__init__(self, name='anonymizer-jobs')
+        self.daemon = True
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            self._wake.clear()
+            try:
+                run_pending()
+            except Exception:
+                logger.exception('Running schema discovery jobs failed')
+            finally:
+                # don't keep a database connection open while idle
+                db_connection.close()
+
+            self._wake.wait(self.poll_interval)
+
+
+# the worker thread of this process
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def wake_worker():
+    """
+    Makes the worker thread of this process look for queued jobs, starting it on first use (also after a fork)
+    With ANONYMIZER_JOB_WORKER = False jobs are only run by `manage.py run_jobs`
+    """
+    global _worker
+
+    if not getattr(settings, 'ANONYMIZER_JOB_WORKER', True):
+        return
+
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = JobWorker()
+            _worker.start()
+
+    _worker.wake()
@@ -16,7 +16,7 @@ AGGREGATE_LIST = [
     ('count(DISTINCT @param)', 'Count'),
     ('GROUP_CONCAT', 'Concatenate'),
 
-    ('to_char(@param, \'HH24\')', 'Hour from a datetime')
+    ('hour', 'Hour from a datetime')
     # TODO: expand aggregate list
 ]
 
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from anonymizer.jobs import run_pending
+
+__author__ = 'dipap'
+
+
+class Command(BaseCommand):
+    help = 'Runs queued background jobs (schema discovery), use with ANONYMIZER_JOB_WORKER = False'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=5,
+                            help='Seconds to wait before checking an empty queue again')
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='Exit as soon as the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            n_of_jobs = run_pending()
+            if n_of_jobs:
+                self.stdout.write('Ran %d job(s)' % n_of_jobs)
+
+            if options['once']:
+                return
+
+            time.sleep(options['poll_interval'])
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anonymizer', '0011_connectionaccesskey_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connectionconfiguration',
+            name='schema',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='connectionconfiguration',
+            name='schema_updated',
+            field=models.DateTimeField(default=None, null=True, editable=False, blank=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anonymizer', '0012_connectionconfiguration_schema'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchemaDiscoveryJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('status', models.CharField(default=b'pending', max_length=16, choices=[(b'pending', b'Pending'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed')])),
+                ('updated', models.DateTimeField(default=None, null=True, blank=True)),
+                ('progress', models.IntegerField(default=0)),
+                ('description', models.TextField(default=b'')),
+                ('error', models.TextField(default=b'')),
+                ('configuration', models.ForeignKey(related_name='discovery_jobs', to='anonymizer.ConnectionConfiguration')),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anonymizer', '0013_schemadiscoveryjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='schemadiscoveryjob',
+            name='status',
+            field=models.CharField(default=b'pending', max_length=16, choices=[(b'pending', b'Pending'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed'), (b'stale', b'Stale')]),
+        ),
+    ]
@@ -1,10 +1,27 @@
 import simplejson as json
+import hashlib
 import uuid
+from django.conf import settings
+from django.core.signals import request_finished
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from anonymizer.datasource.connections import ConnectionManager
+from anonymizer.datasource.managers.registry import UserManagerRegistry
 from anonymizer.datasource.managers.users import UserManager
+from anonymizer.datasource.pools import connection_pools
+from anonymizer.datasource.schema import Schema
 from lists import DATABASE_CONNECTION_TYPES
 
+# ready user managers shared by all requests of this process
+user_managers = UserManagerRegistry(max_size=getattr(settings, 'ANONYMIZER_USER_MANAGER_CACHE_SIZE', 16))
+
+# database connections of the configurations, shared by all requests of this process
+connection_pools.configure(min_size=getattr(settings, 'ANONYMIZER_POOL_MIN_SIZE', 0),
+                           max_size=getattr(settings, 'ANONYMIZER_POOL_MAX_SIZE', 10),
+                           idle_timeout=getattr(settings, 'ANONYMIZER_POOL_IDLE_TIMEOUT', 300))
+
 
 class ConnectionConfiguration(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -18,6 +35,10 @@ class ConnectionConfiguration(models.Model):
     properties = models.TextField(default='')
     foreign_keys = models.TextField(default='', editable=False)
 
+    # snapshot of the introspected tables of the database (see Schema) & when it was taken
+    schema = models.TextField(default='', editable=False)
+    schema_updated = models.DateTimeField(blank=True, null=True, default=None, editable=False)
+
     # only one configuration should be active at each time
     is_active = models.BooleanField(default=False, editable=False)
 
@@ -80,14 +101,64 @@ class ConnectionConfiguration(models.Model):
         return json.dumps(obj, indent=4)
 
     def get_connection(self):
-        manager = ConnectionManager(self.info_to_json())
-        return manager.get(self.name)
+        """
+        :return: The connection to the database, introspection uses the schema snapshot if one was taken
+        """
+        connection = ConnectionManager(self.info_to_json()).get(self.name)
+        if self.schema:
+            connection.set_schema(Schema(json.loads(self.schema)))
+
+        return connection
+
+    def refresh_schema(self, progress=None):
+        """
+        Introspects the database & keeps the schema as the snapshot of the configuration (saved by the caller)
+        Large databases take a while, see SchemaDiscoveryJob to run this in the background
+        :param progress: Called with (percent done, description) before each step
+        """
+        if progress is None:
+            progress = lambda percent, description: None
+
+        connection = ConnectionManager(self.info_to_json()).get(self.name)
+
+        progress(0, 'Reading tables, columns & foreign keys')
+        tables = connection.schema().tables
+
+        progress(50, 'Estimating table sizes')
+        rows = connection.estimate_rows()
+        for table in tables:
+            table['rows'] = rows.get(table['name'])
+
+        self.schema = json.dumps(tables)
+        self.schema_updated = timezone.now()
+
+    def clear_schema(self):
+        """
+        Drops the schema snapshot, e.g when the connection info changes
+        """
+        self.schema = ''
+        self.schema_updated = None
+
+    def version(self):
+        """
+        :return: A hash of everything a user manager is built from, changes whenever the configuration changes
+        """
+        fields = [self.name, self.connection_type, self.info, self.user_pk, self.properties, self.foreign_keys]
+        return hashlib.sha1('###'.join([f.encode('utf8') for f in fields])).hexdigest()
 
     def get_user_manager(self, token=None):
+        """
+        Managers with an explicit token are cached in the process-wide registry
+        Only cached managers use the ANONYMIZER_WORKERS worker processes
+        """
+        prefetch = getattr(settings, 'ANONYMIZER_PREFETCH', 0)
         if not token:
-            token = uuid.uuid4()
+            return UserManager(from_str=self.to_json(), token=uuid.uuid4(), prefetch=prefetch)
 
-        return UserManager(from_str=self.to_json(), token=token)
+        workers = getattr(settings, 'ANONYMIZER_WORKERS', 0)
+        return user_managers.get(self.pk, self.version(), token,
+                                 lambda: UserManager(from_str=self.to_json(), token=token, workers=workers,
+                                                     prefetch=prefetch))
 
     def save(self, *args, **kwargs):
         if ConnectionConfiguration.objects.all().count() == 0:
@@ -109,3 +180,55 @@ class ConnectionAccessKey(models.Model):
             self.key = ''.join(uuid.uuid4().__str__().split('-')[0:2])
 
         super(ConnectionAccessKey, self).save(*args, **kwargs)
+
+
+class SchemaDiscoveryJob(models.Model):
+    """
+    A background discovery of the schema of a configuration's database
+    The jobs table is the queue: workers claim pending jobs in the order they were created, see anonymizer.jobs
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    # the connection info changed while the job was running, its schema was not stored
+    STALE = 'stale'
+
+    configuration = models.ForeignKey(ConnectionConfiguration, related_name='discovery_jobs')
+    created = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(max_length=16, default=PENDING,
+                              choices=[(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'),
+                                       (STALE, 'Stale')])
+
+    # set on each progress report, so jobs of workers that died can be found
+    updated = models.DateTimeField(blank=True, null=True, default=None)
+
+    progress = models.IntegerField(default=0)
+    description = models.TextField(default='')
+    error = models.TextField(default='')
+
+    def to_json(self):
+        return {
+            'id': self.pk,
+            'status': self.status,
+            'progress': self.progress,
+            'description': self.description,
+            'error': self.error,
+        }
+
+
+@receiver(post_save, sender=ConnectionConfiguration)
+@receiver(post_delete, sender=ConnectionConfiguration)
+def invalidate_user_managers(sender, instance, **kwargs):
+    """
+    Drop cached user managers when a configuration is saved (also on (de)activation) or deleted
+    """
+    user_managers.invalidate(instance.pk)
+
+
+@receiver(request_finished)
+def release_connections(sender, **kwargs):
+    """
+    Give the database connections a request used back to their pools (streamed responses finish after streaming)
+    """
+    connection_pools.release()
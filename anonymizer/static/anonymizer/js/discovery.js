@@ -0,0 +1,28 @@
+$(function() {
+    /* Poll the progress of the schema discovery & continue to the next page once it is done */
+    var $discovery = $('.schema-discovery');
+
+    function poll() {
+        $.get($discovery.data('progress-url'), function(job) {
+            $discovery.find('.progress-bar').css('width', job.progress + '%');
+            $discovery.find('.discovery-description').text(job.description);
+
+            if (job.status == 'done') {
+                window.location.href = $discovery.data('next');
+            } else if (job.status == 'stale') {
+                /* read the database the configuration uses now */
+                window.location.reload();
+            } else if (job.status == 'failed') {
+                $discovery.find('.progress-bar').removeClass('active');
+                $discovery.find('.error-message').text(job.error);
+                $discovery.find('.discovery-error').removeClass('hidden');
+            } else {
+                setTimeout(poll, 1000);
+            }
+        });
+    }
+
+    if ($discovery.length) {
+        poll();
+    }
+});
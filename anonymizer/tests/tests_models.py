@@ -0,0 +1,138 @@
+import json
+from datetime import timedelta
+
+from django.test.utils import override_settings
+from django.utils import timezone
+from anonymizer.jobs import discover_schema, claim_next, run_pending, JOB_TIMEOUT
+from anonymizer.models import ConnectionConfiguration, SchemaDiscoveryJob
+
+__author__ = 'dipap'
+
+from django.test import TestCase
+
+
+class SchemaSnapshotTests(TestCase):
+
+    def setUp(self):
+        self.config = ConnectionConfiguration.objects.create(name='my_name',
+                                                             connection_type='django.db.backends.sqlite3',
+                                                             info='"name": "test-data/test_site.sqlite3"')
+
+        super(SchemaSnapshotTests, self).setUp()
+
+    def test_refresh_schema(self):
+        self.assertIsNone(self.config.schema_updated)
+
+        self.config.refresh_schema()
+        self.config.save()
+
+        config = ConnectionConfiguration.objects.get(pk=self.config.pk)
+        self.assertIsNotNone(config.schema_updated)
+        self.assertIn('Running', [table['name'] for table in json.loads(config.schema)])
+
+    def test_connection_uses_snapshot(self):
+        self.config.refresh_schema()
+
+        # the stored tables are used instead of the ones of the database
+        snapshot = json.loads(self.config.schema)
+        snapshot[0]['columns'].append(['nickname', 'text'])
+        self.config.schema = json.dumps(snapshot)
+
+        columns = self.config.get_connection().get_data_properties(snapshot[0]['name'])[0]
+        self.assertIn('nickname', [column[0] for column in columns])
+
+        self.config.clear_schema()
+        columns = self.config.get_connection().get_data_properties(snapshot[0]['name'])[0]
+        self.assertNotIn('nickname', [column[0] for column in columns])
+
+
+@override_settings(ANONYMIZER_JOB_WORKER=False)
+class SchemaDiscoveryJobTests(TestCase):
+
+    def setUp(self):
+        self.config = ConnectionConfiguration.objects.create(name='my_name',
+                                                             connection_type='django.db.backends.sqlite3',
+                                                             info='"name": "test-data/test_site.sqlite3"')
+
+        super(SchemaDiscoveryJobTests, self).setUp()
+
+    def test_discovery(self):
+        job = discover_schema(self.config)
+        self.assertEqual(job.status, SchemaDiscoveryJob.PENDING)
+
+        # a queued discovery is not queued again
+        self.assertEqual(discover_schema(self.config).pk, job.pk)
+
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(run_pending(), 0)
+
+        job = SchemaDiscoveryJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, SchemaDiscoveryJob.DONE)
+        self.assertEqual(job.progress, 100)
+
+        # the snapshot includes the row estimates
+        config = ConnectionConfiguration.objects.get(pk=self.config.pk)
+        tables = dict((table['name'], table) for table in json.loads(config.schema))
+        self.assertIsNotNone(tables['Users']['rows'])
+
+    def test_failed_discovery(self):
+        self.config.info = '"name": "test-data/missing/test_site.sqlite3"'
+        self.config.save()
+
+        job = discover_schema(self.config)
+        run_pending()
+
+        job = SchemaDiscoveryJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, SchemaDiscoveryJob.FAILED)
+        self.assertTrue(job.error)
+        self.assertFalse(ConnectionConfiguration.objects.get(pk=self.config.pk).schema)
+
+    def test_claim(self):
+        job = discover_schema(self.config)
+
+        # each job is claimed once
+        self.assertEqual(claim_next().pk, job.pk)
+        self.assertIsNone(claim_next())
+
+        # unless its worker stopped reporting progress
+        SchemaDiscoveryJob.objects.filter(pk=job.pk) \
+            .update(updated=timezone.now() - timedelta(seconds=JOB_TIMEOUT + 1))
+        self.assertEqual(claim_next().pk, job.pk)
+
+    def test_stale_discovery(self):
+        refresh_schema = ConnectionConfiguration.refresh_schema
+
+        # the connection info is edited while the schema is read
+        def edited_meanwhile(config, progress=None):
+            refresh_schema(config, progress=progress)
+            ConnectionConfiguration.objects.filter(pk=config.pk).update(info='"name": "test-data/other.sqlite3"')
+
+        ConnectionConfiguration.refresh_schema = edited_meanwhile
+        try:
+            job = discover_schema(self.config)
+            run_pending()
+        finally:
+            ConnectionConfiguration.refresh_schema = refresh_schema
+
+        # the schema of the old database is not stored
+        self.assertEqual(SchemaDiscoveryJob.objects.get(pk=job.pk).status, SchemaDiscoveryJob.STALE)
+        self.assertFalse(ConnectionConfiguration.objects.get(pk=self.config.pk).schema)
+
+        # a new discovery is queued for the current database
+        self.assertNotEqual(discover_schema(self.config).pk, job.pk)
+
+    def test_default_properties(self):
+        self.config.users_table = 'Users'
+        self.config.save()
+
+        discover_schema(self.config)
+        run_pending()
+
+        properties = json.loads(ConnectionConfiguration.objects.get(pk=self.config.pk).properties)
+        self.assertIn('age', [prop['name'] for prop in properties])
+
+        # properties that were already chosen are kept
+        ConnectionConfiguration.objects.filter(pk=self.config.pk).update(properties='[]')
+        discover_schema(self.config)
+        run_pending()
+        self.assertEqual(ConnectionConfiguration.objects.get(pk=self.config.pk).properties, '[]')
@@ -1,10 +1,11 @@
 import os
 
 import simplejson as json
+from django.contrib.auth.models import User
 from django.contrib.staticfiles.testing import StaticLiveServerTestCase
 from django.utils.datastructures import MultiValueDictKeyError
 from anonymizer.datasource.connections import Connection, ConnectionManager
-from anonymizer.models import ConnectionConfiguration
+from anonymizer.models import ConnectionConfiguration, ConnectionAccessKey
 
 __author__ = 'dipap'
 
@@ -292,6 +293,11 @@ class ConnectionViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(json.loads(response.content)), 4)
 
+        # test filter command with fields, the id is always included
+        response = self.client.get(query_url + '?q=filter(running_duration>35, fields=gender)')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([len(user) for user in json.loads(response.content)], [2] * 4)
+
         # test malformed query
         response = self.client.get(query_url + '?q=filter(wrong>35)')
         self.assertEqual(response.status_code, 400)
@@ -324,3 +330,89 @@ class ConnectionViewTests(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertEqual(ConnectionConfiguration.objects.all().count(), 0)
 
+
+class ConnectionApiTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_user('admin', password='admin')
+        self.client.login(username='admin', password='admin')
+
+        site = json.loads(open('test-data/config/sqlite3_config.json').read())['sites'][0]
+        config = ConnectionConfiguration.objects.create(name='my_site_db',
+                                                        connection_type='django.db.backends.sqlite3',
+                                                        info='"name": "test-data/test_site.sqlite3"',
+                                                        users_table='Users', user_pk=site['user_pk'],
+                                                        properties=json.dumps(site['properties']),
+                                                        foreign_keys=json.dumps(site['foreign_keys']))
+        key = ConnectionAccessKey.objects.create(connection=config, name='test_key')
+
+        self.api_url = '/anonymizer/api/%s/' % key.key
+
+        super(ConnectionApiTests, self).setUp()
+
+    def test_cursor_pages(self):
+        users = json.loads(self.client.get(self.api_url + 'list/').content)
+
+        # follow the cursors until the last page
+        response = self.client.get(self.api_url + 'list/?limit=30')
+        pages = [json.loads(response.content)]
+        while response.has_header('X-Next-Cursor'):
+            response = self.client.get(self.api_url + 'list/?limit=30&cursor=' + response['X-Next-Cursor'])
+            self.assertEqual(response.status_code, 200)
+            pages.append(json.loads(response.content))
+
+        self.assertEqual([len(page) for page in pages], [30, 30, 30, 10])
+        self.assertEqual([user for page in pages for user in page], users)
+
+    def test_cursor_keeps_filters_and_fields(self):
+        response = self.client.get(self.api_url + 'list/?limit=10&filters=gender~Male&fields=gender')
+        cursor = response['X-Next-Cursor']
+
+        response = self.client.get(self.api_url + 'list/?limit=100&cursor=' + cursor)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)), 40)
+        self.assertEqual(set([user['gender'] for user in json.loads(response.content)]), set(['Male']))
+
+        # the cursor only continues the query that issued it
+        response = self.client.get(self.api_url + 'list/?limit=10&filters=gender~Female&cursor=' + cursor)
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(self.api_url + 'list/?limit=10&fields=age&cursor=' + cursor)
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_cursor(self):
+        cursor = self.client.get(self.api_url + 'list/?limit=10')['X-Next-Cursor']
+
+        changed = cursor[:-5] + ('A' if cursor[-5] != 'A' else 'B') + cursor[-4:]
+        response = self.client.get(self.api_url + 'list/?limit=10&cursor=' + changed)
+        self.assertEqual(response.status_code, 400)
+
+        # a cursor is a position of its own, it can't be moved by an offset
+        response = self.client.get(self.api_url + 'list/?limit=10&offset=10&cursor=' + cursor)
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream(self):
+        count = json.loads(self.client.get(self.api_url + 'count/?filters=gender~Male').content)['count']
+        users = json.loads(self.client.get(self.api_url + 'list/?filters=gender~Male').content)
+
+        # a single json list
+        response = self.client.get(self.api_url + 'list/?filters=gender~Male&stream=json')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(''.join(response.streaming_content)), users)
+
+        # one json object per line
+        response = self.client.get(self.api_url + 'list/?filters=gender~Male&stream=ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), count)
+        self.assertEqual([json.loads(line) for line in lines], users)
+
+    def test_malformed_filters(self):
+        # unknown properties, operators & values are the client's error
+        for filters in ['wrong~1', 'age<<5', 'age<20 xor gender~Male']:
+            response = self.client.get(self.api_url + 'list/?filters=' + filters)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', json.loads(response.content))
+
+            response = self.client.get(self.api_url + 'count/?filters=' + filters)
+            self.assertEqual(response.status_code, 400)
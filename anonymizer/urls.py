@@ -19,6 +19,9 @@ urlpatterns = [
     # pick user table & columns
     url(r'^connection/(?P<pk>\d+)/suggest-user-table/$', views.suggest_users_table),
     url(r'^connection/(?P<pk>\d+)/select-columns/$', views.select_columns),
+    url(r'^connection/(?P<pk>\d+)/refresh-schema/$', views.refresh_schema),
+    url(r'^connection/(?P<pk>\d+)/discovery/$', views.schema_discovery),
+    url(r'^connection/(?P<pk>\d+)/discovery/progress/$', views.schema_discovery_progress),
 
     # change active configuration
     url(r'^connection/(?P<pk>\d+)/set-active/$', views.set_active),
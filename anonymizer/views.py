@@ -4,15 +4,22 @@ import traceback
 from functools import partial, wraps
 import json
 import datetime
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.forms import formset_factory
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
+from django.utils.http import is_safe_url, urlencode
 from django.views.generic import CreateView, DeleteView
 import simplejson
+from anonymizer.datasource.managers.data import PropertyNotFoundException, UnknownOperatorException, \
+    InvalidFilterException
+from anonymizer.datasource.util import encode_cursor, decode_cursor, InvalidCursor
 from anonymizer.lists import PROVIDER_PLUGINS
 from forms import ConnectionConfigurationForm, Sqlite3ConnectionForm, MySQLConnectionForm, UserTableSelectionForm, \
     ColumnForm, validate_unique_across, PostgresConnectionForm
-from models import ConnectionConfiguration, ConnectionAccessKey
+from jobs import discover_schema, latest_job
+from models import ConnectionConfiguration, ConnectionAccessKey, SchemaDiscoveryJob
 
 # patch simplejson library to serialize datetimes
 simplejson.JSONEncoder.default = lambda self, obj: (obj.isoformat() if isinstance(obj, datetime.datetime) else None)
@@ -57,6 +64,7 @@ def sqlite3_info(request, pk):
             config.info = '''
                   "name": "''' + form.cleaned_data['path'] + '''"
             '''
+            config.clear_schema()
             config.save()
 
             return redirect('/anonymizer/connection/%d/suggest-user-table/' % config.pk)
@@ -88,6 +96,7 @@ def mysql_info(request, pk):
                 "host": "''' + data['host'] + '''",
                 "port": "''' + data['port'] + '''"
             '''
+            config.clear_schema()
             config.save()
 
             return redirect('/anonymizer/connection/%d/suggest-user-table/' % config.pk)
@@ -119,6 +128,7 @@ def postgres_info(request, pk):
                 "host": "''' + data['host'] + '''",
                 "port": "''' + data['port'] + '''"
             '''
+            config.clear_schema()
             config.save()
 
             return redirect('/anonymizer/connection/%d/suggest-user-table/' % config.pk)
@@ -137,7 +147,12 @@ def suggest_users_table(request, pk):
     status = 200
 
     config = get_object_or_404(ConnectionConfiguration, pk=pk)
+    if not config.schema:
+        # the wizard pages read a snapshot of the schema, discovered in the background
+        return discovery_redirect(request, config)
+
     connection = config.get_connection()
+    params['config'] = config
 
     if request.method == 'GET':
         params['form'] = UserTableSelectionForm(connection)
@@ -176,7 +191,11 @@ def select_columns(request, pk):
     status = 200
 
     config = get_object_or_404(ConnectionConfiguration, pk=pk)
+    if not config.schema:
+        return discovery_redirect(request, config)
+
     connection = config.get_connection()
+    params['config'] = config
 
     columns = connection.get_data_properties(config.users_table, from_related=True)[0]
     columns.insert(0, ('', '', ''))
@@ -294,6 +313,68 @@ def select_columns(request, pk):
     return render(request, 'anonymizer/connection/select_columns.html', params, status=status)
 
 
+def discovery_redirect(request, config, next_url=None):
+    """
+    Queues a discovery of the schema of a configuration & sends the user to its progress page,
+    which continues to `next_url` (by default the current page) once the discovery is done
+    """
+    discover_schema(config)
+
+    return redirect('/anonymizer/connection/%d/discovery/?%s' %
+                    (config.pk, urlencode({'next': next_url or request.path})))
+
+
+def refresh_schema(request, pk):
+    """
+    Discovers the schema of a configuration's database again, e.g after tables or columns were added
+    """
+    if request.method == 'POST':
+        config = get_object_or_404(ConnectionConfiguration, pk=pk)
+
+        return discovery_redirect(request, config, next_url=request.POST.get('next', ''))
+    else:
+        return HttpResponse('Only POST method allowed', status=400)
+
+
+def schema_discovery(request, pk):
+    """
+    Progress of the schema discovery of a configuration, polls `schema_discovery_progress` until it is done
+    """
+    config = get_object_or_404(ConnectionConfiguration, pk=pk)
+
+    # back to the wizard page that needed the schema
+    next_url = request.GET.get('next', '')
+    if not is_safe_url(next_url, host=request.get_host()):
+        next_url = '/anonymizer/connection/%d/suggest-user-table/' % config.pk
+
+    job = latest_job(config)
+    if job is None or job.status == SchemaDiscoveryJob.STALE:
+        job = discover_schema(config)
+    elif job.status == SchemaDiscoveryJob.DONE:
+        return redirect(next_url)
+
+    params = {
+        'config': config,
+        'job': job,
+        'next': next_url,
+    }
+
+    return render(request, 'anonymizer/connection/schema_discovery.html', params)
+
+
+def schema_discovery_progress(request, pk):
+    """
+    :return: The status & progress of the latest schema discovery of a configuration as json
+    """
+    config = get_object_or_404(ConnectionConfiguration, pk=pk)
+
+    job = latest_job(config)
+    if job is None:
+        return JsonResponse({'error': 'No schema discovery was started'}, status=404)
+
+    return JsonResponse(job.to_json())
+
+
 def set_active(request, pk):
     """
     Activates a configuration
@@ -349,6 +430,17 @@ def parse_filters(q):
     return f_end, start, end
 
 
+def parse_fields(args):
+    """
+    Splits the arguments of a console command like `age>30, fields=first_name,age` into filters & fields
+    """
+    pos = args.rfind('fields=')
+    if pos < 0:
+        return args, None
+
+    return args[:pos].strip().rstrip(',').strip(), args[pos + len('fields='):].strip()
+
+
 def query_connection(request, pk):
     """
     Execute a query against a connection
@@ -366,16 +458,18 @@ def query_connection(request, pk):
 
     if q:
         try:
-            if q.startswith('all()'):
-                _, start, end = parse_filters(q)
+            if q.startswith('all('):
+                pos = len('all(')
+                f_end, start, end = parse_filters(q)
 
-                result = user_manager.all(start=start, end=end)
+                _, fields = parse_fields(q[pos:f_end])
+                result = user_manager.all(start=start, end=end, fields=fields)
             elif q.startswith('filter'):
                 pos = len('filter(')
                 f_end, start, end = parse_filters(q)
 
-                filters = q[pos:f_end]
-                result = user_manager.filter(filters, start=start, end=end)
+                filters, fields = parse_fields(q[pos:f_end])
+                result = user_manager.filter(filters, start=start, end=end, fields=fields)
             elif q.startswith('count('):
                 pos = len('count(')
                 f_end, start, end = parse_filters(q)
@@ -389,12 +483,14 @@ def query_connection(request, pk):
     Commands:
         - all(): Fetch all records
         - filter(some_filter): Fetch records based on `some_filter`
+        - all(fields=some_properties), filter(some_filter, fields=some_properties): Only fetch `some_properties`
         - count(some_filters): Count records based on `some_filter`
         - properties: Show all acceptable attributes
 
     Examples of filter usage:
         - filter(age>30)
         - filter(age<20 and run_distance>500)
+        - filter(age>30, fields=first_name,age)
 
     Available data properties:
 """
@@ -475,6 +571,21 @@ def revoke_access_key(request, pk, key_id):
     return redirect('/anonymizer/connection/%d/access-keys/' % configuration.pk)
 
 
+def stream_users(users, stream_format):
+    """
+    Serializes each user as soon as it is available
+    `ndjson` writes one json object per line, `json` writes a single json list
+    """
+    if stream_format == 'ndjson':
+        for user in users:
+            yield json.dumps(user, cls=DjangoJSONEncoder) + '\n'
+    else:
+        yield '['
+        for idx, user in enumerate(users):
+            yield (',' if idx else '') + json.dumps(user, cls=DjangoJSONEncoder)
+        yield ']'
+
+
 def connnection_api_view(request, key, action='list'):
     try:
         access_key = ConnectionAccessKey.objects.get(key=key)
@@ -496,6 +607,9 @@ def connnection_api_view(request, key, action='list'):
     # get filters
     filters = request.GET.get('filters', '').replace('~', '=')
 
+    # only the requested properties are computed & returned, e.g `fields=first_name,age`
+    fields = request.GET.get('fields', '') or None
+
     # get offset & limit
     try:
         start = int(request.GET.get('offset', '0'))
@@ -507,18 +621,79 @@ def connnection_api_view(request, key, action='list'):
     except (ValueError, TypeError):
         end = None
 
-    user_manager = access_key.connection.get_user_manager(token=access_key.connection.pk)
+    connection = access_key.connection
+    user_manager = connection.get_user_manager(token=connection.pk)
     status = 200
 
-    if action == 'list':
-        result = user_manager.filter(filters, start=start, end=end)
-    elif action == 'count':
-        result = {
-            'count': user_manager.count(filters)
-        }
-    else:
+    # cursors are only valid for the configuration (& version) that issued them
+    cursor_secret = str('%s#%d#%s' % (settings.SECRET_KEY, connection.pk, connection.version()))
+    after = None
+
+    # continue after the last user of a previous page
+    cursor = request.GET.get('cursor', '')
+    if cursor:
+        # the cursor already is the position of the next page
+        if start:
+            return JsonResponse({
+                'error': 'A cursor can not be combined with an offset.'
+            }, status=400)
+
+        try:
+            state = decode_cursor(cursor_secret, cursor)
+        except InvalidCursor as e:
+            return JsonResponse({
+                'error': str(e)
+            }, status=400)
+
+        # a cursor only continues the query that issued it
+        if filters and filters != state['filters']:
+            return JsonResponse({
+                'error': 'The cursor was issued for different filters.'
+            }, status=400)
+
+        if fields and fields != state['fields']:
+            return JsonResponse({
+                'error': 'The cursor was issued for different fields.'
+            }, status=400)
+
+        filters = state['filters']
+        fields = state['fields']
+        after = state['after']
+
+    # stream results instead of building the whole response in memory
+    stream_format = request.GET.get('stream', '')
+
+    # filters & fields are validated before any user is fetched, malformed ones are the client's error
+    try:
+        if action == 'list' and stream_format in ['json', 'ndjson']:
+            users = user_manager.iterate(filters, start=start, end=end, after=after, fields=fields)
+            content_type = 'application/x-ndjson' if stream_format == 'ndjson' else 'application/json'
+
+            return StreamingHttpResponse(stream_users(users, stream_format), content_type=content_type)
+        elif action == 'list' and not start and (end is not None or cursor):
+            # keyset pagination, the `X-Next-Cursor` header points to the next page
+            result, last_pk = user_manager.page(filters, after=after, limit=end, fields=fields)
+
+            response = JsonResponse(result, safe=False, status=status)
+            if last_pk is not None:
+                response['X-Next-Cursor'] = encode_cursor(cursor_secret, {'after': last_pk, 'filters': filters,
+                                                                        'fields': fields})
+
+            return response
+        elif action == 'list':
+            result = user_manager.filter(filters, start=start, end=end, fields=fields)
+        elif action == 'count':
+            result = {
+                'count': user_manager.count(filters)
+            }
+        else:
+            result = {
+                'error': 'Invalid action.'
+            }
+            status = 400
+    except (UnknownOperatorException, PropertyNotFoundException, InvalidFilterException) as e:
         result = {
-            'error': 'Invalid action.'
+            'error': unicode(e)
         }
         status = 400
 